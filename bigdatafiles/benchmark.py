@@ -0,0 +1,250 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from metrics import peak_rss_mb
+from synthetic_data import generate_dataset
+
+# Benchmark corpus and scratch space, kept apart from real data
+BENCH_DIR = 'benchmark_data'
+RESULTS_FILE = 'benchmark_results.jsonl'
+
+# Default corpus: shards x records, plus one corrupt and one empty shard
+SHARDS = 2
+RECORDS_PER_SHARD = 12000
+
+# A run is flagged when throughput drops or peak memory grows by more than this
+# fraction compared with the best earlier run of the same stage and scale
+THROUGHPUT_TOLERANCE = 0.15
+RSS_TOLERANCE = 0.25
+
+# clean_ndjson stages the shards as newline-delimited JSON; convert_ndjson and
+# convert_ndjson_python convert such staged copies (staging is not timed) with
+# Arrow's native JSON reader and with the Python reader respectively; their
+# throughput in MB/s is measured against the staged files' size
+STAGES = ['clean', 'clean_in_memory', 'clean_ndjson', 'convert', 'convert_ndjson', 'convert_ndjson_python',
+          'clean_convert', 'profile']
+
+
+def _run_stage(stage, sources, input_dir, work_dir):
+    """
+    Run one stage over every source in a fresh process, so its peak RSS is its own.
+
+    Returns:
+        dict: records, errors, seconds, rss_before_mb, peak_rss_mb, plus for
+        the stages that convert staged copies the bytes staged and
+        staging_errors, a list of {"file", "error"} for the shards that could
+        not be staged (they count as failed files)
+    """
+    # Manifest and vocabulary files are created relative to the working directory
+    os.chdir(work_dir)
+    from json_stream import Quarantine, iter_ndjson_records, iter_records
+    from shard_sources import open_json_source, relative_source_path
+    import data_cleaner
+    import convert_to_parquet
+    import clean_to_parquet
+    import file_analysis
+    from parquet_dataset import dataset_file_name
+    from manifest import shard_key
+
+    staging = {}
+    if stage in ('convert_ndjson', 'convert_ndjson_python'):
+        staged_dir = os.path.join(work_dir, 'staged')
+        staged = []
+        staging = {"bytes": 0, "staging_errors": []}
+        for source in sources:
+            path = os.path.join(staged_dir, os.path.splitext(relative_source_path(source, input_dir))[0] + '.ndjson')
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            try:
+                data_cleaner.clean_file_streaming(source, path, Quarantine(source), ndjson=True)
+            except Exception as e:
+                staging["staging_errors"].append({"file": source, "error": str(e)})
+                continue
+            staging["bytes"] += os.path.getsize(path)
+            staged.append(path)
+        sources, input_dir = staged, staged_dir
+
+    rss_before = peak_rss_mb()
+    records = 0
+    errors = len(staging.get("staging_errors", []))
+    start = time.perf_counter()
+    for source in sources:
+        output_path = os.path.join(work_dir, 'out', relative_source_path(source, input_dir))
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        try:
+            if stage == 'clean':
+                records += data_cleaner.clean_file_streaming(source, output_path, Quarantine(source))
+            elif stage == 'clean_ndjson':
+                ndjson_path = os.path.splitext(output_path)[0] + '.ndjson'
+                records += data_cleaner.clean_file_streaming(source, ndjson_path, Quarantine(source), ndjson=True)
+            elif stage == 'clean_in_memory':
+                # The original whole-file path: json.load, remove_fields_from_dict, json.dump
+                with open_json_source(source) as f:
+                    data = json.load(f)
+                cleaned = data_cleaner.remove_fields_from_dict(data, data_cleaner.FIELDS_TO_REMOVE)
+                with open(output_path, 'w', encoding='utf-8') as f:
+                    json.dump(cleaned, f, separators=(',', ':'))
+                records += len(cleaned.get('results', []))
+            elif stage == 'convert':
+                with open_json_source(source, errors='replace') as f:
+                    count, _ = convert_to_parquet.write_records_to_dataset(
+                        iter_records(f, on_error=Quarantine(source)), os.path.join(work_dir, 'parquet'), dataset_file_name(source, input_dir),
+                        shard_key(source, input_dir)
+                    )
+                records += count
+            elif stage == 'convert_ndjson':
+                count, _ = convert_to_parquet.write_batches_to_dataset(
+                    convert_to_parquet.read_ndjson_batches(source), os.path.join(work_dir, 'parquet'),
+                    dataset_file_name(source, input_dir), shard_key(source, input_dir)
+                )
+                records += count
+            elif stage == 'convert_ndjson_python':
+                with open_json_source(source, errors='replace') as f:
+                    count, _ = convert_to_parquet.write_records_to_dataset(
+                        iter_ndjson_records(f, on_error=Quarantine(source)), os.path.join(work_dir, 'parquet'),
+                        dataset_file_name(source, input_dir), shard_key(source, input_dir)
+                    )
+                records += count
+            elif stage == 'clean_convert':
+                result = clean_to_parquet.clean_and_convert(
+                    source, input_dir, os.path.join(work_dir, 'parquet'),
+                    normalized_dir=os.path.join(work_dir, 'normalized'),
+                )
+                if result['error']:
+                    raise ValueError(result['error'])
+                records += result['records']
+            elif stage == 'profile':
+                profile = file_analysis.profile_json_file(source)
+                if profile['errors']:
+                    raise ValueError(profile['errors'][0]['error'])
+                records += profile['records']
+            else:
+                raise ValueError(f"Unknown stage {stage!r}")
+        except Exception:
+            errors += 1
+    return {
+        "records": records,
+        "errors": errors,
+        "seconds": time.perf_counter() - start,
+        "rss_before_mb": rss_before,
+        "peak_rss_mb": peak_rss_mb(),
+        **staging,
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def load_results(results_file=RESULTS_FILE):
+    if not os.path.exists(results_file):
+        return []
+    with open(results_file, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def check_regression(result, history):
+    """
+    Compare a result with the best earlier run of the same stage and scale.
+
+    Returns:
+        list: Human-readable regressions (empty if none).
+    """
+    earlier = [r for r in history if r['stage'] == result['stage'] and r['scale'] == result['scale']]
+    if not earlier:
+        return []
+    problems = []
+    best_throughput = max(r['records_per_second'] for r in earlier)
+    if result['records_per_second'] < best_throughput * (1 - THROUGHPUT_TOLERANCE):
+        problems.append(f"{result['stage']}: {result['records_per_second']:.0f} records/s "
+                        f"vs. best {best_throughput:.0f}")
+    best_rss = min(r['peak_rss_mb'] for r in earlier)
+    if result['peak_rss_mb'] > best_rss * (1 + RSS_TOLERANCE):
+        problems.append(f"{result['stage']}: peak RSS {result['peak_rss_mb']:.0f} MB vs. best {best_rss:.0f} MB")
+    return problems
+
+
+def main(stages=STAGES, shards=SHARDS, records_per_shard=RECORDS_PER_SHARD, bench_dir=BENCH_DIR,
+         results_file=RESULTS_FILE, as_zip=False, seed=0):
+    """
+    Generate (or reuse) a synthetic corpus, benchmark each stage on it and
+    append the results to `results_file`.
+
+    Returns:
+        int: 0, or 1 if any stage regressed against earlier results.
+    """
+    bench_dir = os.path.abspath(bench_dir)
+    scale = f"{shards}x{records_per_shard}{'-zip' if as_zip else ''}-seed{seed}"
+    input_dir = os.path.join(bench_dir, 'input', scale)
+    if not os.path.isdir(input_dir):
+        print(f"Generating synthetic corpus {scale} in {input_dir}")
+        generate_dataset(input_dir, shards, records_per_shard, seed=seed, as_zip=as_zip)
+    from shard_sources import list_json_sources, source_size
+    sources = list_json_sources(input_dir)
+    bytes_in = sum(source_size(source) for source in sources)
+
+    history = load_results(results_file)
+    regressions = []
+    context = multiprocessing.get_context('spawn')
+    for stage in stages:
+        work_dir = os.path.join(bench_dir, 'work', stage)
+        shutil.rmtree(work_dir, ignore_errors=True)
+        os.makedirs(work_dir)
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            measured = executor.submit(_run_stage, stage, sources, input_dir, work_dir).result()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+        seconds = measured['seconds']
+        stage_bytes = measured.get('bytes', bytes_in)
+        result = {
+            "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S'),
+            "commit": _git_commit(),
+            "stage": stage,
+            "scale": scale,
+            "files": len(sources),
+            "errors": measured['errors'],
+            "records": measured['records'],
+            "bytes": stage_bytes,
+            "seconds": seconds,
+            "records_per_second": measured['records'] / seconds if seconds else 0.0,
+            "mb_per_second": stage_bytes / 1024 ** 2 / seconds if seconds else 0.0,
+            "rss_before_mb": measured['rss_before_mb'],
+            "peak_rss_mb": measured['peak_rss_mb'],
+            "python": platform.python_version(),
+        }
+        if 'staging_errors' in measured:
+            result["staging_errors"] = measured['staging_errors']
+        problems = check_regression(result, history)
+        regressions.extend(problems)
+        with open(results_file, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(result) + "\n")
+        print(f"{stage:<22}{result['records_per_second']:>10.0f} records/s{result['mb_per_second']:>8.1f} MB/s"
+              f"{result['peak_rss_mb']:>8.0f} MB peak RSS  ({result['errors']} failed files)"
+              + ("  REGRESSION" if problems else ""))
+        for failure in measured.get('staging_errors', []):
+            print(f"    staging failed: {failure['file']}: {failure['error']}")
+
+    for problem in regressions:
+        print(f"Regression: {problem}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    # Adjustable parameters
+    stages_to_run = STAGES
+    number_of_shards = SHARDS
+    records_in_each_shard = RECORDS_PER_SHARD
+    zipped_corpus = False  # Read the shards from zip archives, like the downloaded data
+
+    sys.exit(main(stages_to_run, number_of_shards, records_in_each_shard, as_zip=zipped_corpus))
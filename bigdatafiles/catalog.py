@@ -0,0 +1,285 @@
+import os
+import re
+import json
+from datetime import date
+from html.parser import HTMLParser
+
+# openFDA download index: a saved copy of the download page, or download.json
+# from https://api.fda.gov/download.json. A plain list of links (the old
+# output_links.txt) also works, without sizes.
+CATALOG_PATH = 'Project.html'
+
+# Drug-event shard URLs, e.g.
+# https://download.open.fda.gov/drug/event/2004q3/drug-event-0001-of-0005.json.zip
+_SHARD_URL = re.compile(
+    r'/drug/event/(?P<quarter>[^/]+)/drug-event-(?P<shard>\d+)-of-(?P<shards>\d+)\.json\.zip$'
+)
+_QUARTER = re.compile(r'^(?P<year>\d{4})q(?P<quarter>[1-4])$')
+
+# Partition holding reports without a quarter ('All other data' on the page)
+OTHER_QUARTER = 'all_other'
+
+# Size next to each link on the download page, e.g. '7.32 mb'
+_SIZE = re.compile(r'^\s*([\d.]+)\s*(kb|mb|gb)\s*$', re.IGNORECASE)
+_UNIT_BYTES = {'kb': 1024, 'mb': 1024 ** 2, 'gb': 1024 ** 3}
+
+
+def shard_file_name(quarter, shard, shards):
+    """
+    Stable download name of a shard, from its quarter and position, e.g.
+    '2004q3-drug-event-0001-of-0005.json.zip'. Underscores are avoided because
+    the part of a Parquet file name before the first '_' is its shard key
+    (see parquet_dataset.dataset_file_name).
+    """
+    return f"{quarter.replace('_', '-')}-drug-event-{shard:04d}-of-{shards:04d}.json.zip"
+
+
+def make_entry(url, size=None, checksum=None, records=None, position=None):
+    """
+    Catalog entry of a shard URL, or None if the URL is not a drug-event shard.
+
+    Returns:
+        dict: {"quarter", "shard", "shards", "url", "size" (expected bytes or
+        None), "checksum" (SHA-256 or None), "records", "name" (stable file
+        name), "position" (1-based place in the index)}.
+    """
+    match = _SHARD_URL.search(url)
+    if not match:
+        return None
+    shard, shards = int(match.group('shard')), int(match.group('shards'))
+    return {
+        "quarter": match.group('quarter'),
+        "shard": shard,
+        "shards": shards,
+        "url": url,
+        "size": size,
+        "checksum": checksum,
+        "records": records,
+        "name": shard_file_name(match.group('quarter'), shard, shards),
+        "position": position,
+    }
+
+
+class _IndexPageParser(HTMLParser):
+    """
+    Collects every link of the download page with the size shown in the
+    element that follows it.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.links = []  # [url, size text]
+        self.in_size = False
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == 'a' and attrs.get('href'):
+            self.links.append([attrs['href'].strip(), None])
+        elif tag == 'span' and self.links and self.links[-1][1] is None:
+            self.in_size = True
+
+    def handle_endtag(self, tag):
+        if tag == 'span':
+            self.in_size = False
+
+    def handle_data(self, data):
+        if self.in_size and _SIZE.match(data):
+            self.links[-1][1] = data
+
+
+def parse_size(text):
+    """
+    Bytes of a size like '7.32 mb'; None if it can't be read.
+    """
+    match = _SIZE.match(text or '')
+    if not match:
+        return None
+    return int(float(match.group(1)) * _UNIT_BYTES[match.group(2).lower()])
+
+
+def parse_index_page(path):
+    """
+    Entries of a saved openFDA download page.
+    """
+    parser = _IndexPageParser()
+    with open(path, 'r', encoding='utf-8') as f:
+        parser.feed(f.read())
+    entries = []
+    for url, size_text in parser.links:
+        entry = make_entry(url, size=parse_size(size_text), position=len(entries) + 1)
+        if entry:
+            entries.append(entry)
+    return entries
+
+
+def parse_download_json(path):
+    """
+    Entries of openFDA's download.json (results.drug.event.partitions), whose
+    partitions carry the file URL, size in MB and record count.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        index = json.load(f)
+    partitions = index.get('results', index).get('drug', {}).get('event', {}).get('partitions', [])
+    entries = []
+    for partition in partitions:
+        size_mb = partition.get('size_mb')
+        entry = make_entry(
+            partition.get('file', ''),
+            size=int(float(size_mb) * 1024 ** 2) if size_mb not in (None, '') else None,
+            checksum=partition.get('sha256'),
+            records=partition.get('records'),
+            position=len(entries) + 1,
+        )
+        if entry:
+            entries.append(entry)
+    return entries
+
+
+def parse_link_list(path):
+    """
+    Entries of a plain list of links, one per line (e.g. output_links.txt).
+    """
+    entries = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            entry = make_entry(line.strip(), position=len(entries) + 1)
+            if entry:
+                entries.append(entry)
+    return entries
+
+
+def load_catalog(path=CATALOG_PATH):
+    """
+    Parse a download index into catalog entries (see make_entry), choosing
+    the parser by file type: .json (download.json), .html/.htm (the saved
+    download page) or anything else as a list of links.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.json':
+        return parse_download_json(path)
+    if extension in ('.html', '.htm'):
+        return parse_index_page(path)
+    return parse_link_list(path)
+
+
+def quarter_start(quarter):
+    """
+    First day of a quarter like '2004q3'; None for OTHER_QUARTER.
+    """
+    match = _QUARTER.match(quarter)
+    if not match:
+        return None
+    return date(int(match.group('year')), 3 * int(match.group('quarter')) - 2, 1)
+
+
+def _period_start(period):
+    """
+    First day of a period given as 'YYYY', 'YYYYqN' or 'YYYY-MM'.
+    """
+    period = period.lower()
+    if _QUARTER.match(period):
+        return quarter_start(period)
+    year, _, month = period.partition('-')
+    return date(int(year), int(month or 1), 1)
+
+
+def _period_end(period):
+    """
+    First day after a period given as 'YYYY', 'YYYYqN' or 'YYYY-MM'.
+    """
+    start = _period_start(period)
+    months = 12 if re.fullmatch(r'\d{4}', period) else 3 if _QUARTER.match(period.lower()) else 1
+    month = start.month - 1 + months
+    return date(start.year + month // 12, month % 12 + 1, 1)
+
+
+def select_entries(entries, quarters=None, start=None, end=None, include_other=None):
+    """
+    Pick shards by quarter or by date range and order them largest-first, so
+    parallel downloads started in that order finish at about the same time.
+
+    Parameters:
+        entries (list): Catalog entries.
+        quarters (list): Quarters ('2004q3'), whole years ('2004') or
+            OTHER_QUARTER to keep.
+        start, end (str): Inclusive range of 'YYYY', 'YYYYqN' or 'YYYY-MM';
+            a quarter is kept if it overlaps the range.
+        include_other (bool): Keep the OTHER_QUARTER shards. Defaults to
+            keeping them only when no quarter or range is given.
+
+    Returns:
+        list: Selected entries, largest first (unknown sizes last, then in
+        index order).
+    """
+    filtered = quarters is not None or start is not None or end is not None
+    if include_other is None:
+        include_other = not filtered
+    wanted = {q.lower() for q in quarters} if quarters is not None else None
+    range_start = _period_start(start) if start else None
+    range_end = _period_end(end) if end else None
+
+    selected = []
+    for entry in entries:
+        first_day = quarter_start(entry["quarter"])
+        if first_day is None:
+            if include_other or (wanted is not None and entry["quarter"] in wanted):
+                selected.append(entry)
+            continue
+        if wanted is not None and entry["quarter"] not in wanted and entry["quarter"][:4] not in wanted:
+            continue
+        next_quarter = _period_end(entry["quarter"])
+        if range_start is not None and next_quarter <= range_start:
+            continue
+        if range_end is not None and first_day >= range_end:
+            continue
+        selected.append(entry)
+    return sorted(selected, key=lambda e: (e["size"] is None, -(e["size"] or 0), e["position"] or 0))
+
+
+def legacy_file_name(entry):
+    """
+    Name the line-number based downloaders gave the shard: its 1-based line
+    in output_links.txt, which follows the order of the download page.
+    """
+    return f"{entry['position']}-{os.path.basename(entry['url'])}"
+
+
+def summarize(entries):
+    """
+    Shards, known bytes and records per year ('other' for OTHER_QUARTER).
+
+    Returns:
+        dict: Year -> {"shards", "bytes", "records"}
+    """
+    years = {}
+    for entry in entries:
+        year = entry["quarter"][:4] if quarter_start(entry["quarter"]) else 'other'
+        totals = years.setdefault(year, {"shards": 0, "bytes": 0, "records": 0})
+        totals["shards"] += 1
+        totals["bytes"] += entry["size"] or 0
+        totals["records"] += entry["records"] or 0
+    return dict(sorted(years.items()))
+
+
+def main(catalog_path=CATALOG_PATH, quarters=None, start=None, end=None):
+    """
+    Print the shards of the catalog per year and the largest selected shards.
+    """
+    entries = load_catalog(catalog_path)
+    selected = select_entries(entries, quarters, start, end)
+    quarter_count = len({entry["quarter"] for entry in entries})
+    print(f"{catalog_path}: {len(entries)} shards in {quarter_count} quarters, "
+          f"{len(selected)} selected ({sum(e['size'] or 0 for e in selected) / 1024 ** 3:.1f} GB)")
+    for year, totals in summarize(selected).items():
+        print(f"  {year:<6}{totals['shards']:>6} shards{totals['bytes'] / 1024 ** 3:>9.2f} GB")
+    for entry in selected[:5]:
+        print(f"  {entry['name']:<48}{(entry['size'] or 0) / 1024 ** 2:>9.1f} MB  {entry['url']}")
+
+
+if __name__ == "__main__":
+    # Adjustable parameters
+    catalog_file = CATALOG_PATH  # Saved download page, download.json or a list of links
+    selected_quarters = None  # e.g. ['2004q3', '2005'] or None for every quarter
+    first_period, last_period = None, None  # e.g. '2010q1', '2012-06'
+
+    main(catalog_file, selected_quarters, first_period, last_period)
@@ -0,0 +1,166 @@
+import os
+import time
+from contextlib import ExitStack
+from convert_to_parquet import BATCH_SIZE, drop_stale_compacted_rows, log_error, write_records_to_dataset
+from data_cleaner import FIELDS_TO_REMOVE, iter_cleaned_events
+from drug_event_schema import SCHEMA_VERSION
+from json_stream import Quarantine, tee_events
+from manifest import Manifest, shard_key
+from metrics import print_summary, start_run, track
+from normalized_tables import NORMALIZED_DIR
+from parquet_dataset import dataset_file_name
+from scheduler import run_scheduled
+from shard_sources import list_json_sources, open_json_source, relative_source_path, source_size
+
+# Input and output directories
+INPUT_DIR = 'DataUnzip'
+OUTPUT_DIR = 'Data_parquet'
+
+# Name of this stage in the ingestion manifest; the fused path replaces clean + convert
+STAGE = 'convert'
+
+# Set to a directory (e.g. 'DataUnzip_cleaned') to also keep the cleaned JSON for debugging
+DEBUG_JSON_DIR = None
+
+
+def clean_and_convert(file_path, input_dir=INPUT_DIR, output_dir=OUTPUT_DIR,
+                      debug_json_dir=DEBUG_JSON_DIR, batch_size=BATCH_SIZE, normalized_dir=NORMALIZED_DIR):
+    """
+    Read a raw shard once, drop FIELDS_TO_REMOVE from every record and write the
+    records straight to the month-partitioned Parquet dataset with the canonical
+    drug-event schema, in record batches of `batch_size`. The well-formed records
+    of a truncated or partly corrupt shard are kept and the skipped byte ranges
+    are quarantined (see json_stream.Quarantine).
+
+    Parameters:
+        file_path (str): Path to the raw JSON shard, or a zip member source.
+        input_dir (str): Root the shard path is taken relative to for naming.
+        output_dir (str): Root directory of the Parquet dataset.
+        debug_json_dir (str): If set, the cleaned JSON is also written under this directory.
+        batch_size (int): Number of records per Arrow record batch.
+        normalized_dir (str): Root of the reports/drugs/reactions tables, or None to skip them.
+
+    Returns:
+        dict: Per-file throughput figures, or error details.
+    """
+    start = time.perf_counter()
+    file_name = dataset_file_name(file_path, input_dir)
+    output_paths = []
+    bytes_written = 0
+    record_count = 0
+    error = None
+
+    with track(STAGE, file_path, bytes_in=source_size(file_path)) as m:
+        try:
+            os.makedirs(output_dir, exist_ok=True)
+            quarantine = Quarantine(file_path)
+            with open_json_source(file_path, errors='replace') as src, ExitStack() as stack:
+                events = iter_cleaned_events(src, FIELDS_TO_REMOVE, on_error=quarantine)
+                if debug_json_dir:
+                    debug_path = os.path.join(debug_json_dir, relative_source_path(file_path, input_dir))
+                    os.makedirs(os.path.dirname(debug_path), exist_ok=True)
+                    out = stack.enter_context(open(debug_path, 'w', encoding='utf-8'))
+                    events = tee_events(events, out)
+                records = (value for event, _, value in events if event == "record")
+                record_count, output_paths = write_records_to_dataset(
+                    records, output_dir, file_name, shard_key(file_path, input_dir), batch_size,
+                    normalized_dir=normalized_dir
+                )
+            if debug_json_dir:
+                bytes_written += os.path.getsize(debug_path)
+            bytes_written += sum(os.path.getsize(path) for path in output_paths)
+            if quarantine.ranges:
+                log_error(file_path, f"Salvaged {record_count} records, {quarantine.summary()}")
+        except Exception as e:
+            error = str(e)
+        m.records, m.bytes_out, m.error = record_count, bytes_written, error
+
+    return {
+        "file": file_path,
+        "outputs": output_paths,
+        "records": record_count,
+        "bytes_in": m.bytes_in,
+        "bytes_written": bytes_written,
+        "seconds": time.perf_counter() - start,
+        "error": error,
+    }
+
+
+def failed_result(file_path, error):
+    """
+    Result of a shard whose worker raised or died (see scheduler.run_tasks).
+    """
+    return {"file": file_path, "outputs": [], "records": 0, "bytes_in": 0, "bytes_written": 0,
+            "seconds": 0.0, "error": error}
+
+
+def summarize(results, wall_seconds):
+    """
+    Summarise per-file results into overall throughput figures.
+    """
+    records = sum(result["records"] for result in results)
+    bytes_in = sum(result["bytes_in"] for result in results)
+    bytes_written = sum(result["bytes_written"] for result in results)
+    return {
+        "files": len(results),
+        "errors": [result for result in results if result["error"]],
+        "records": records,
+        "bytes_in": bytes_in,
+        "bytes_written": bytes_written,
+        "wall_seconds": wall_seconds,
+        "records_per_second": records / wall_seconds if wall_seconds else 0.0,
+        "mb_read_per_second": bytes_in / (1024 ** 2) / wall_seconds if wall_seconds else 0.0,
+    }
+
+
+def main(input_dir=INPUT_DIR, output_dir=OUTPUT_DIR, debug_json_dir=DEBUG_JSON_DIR,
+         batch_size=BATCH_SIZE, normalized_dir=NORMALIZED_DIR, memory_budget_gb=None, max_workers=None):
+    """
+    Clean and convert every raw JSON shard to Parquet in a single pass.
+    `input_dir` may hold extracted JSON files or the downloaded zip archives.
+    Shards run largest first, as many at once as `memory_budget_gb` allows
+    (see scheduler).
+    """
+    all_json_files = list_json_sources(input_dir)
+    print(f"Found {len(all_json_files)} JSON files to process.")
+
+    # Skip shards already converted with the current schema that have not changed since
+    with Manifest() as manifest:
+        pending = manifest.pending_sources(STAGE, all_json_files, input_dir, SCHEMA_VERSION)
+    print(f"{len(all_json_files) - len(pending)} files are up to date, {len(pending)} to process.")
+    if not pending:
+        return summarize([], 0.0)
+
+    run_id = start_run(STAGE)
+    start = time.perf_counter()
+    results = list(run_scheduled(
+        clean_and_convert,
+        list(pending),
+        memory_budget_gb,
+        max_workers,
+        error_result=failed_result,
+        input_dir=input_dir,
+        output_dir=output_dir,
+        debug_json_dir=debug_json_dir,
+        batch_size=batch_size,
+        normalized_dir=normalized_dir,
+    ).values())
+    summary = summarize(results, time.perf_counter() - start)
+
+    with Manifest() as manifest:
+        manifest.record_results(STAGE, pending, {
+            result["file"]: result["error"] is None or result["error"] for result in results
+        })
+    drop_stale_compacted_rows(output_dir, normalized_dir)
+
+    print(f"Converted {summary['records']} records from {summary['files']} files "
+          f"in {summary['wall_seconds']:.1f}s")
+    print(f"Throughput: {summary['records_per_second']:.0f} records/s, "
+          f"{summary['mb_read_per_second']:.1f} MB/s read")
+    print(f"Bytes read: {summary['bytes_in']}, bytes written: {summary['bytes_written']}")
+    print_summary(run_id)
+    return summary
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,373 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from parquet_dataset import (
+    PARTITION_KEY, ROW_GROUP_SIZE, DATA_PAGE_SIZE, COMPRESSION, COMPACTED_PREFIX, COMPACTED_INPUTS_KEY,
+    SHARD_COLUMN, SHARDS_KEY, compacted_inputs, drop_stale_rows, file_shards, is_compacted,
+)
+
+# Dataset produced by convert_to_parquet / clean_to_parquet
+DATASET_DIR = 'Data_parquet'
+
+# Files are merged until a compacted file would exceed this size
+TARGET_FILE_SIZE = 256 * 1024 * 1024
+
+# Columns used to order rows when sorting, for tighter min/max statistics
+SORT_COLUMNS = [('receivedate', 'ascending'), ('safetyreportid', 'ascending')]
+
+# Number of rows read from an input file at a time when streaming
+READ_BATCH_SIZE = 64 * 1024
+
+# Rows sorted in memory at a time when sorting; each sorted run is spilled to
+# a temporary file and the runs are merged
+SORT_RUN_ROWS = ROW_GROUP_SIZE
+
+
+def list_partitions(dataset_dir):
+    """
+    List the partition directories of a dataset.
+    """
+    return sorted(
+        os.path.join(dataset_dir, name)
+        for name in os.listdir(dataset_dir)
+        if name.startswith(f"{PARTITION_KEY}=") and os.path.isdir(os.path.join(dataset_dir, name))
+    )
+
+
+def list_files(partition_dir):
+    return sorted(
+        os.path.join(partition_dir, name) for name in os.listdir(partition_dir)
+        if name.endswith('.parquet') and not name.startswith('.')
+    )
+
+
+def recover_partition(partition_dir):
+    """
+    Finish a compaction interrupted after its merged file was moved into
+    place: inputs still listed by a compacted file are deleted, unless they
+    hold a shard converted again since the merge. Leftover temporary files
+    are removed too.
+    """
+    for name in os.listdir(partition_dir):
+        path = os.path.join(partition_dir, name)
+        if name.startswith(f".{COMPACTED_PREFIX}"):
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+    for path in list_files(partition_dir):
+        if not is_compacted(path) or not os.path.exists(path):
+            continue
+        merged = file_shards(path).items()
+        for name in compacted_inputs(path):
+            leftover = os.path.join(partition_dir, name)
+            if leftover != path and os.path.exists(leftover) and file_shards(leftover).items() <= merged:
+                os.remove(leftover)
+
+
+def plan_bins(file_paths, target_size=TARGET_FILE_SIZE, sort=False):
+    """
+    Group the files of a partition into bins of at most `target_size` bytes.
+    Only files with identical schemas share a bin. Files already at the target
+    size are left alone, as are single-file bins unless sorting was requested
+    and the file is not already the output of a compaction.
+
+    Returns:
+        list: Lists of file paths to merge, in name order.
+    """
+    by_schema = {}
+    for path in sorted(file_paths):
+        if os.path.getsize(path) >= target_size:
+            continue
+        by_schema.setdefault(pq.read_schema(path).to_string(), []).append(path)
+
+    bins = []
+    for paths in by_schema.values():
+        current, current_size = [], 0
+        for path in paths:
+            size = os.path.getsize(path)
+            if current and current_size + size > target_size:
+                bins.append(current)
+                current, current_size = [], 0
+            current.append(path)
+            current_size += size
+        if current:
+            bins.append(current)
+    return [
+        paths for paths in bins
+        if len(paths) > 1 or (sort and not is_compacted(paths[0]))
+    ]
+
+
+def compacted_file_name(file_paths):
+    """
+    Deterministic name for the file merged from `file_paths`. The digest
+    covers the size and modification time of every input too, so merging
+    files later rewritten under the same names gives a new name.
+    """
+    fingerprints = []
+    for path in sorted(file_paths):
+        stat = os.stat(path)
+        fingerprints.append(f"{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns}")
+    digest = hashlib.sha1("\n".join(fingerprints).encode()).hexdigest()
+    return f"{COMPACTED_PREFIX}{digest[:16]}.parquet"
+
+
+def _plan_shards(file_paths):
+    """
+    Shards of a bin with their writer run ids. A shard held by a compacted
+    input with another id than in its own file was converted again since, so
+    the id of the per-shard file wins.
+
+    Returns:
+        tuple: (dict of shard -> run id, list of the stale shards of every input)
+    """
+    shards = {}
+    for path in sorted(file_paths, key=is_compacted, reverse=True):
+        shards.update(file_shards(path))
+    stale = [{shard for shard, run in file_shards(path).items() if shards[shard] != run} for path in file_paths]
+    return shards, stale
+
+
+def _iter_batches(file_paths, stale, schema):
+    """
+    Stream the rows of the inputs as tables, without the rows of stale shards.
+    """
+    for path, shards in zip(file_paths, stale):
+        unwanted = pa.array(sorted(shards), pa.string())
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=READ_BATCH_SIZE):
+            table = pa.Table.from_batches([pa.RecordBatch.from_arrays(batch.columns, schema=schema)])
+            if shards:
+                table = table.filter(pc.invert(pc.is_in(table.column(SHARD_COLUMN), unwanted)))
+            yield table
+
+
+def _spill_sorted_runs(tables, keys, run_dir, row_group_size):
+    """
+    Sort the rows SORT_RUN_ROWS at a time and write every sorted run to its
+    own file in `run_dir`.
+
+    Returns:
+        list: Paths of the run files, in order.
+    """
+    runs, pending, pending_rows = [], [], 0
+
+    def spill():
+        path = os.path.join(run_dir, f"run-{len(runs):05d}.parquet")
+        pq.write_table(pa.concat_tables(pending).sort_by(keys), path, row_group_size=row_group_size,
+                       compression=COMPRESSION)
+        runs.append(path)
+
+    for table in tables:
+        pending.append(table)
+        pending_rows += table.num_rows
+        if pending_rows >= SORT_RUN_ROWS:
+            spill()
+            pending, pending_rows = [], 0
+    if pending:
+        spill()
+    return runs
+
+
+def _merge_sorted_runs(run_paths, keys, batch_size):
+    """
+    K-way merge of sorted run files, yielding sorted tables.
+
+    Every step sorts the rows buffered from all runs and emits them up to the
+    last buffered row of the run that is furthest behind; rows not read yet
+    sort after that one in every run, so the emitted rows are final. That
+    run's buffer is emptied and refilled, and memory holds about one batch
+    per run.
+    """
+    readers = [pq.ParquetFile(path).iter_batches(batch_size=batch_size) for path in run_paths]
+    buffers = [None] * len(readers)
+    # Ties are broken by run and position, so each run's rows keep their order
+    merge_keys = keys + [('__run', 'ascending'), ('__row', 'ascending')]
+    while True:
+        for i, reader in enumerate(readers):
+            if reader is not None and (buffers[i] is None or buffers[i].num_rows == 0):
+                batch = next(reader, None)
+                if batch is None:
+                    readers[i] = None
+                else:
+                    buffers[i] = pa.Table.from_batches([batch])
+        live = [i for i, table in enumerate(buffers) if table is not None and table.num_rows]
+        if not live:
+            return
+
+        combined = pa.concat_tables([
+            buffers[i]
+            .append_column('__run', pa.array(np.full(buffers[i].num_rows, i, dtype=np.int32)))
+            .append_column('__row', pa.array(np.arange(buffers[i].num_rows, dtype=np.int64)))
+            for i in live
+        ])
+        order = pc.sort_indices(combined, sort_keys=merge_keys).to_numpy()
+        cut = len(order)
+        unread = [i for i in live if readers[i] is not None]
+        if unread:
+            rank = np.empty(len(order), dtype=np.int64)
+            rank[order] = np.arange(len(order))
+            last_rows = np.cumsum([buffers[i].num_rows for i in live]) - 1
+            cut = min(rank[last] for i, last in zip(live, last_rows) if i in unread) + 1
+
+        emitted = combined.take(pa.array(order[:cut]))
+        taken = np.bincount(emitted.column('__run').to_numpy(), minlength=len(buffers))
+        for i in live:
+            buffers[i] = buffers[i].slice(taken[i])
+        yield emitted.drop_columns(['__run', '__row'])
+
+
+def _write_row_groups(writer, tables, row_group_size):
+    """
+    Write tables through the writer in row groups of `row_group_size` rows.
+
+    Returns:
+        int: Number of rows written.
+    """
+    written, pending, pending_rows = 0, [], 0
+
+    def flush():
+        writer.write_table(pa.concat_tables(pending), row_group_size=row_group_size)
+
+    for table in tables:
+        written += table.num_rows
+        pending.append(table)
+        pending_rows += table.num_rows
+        if pending_rows >= row_group_size:
+            flush()
+            pending, pending_rows = [], 0
+    if pending:
+        flush()
+    return written
+
+
+def merge_files(file_paths, output_path, sort=False, row_group_size=ROW_GROUP_SIZE):
+    """
+    Merge Parquet files with the same schema into one file. The footer lists
+    the shards of the inputs (see parquet_dataset.SHARDS_KEY), so the rows of
+    a shard converted again later can be taken back out, and the inputs.
+
+    Rows are streamed through in batches, so without sorting memory stays
+    bounded by a row group. With sorting, SORT_RUN_ROWS rows at a time are
+    sorted and spilled to a run file next to the output, and the runs are
+    then merged a batch at a time, so memory stays bounded by one run.
+
+    Returns:
+        int: Number of rows written.
+    """
+    schema = pq.read_schema(file_paths[0])
+    shards, stale = _plan_shards(file_paths)
+    tables = _iter_batches(file_paths, stale, schema)
+    keys = [(name, order) for name, order in SORT_COLUMNS if name in schema.names] if sort else []
+
+    with pq.ParquetWriter(output_path, schema, compression=COMPRESSION, data_page_size=DATA_PAGE_SIZE,
+                          write_statistics=True) as writer:
+        if keys:
+            run_dir = tempfile.mkdtemp(prefix=f".{COMPACTED_PREFIX}runs-", dir=os.path.dirname(output_path))
+            try:
+                total_rows = sum(pq.read_metadata(path).num_rows for path in file_paths)
+                # Read the runs back in batches small enough that all of them fit in about one batch
+                batch_size = max(1024, READ_BATCH_SIZE // max(-(-total_rows // SORT_RUN_ROWS), 1))
+                runs = _spill_sorted_runs(tables, keys, run_dir, batch_size)
+                written = _write_row_groups(writer, _merge_sorted_runs(runs, keys, batch_size), row_group_size)
+            finally:
+                shutil.rmtree(run_dir)
+        else:
+            written = _write_row_groups(writer, tables, row_group_size)
+        writer.add_key_value_metadata({
+            SHARDS_KEY: json.dumps(shards, sort_keys=True).encode(),
+            COMPACTED_INPUTS_KEY: json.dumps([os.path.basename(path) for path in file_paths]).encode(),
+        })
+    return written
+
+
+def compact_partition(partition_dir, target_size=TARGET_FILE_SIZE, sort=False):
+    """
+    Compact one partition directory in place.
+
+    Each bin is merged into a temporary file inside the partition, renamed
+    over its final name, and only then are its inputs deleted, so readers
+    always find every row of the partition (for a moment, some twice). If a
+    run stops before the deletes, recover_partition finishes them next time
+    from the inputs the compacted file lists.
+
+    Returns:
+        dict: Files and bytes before and after compaction.
+    """
+    recover_partition(partition_dir)
+    files = list_files(partition_dir)
+    bytes_before = sum(os.path.getsize(path) for path in files)
+    bins = plan_bins(files, target_size, sort)
+    summary = {
+        "partition": partition_dir,
+        "files_before": len(files),
+        "bytes_before": bytes_before,
+        "files_after": len(files),
+        "bytes_after": bytes_before,
+        "bins": len(bins),
+    }
+    if not bins:
+        return summary
+
+    for paths in bins:
+        output_path = os.path.join(partition_dir, compacted_file_name(paths))
+        temp_path = os.path.join(partition_dir, f".{os.path.basename(output_path)}.tmp")
+        try:
+            merge_files(paths, temp_path, sort)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        os.replace(temp_path, output_path)
+        for path in paths:
+            if path != output_path:
+                os.remove(path)
+
+    after = list_files(partition_dir)
+    summary["files_after"] = len(after)
+    summary["bytes_after"] = sum(os.path.getsize(path) for path in after)
+    return summary
+
+
+def main(dataset_dir=DATASET_DIR, target_size_mb=TARGET_FILE_SIZE // (1024 ** 2), sort=False):
+    """
+    Compact every partition of the dataset, one partition at a time.
+    """
+    target_size = target_size_mb * 1024 ** 2
+    partitions = list_partitions(dataset_dir)
+    for partition_dir in partitions:
+        recover_partition(partition_dir)
+    # Take shards converted again since the last compaction out of compacted files first
+    removed = drop_stale_rows(dataset_dir)
+    if removed:
+        print(f"Dropped {removed} stale rows of reconverted shards from compacted files")
+    print(f"Compacting {len(partitions)} partitions in {dataset_dir} (target {target_size_mb} MB, sort={sort})")
+
+    files_before = files_after = 0
+    for partition_dir in partitions:
+        try:
+            summary = compact_partition(partition_dir, target_size, sort)
+        except Exception as e:
+            print(f"Failed to compact {partition_dir}: {e}")
+            continue
+        files_before += summary["files_before"]
+        files_after += summary["files_after"]
+        if summary["bins"]:
+            print(f"{partition_dir}: {summary['files_before']} -> {summary['files_after']} files, "
+                  f"{summary['bytes_before'] / 1024 ** 2:.1f} -> {summary['bytes_after'] / 1024 ** 2:.1f} MB")
+    print(f"Compaction complete: {files_before} -> {files_after} files")
+
+
+if __name__ == "__main__":
+    # Adjustable parameters
+    dataset_directory = DATASET_DIR  # e.g. 'Data_parquet' or 'parquet_database'
+    target_file_size_mb = 256  # Merge files up to roughly this size
+    sort_rows = False  # Sort by receivedate, safetyreportid for tighter statistics (spills sorted runs to disk)
+
+    main(dataset_dir=dataset_directory, target_size_mb=target_file_size_mb, sort=sort_rows)
@@ -1,19 +1,31 @@
 import os
-import json
 import pyarrow as pa
-import pyarrow.parquet as pq
-import dask.bag as db
-from dask.diagnostics import ProgressBar
-import random
-import string
+import pyarrow.json as pj
+from drug_event_schema import DRUG_EVENT_SCHEMA, SCHEMA_VERSION, records_to_batch, string_schema, type_batch
+from json_stream import Quarantine, iter_ndjson_records, iter_records
+from parquet_dataset import PartitionedDatasetWriter, dataset_file_name, drop_stale_rows
+from manifest import Manifest, shard_key
+from metrics import print_summary, start_run, track
+from normalized_tables import NORMALIZED_DIR, TABLE_SCHEMAS, NormalizedDatasetWriter
+from scheduler import run_scheduled
+from shard_sources import is_ndjson, list_json_sources, open_json_source, source_size
 
 # Input and output directories
 INPUT_DIR = 'DataUnzip_cleaned'
 OUTPUT_DIR = 'Data_parquet'
 ERROR_LOG = 'error_log.txt'
 
-# Ensure output directory exists
-os.makedirs(OUTPUT_DIR, exist_ok=True)
+# Name of this stage in the ingestion manifest
+STAGE = 'convert'
+
+# Number of records per Arrow record batch
+BATCH_SIZE = 2000
+
+# Read .ndjson shards (see data_cleaner.NDJSON_STAGING) with Arrow's native JSON
+# reader, in blocks of NDJSON_BLOCK_SIZE bytes parsed on several threads.
+# With False, or for a shard the reader rejects, records go through Python.
+NATIVE_JSON = True
+NDJSON_BLOCK_SIZE = 16 * 1024 * 1024
 
 def log_error(file_path, error_message):
     """
@@ -25,83 +37,189 @@ def log_error(file_path, error_message):
     except Exception as e:
         print(f"Failed to log error for {file_path}: {str(e)}")
 
-def is_valid_json_file(file_path):
+def write_batches_to_dataset(batches, output_dir, file_name, shard, schema=DRUG_EVENT_SCHEMA, normalized_dir=None):
     """
-    Check if a file is non-empty and contains valid JSON.
+    Write record batches with the canonical schema into the month-partitioned
+    dataset under `output_dir` (see parquet_dataset), every row tagged with
+    the key of its source shard (see manifest.shard_key).
+    If `normalized_dir` is set, the same batches are also written as the flat
+    reports, drugs and reactions tables (see normalized_tables).
+    If reading or writing fails, everything written so far is discarded.
+
+    Returns:
+        tuple: (number of records written, list of Parquet files written)
     """
+    writers = [PartitionedDatasetWriter(output_dir, file_name, schema, shard)]
+    if normalized_dir:
+        writers.append(NormalizedDatasetWriter(normalized_dir, file_name, shard))
+
+    record_count = 0
     try:
-        if os.path.getsize(file_path) == 0:  # Check for empty file
-            print(f"Skipping empty file: {file_path}")
-            log_error(file_path, "File is empty")
-            return False
-        with open(file_path, 'r', encoding='utf-8') as f:
-            json.load(f)  # Try to load the file as JSON
-        return True
-    except (json.JSONDecodeError, Exception) as e:
-        print(f"Invalid JSON file: {file_path}, Error: {e}")
-        log_error(file_path, f"Invalid JSON file: {e}")
-        return False
+        for batch in batches:
+            for writer in writers:
+                writer.write_batch(batch)
+            record_count += batch.num_rows
+    except Exception:
+        for writer in writers:
+            writer.abort()
+        raise
+    output_paths = writers[0].close()
+    if normalized_dir:
+        for paths in writers[1].close().values():
+            output_paths.extend(paths)
+    return record_count, output_paths
+
+def _record_batches(records, batch_size, schema):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield records_to_batch(batch, schema)
+            batch = []
+    if batch:
+        yield records_to_batch(batch, schema)
+
+def write_records_to_dataset(records, output_dir, file_name, shard, batch_size=BATCH_SIZE, schema=DRUG_EVENT_SCHEMA,
+                             normalized_dir=None):
+    """
+    Write an iterable of drug-event records into the month-partitioned dataset
+    under `output_dir` with the canonical schema, one record batch of
+    `batch_size` records at a time (see write_batches_to_dataset).
+
+    Returns:
+        tuple: (number of records written, list of Parquet files written)
+    """
+    return write_batches_to_dataset(_record_batches(records, batch_size, schema), output_dir, file_name, shard,
+                                    schema, normalized_dir)
+
+def drop_stale_compacted_rows(output_dir, normalized_dir=None):
+    """
+    Once a conversion run is over, take the earlier rows of the shards it
+    converted out of compacted files of the dataset and of the normalized
+    tables (see parquet_dataset.drop_stale_rows). Runs in the process that
+    scheduled the conversions, never in the workers.
+
+    Returns:
+        int: Number of rows removed.
+    """
+    dataset_dirs = [output_dir]
+    if normalized_dir:
+        dataset_dirs.extend(os.path.join(normalized_dir, table) for table in TABLE_SCHEMAS)
+    removed = sum(drop_stale_rows(dataset_dir) for dataset_dir in dataset_dirs)
+    if removed:
+        print(f"Dropped {removed} stale rows of reconverted shards from compacted files")
+    return removed
+
+def read_ndjson_batches(file_path, schema=DRUG_EVENT_SCHEMA, block_size=NDJSON_BLOCK_SIZE):
+    """
+    Parse a newline-delimited JSON shard with Arrow's native block reader
+    straight into the string columns of the schema and type them (see
+    drug_event_schema.type_batch), so records never become Python objects.
+    Blocks are parsed on several threads and memory stays bounded by a few blocks.
+
+    The schema is explicit, so a record it can't hold exactly (an unknown
+    field, a number where a string is expected, a broken line) raises
+    pyarrow.ArrowInvalid instead of being inferred differently.
+
+    Yields:
+        RecordBatch: One batch with `schema` per block.
+    """
+    reader = pj.open_json(
+        file_path,
+        read_options=pj.ReadOptions(use_threads=True, block_size=block_size),
+        parse_options=pj.ParseOptions(explicit_schema=string_schema(schema), unexpected_field_behavior='error'),
+    )
+    for batch in reader:
+        yield type_batch(batch, schema)
 
 def convert_json_to_parquet(file_path):
     """
-    Converts a single JSON file into a Parquet file.
-    The Parquet file is saved in Sampler_output/ with the same name as the JSON file.
+    Converts a single JSON file into Parquet files in OUTPUT_DIR, partitioned by
+    the month reports were received and named after the source shard, so a
+    rerun overwrites the previous output instead of duplicating it.
+    Zip member sources are decompressed on the fly.
+    Records of the shard's `results` array become rows with the canonical
+    drug-event schema (see drug_event_schema), so no per-file schema inference
+    is done and every output file scans with the same schema.
+    The flat reports/drugs/reactions tables are written to NORMALIZED_DIR alongside.
+    Shards staged as .ndjson are read with Arrow's native JSON reader when
+    NATIVE_JSON is set, falling back to the Python reader for shards it
+    rejects. The Python reader parses the shard once: a truncated or partly
+    corrupt shard still yields every well-formed record, and the skipped byte
+    ranges are written to the quarantine file (see json_stream.Quarantine).
+    Timings, sizes and errors go to the metrics file (see metrics).
     """
-    try:
-        # Extract the file name (without extension) to name the Parquet file
-        random_string = ''.join(random.choices(string.ascii_letters + string.digits, k=10))
-        file_name = os.path.splitext(os.path.basename(file_path))[0]
-        output_path = os.path.join(OUTPUT_DIR, f"{random_string}_{file_name}.parquet")
-        
-        print(f"Converting JSON file to Parquet: {file_path} -> {output_path}")
-        
+    with track(STAGE, file_path) as m:
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                json_data = json.load(f)  # Load the entire JSON file as Python object
-
-            # Ensure the data is a list of dictionaries for Parquet compatibility
-            if isinstance(json_data, dict):
-                json_data = [json_data]  # Wrap the dict into a list
-            elif not isinstance(json_data, list):
-                raise ValueError(f"JSON file {file_path} must be a list or a dictionary")
-
-            # Convert the list of dictionaries to a PyArrow table
-            table = pa.Table.from_pylist(json_data)
-            
-            # Write the table to a Parquet file
-            pq.write_table(table, output_path, compression='snappy')
-            
-            print(f"Successfully converted {file_path} to Parquet at {output_path}")
+            m.bytes_in = source_size(file_path)
+            if m.bytes_in == 0:
+                raise ValueError("File is empty")
+
+            # Name the Parquet files after the source shard
+            file_name = dataset_file_name(file_path, INPUT_DIR)
+            shard = shard_key(file_path, INPUT_DIR)
+
+            quarantine = Quarantine(file_path)
+            output_paths = None
+            if NATIVE_JSON and is_ndjson(file_path):
+                try:
+                    m.records, output_paths = write_batches_to_dataset(
+                        read_ndjson_batches(file_path), OUTPUT_DIR, file_name, shard, normalized_dir=NORMALIZED_DIR
+                    )
+                except pa.ArrowInvalid as e:
+                    log_error(file_path, f"Native JSON reader rejected the shard, using the Python reader: {e}")
+            if output_paths is None:
+                with open_json_source(file_path, errors='replace') as f:
+                    records = (iter_ndjson_records(f, on_error=quarantine) if is_ndjson(file_path)
+                               else iter_records(f, on_error=quarantine))
+                    m.records, output_paths = write_records_to_dataset(
+                        records, OUTPUT_DIR, file_name, shard, normalized_dir=NORMALIZED_DIR
+                    )
+            m.bytes_out = sum(os.path.getsize(path) for path in output_paths)
+            if quarantine.ranges:
+                log_error(file_path, f"Salvaged {m.records} records, {quarantine.summary()}")
+                return f"Processed {file_path} with {quarantine.summary()}."
             return f"Processed {file_path} successfully."
         except Exception as e:
-            print(f"Error converting JSON to Parquet: {str(e)}")
+            m.error = str(e)
             log_error(file_path, f"Error converting JSON to Parquet: {e}")
             return f"Error processing file {file_path}: {str(e)}"
-    except Exception as e:
-        print(f"Error processing file: {str(e)}")
-        log_error(file_path, f"Error processing file: {e}")
-        return f"Error processing file: {str(e)}"
 
-def main():
+def main(memory_budget_gb=None, max_workers=None):
     """
-    Main function to process all JSON files independently.
+    Main function to process all JSON files independently, scheduled largest
+    first within a memory budget (see scheduler).
     """
-    # Get all JSON files (recursively) in the INPUT_DIR
-    all_json_files = [
-        os.path.join(dirpath, filename)
-        for dirpath, subdirs, filenames in os.walk(INPUT_DIR)
-        for filename in filenames 
-        if filename.endswith('.json') and os.path.isfile(os.path.join(dirpath, filename))
-    ]
-
-    print(f"Found {len(all_json_files)} JSON files to process: {all_json_files}")
+    # Get all JSON files (recursively) in the INPUT_DIR, including members of zip archives
+    all_json_files = list_json_sources(INPUT_DIR)
+
+    print(f"Found {len(all_json_files)} JSON files to process.")
+
+    # Skip files already converted with the current schema that have not changed since
+    with Manifest() as manifest:
+        pending = manifest.pending_sources(STAGE, all_json_files, INPUT_DIR, SCHEMA_VERSION)
+    print(f"{len(all_json_files) - len(pending)} files are up to date, {len(pending)} to process.")
+    if not pending:
+        return
     
-    # Use Dask Bag to parallelize the processing of individual JSON files
-    bag = db.from_sequence(all_json_files, npartitions=16)  # Divide files into 16 partitions
-    results = bag.map(convert_json_to_parquet).compute()
+    # Convert the files in worker processes, as many at once as the memory budget allows
+    run_id = start_run(STAGE)
+    results = run_scheduled(convert_json_to_parquet, list(pending), memory_budget_gb, max_workers)
+
+    # Record which files completed in the manifest
+    with Manifest() as manifest:
+        manifest.record_results(STAGE, pending, {
+            source: result.startswith("Processed") or result
+            for source, result in results.items()
+        })
+    drop_stale_compacted_rows(OUTPUT_DIR, NORMALIZED_DIR)
     
-    # Print summary of processing
-    print(f"Results: {results}")
+    # Print totals and the slowest files instead of every result
+    print_summary(run_id)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # Adjustable parameters
+    memory_budget = None  # GB for all workers together; None uses 60% of the available memory
+    workers = None  # None uses every core the budget can hold
+
+    main(memory_budget, workers)
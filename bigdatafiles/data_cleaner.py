@@ -1,7 +1,10 @@
 import os
 import json
-import dask.bag as db
-from dask.diagnostics import ProgressBar
+from json_stream import Quarantine, dumps_compact, iter_events, write_events, write_ndjson
+from manifest import Manifest
+from metrics import print_summary, start_run, track
+from scheduler import run_scheduled
+from shard_sources import NDJSON_SUFFIX, list_json_sources, open_json_source, relative_source_path, source_size
 
 # List of fields to remove
 FIELDS_TO_REMOVE = [
@@ -18,8 +21,17 @@ FIELDS_TO_REMOVE = [
 INPUT_DIR = 'DataUnzip'
 OUTPUT_DIR = 'DataUnzip_cleaned'
 
-# Ensure output directory exists
-os.makedirs(OUTPUT_DIR, exist_ok=True)
+# Name of this stage in the ingestion manifest
+STAGE = 'clean'
+
+# Stream records one at a time instead of loading whole shards with json.load.
+# With False, shards too large to load within the memory budget still stream.
+STREAMING = True
+
+# Stage the cleaned records as newline-delimited JSON (<shard>.ndjson, one
+# record per line, without the `meta` member) instead of the shard's JSON
+# document, so convert_to_parquet can parse them with Arrow's native reader
+NDJSON_STAGING = False
 
 def remove_fields_from_dict(data, fields_to_remove):
     """
@@ -35,67 +47,152 @@ def remove_fields_from_dict(data, fields_to_remove):
     else:
         return data
 
-def process_large_file(file_path):
+def iter_cleaned_events(fp, fields_to_remove=FIELDS_TO_REMOVE, on_error=None):
+    """
+    Stream the events of a shard (see json_stream.iter_events) with the
+    specified fields removed from every record and top-level member.
+    Corrupt shards are salvaged when `on_error` is given.
+    """
+    for event, key, value in iter_events(fp, on_error=on_error):
+        if event in ("member", "record"):
+            value = remove_fields_from_dict(value, fields_to_remove)
+        yield event, key, value
+
+def clean_file_streaming(file_path, output_path, on_error=None, ndjson=False):
     """
-    Process a large JSON file chunk-by-chunk to avoid memory overflow.
-    Writes cleaned data to the corresponding file in the output directory.
+    Stream the shard's `results` array record by record, writing cleaned records
+    as compact JSON as they are read. Memory is bounded by the size of a record.
+    With `on_error` (e.g. a json_stream.Quarantine), the well-formed records of
+    a truncated or corrupt shard are kept and written out as valid JSON.
+    With `ndjson`, the records are written one per line (see json_stream.write_ndjson).
+    The output is written to '<output_path>.tmp' and renamed into place only
+    once complete, so a failed run never leaves a partial file behind.
+    Returns the number of records written.
     """
+    write = write_ndjson if ndjson else write_events
+    temp_path = output_path + '.tmp'
     try:
-        # Get the relative path and output path
-        relative_path = os.path.relpath(file_path, INPUT_DIR)
-        output_path = os.path.join(OUTPUT_DIR, relative_path)
-        print(f"Input: {file_path} -> Relative: {relative_path} -> Output: {output_path}")
-        
-        # Ensure the output directory structure exists
-        os.makedirs(os.path.dirname(output_path), exist_ok=True)
-        
-        # Open the input file for reading
-        try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-        except json.JSONDecodeError as e:
-            print(f"JSONDecodeError: Failed to load {file_path} due to {e}")
-            return f"Error processing {file_path}: {str(e)}"
-        except Exception as e:
-            print(f"Unexpected Error: Failed to load {file_path} due to {e}")
-            return f"Error processing {file_path}: {str(e)}"
-        
-        # Remove specified fields
-        cleaned_data = remove_fields_from_dict(data, FIELDS_TO_REMOVE)
-        
-        # Write the cleaned JSON to the output file
+        with open_json_source(file_path, errors='replace' if on_error else 'strict') as src, \
+                open(temp_path, 'w', encoding='utf-8') as out:
+            count = write(iter_cleaned_events(src, on_error=on_error), out)
+        os.replace(temp_path, output_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return count
+
+def process_large_file(file_path, streaming=STREAMING, ndjson=NDJSON_STAGING):
+    """
+    Process a large JSON file record-by-record to avoid memory overflow.
+    Writes cleaned data to the corresponding file in the output directory,
+    as newline-delimited JSON with ndjson=True.
+    With streaming=False the whole file is loaded with json.load instead.
+    Shards that are truncated or partly corrupt are salvaged record by record,
+    with the skipped byte ranges quarantined (see json_stream.Quarantine).
+    `file_path` may also be a zip member source (see shard_sources).
+    Timings, sizes and errors go to the metrics file (see metrics).
+    """
+    with track(STAGE, file_path) as m:
         try:
-            with open(output_path, 'w', encoding='utf-8') as f:
-                json.dump(cleaned_data, f, indent=2)
-            print(f"Successfully wrote cleaned file to {output_path}")
+            m.bytes_in = source_size(file_path)
+
+            # Get the relative path and output path
+            relative_path = relative_source_path(file_path, INPUT_DIR)
+            output_path = os.path.join(OUTPUT_DIR, relative_path)
+            if ndjson:
+                output_path = os.path.splitext(output_path)[0] + NDJSON_SUFFIX
+
+            # Ensure the output directory structure exists
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+            quarantine = Quarantine(file_path)
+            data = None
+            if not streaming:
+                # Open the input file for reading; a shard that doesn't parse is salvaged below
+                try:
+                    with open_json_source(file_path) as f:
+                        data = json.load(f)
+                except ValueError:
+                    pass
+            if data is None:
+                m.records = clean_file_streaming(file_path, output_path, quarantine, ndjson)
+            else:
+                # Remove specified fields
+                cleaned_data = remove_fields_from_dict(data, FIELDS_TO_REMOVE)
+                # Only an object has a `results` array; any other JSON document has no records
+                results = cleaned_data.get("results", []) if isinstance(cleaned_data, dict) else []
+                m.records = len(results) if isinstance(cleaned_data, dict) else None
+
+                # Write the cleaned JSON to a temporary file and move it into place once complete
+                temp_path = output_path + '.tmp'
+                try:
+                    with open(temp_path, 'w', encoding='utf-8') as f:
+                        if ndjson:
+                            for record in results:
+                                f.write(dumps_compact(record) + "\n")
+                        else:
+                            json.dump(cleaned_data, f, separators=(',', ':'))
+                    os.replace(temp_path, output_path)
+                except BaseException:
+                    if os.path.exists(temp_path):
+                        os.remove(temp_path)
+                    raise
+            m.bytes_out = os.path.getsize(output_path)
+
+            # Drop the shard's copy in the other staging format so it isn't converted twice
+            stem, suffix = os.path.splitext(output_path)
+            other_path = stem + ('.json' if suffix == NDJSON_SUFFIX else NDJSON_SUFFIX)
+            if os.path.exists(other_path):
+                os.remove(other_path)
+            if quarantine.ranges:
+                return f"Processed {file_path} with {quarantine.summary()}."
             return f"Processed {file_path} successfully."
         except Exception as e:
-            print(f"Failed to write file {output_path} due to {e}")
-            return f"Error writing {output_path}: {str(e)}"
-    except Exception as e:
-        print(f"Error processing {file_path}: {str(e)}")
-        return f"Error processing {file_path}: {str(e)}"
+            m.error = str(e)
+            return f"Error processing {file_path}: {str(e)}"
 
-def main():
+def main(memory_budget_gb=None, max_workers=None, ndjson=NDJSON_STAGING):
     """
-    Main function to process large JSON files in parallel using dask.bag.
+    Main function to process large JSON files in parallel, scheduled largest
+    first within a memory budget (see scheduler). With `ndjson`, the cleaned
+    shards are staged as newline-delimited JSON.
     """
-    # Get all JSON files from the input directory
-    all_json_files = [
-        os.path.join(dirpath, filename)
-        for dirpath, _, filenames in os.walk(INPUT_DIR)
-        for filename in filenames if filename.endswith('.json')
-    ]
+    # Ensure output directory exists
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+
+    # Get all JSON files from the input directory, including members of zip archives
+    all_json_files = list_json_sources(INPUT_DIR)
 
     # Check how many files are found
-    print(f"Found {len(all_json_files)} JSON files to process: {all_json_files}")
+    print(f"Found {len(all_json_files)} JSON files to process.")
+
+    # Skip files that were already processed and have not changed since
+    with Manifest() as manifest:
+        pending = manifest.pending_sources(STAGE, all_json_files, INPUT_DIR, 'ndjson' if ndjson else None)
+    print(f"{len(all_json_files) - len(pending)} files are up to date, {len(pending)} to process.")
+    if not pending:
+        return
     
-    # Use dask bag to parallelize the file processing
-    bag = db.from_sequence(all_json_files, npartitions=30)  # Divide files into 16 partitions
-    results = bag.map(process_large_file).compute()
+    # Process the files in worker processes, as many at once as the memory budget allows
+    run_id = start_run(STAGE)
+    results = run_scheduled(process_large_file, list(pending), memory_budget_gb, max_workers,
+                            in_memory=not STREAMING, ndjson=ndjson)
+
+    # Record which files completed in the manifest
+    with Manifest() as manifest:
+        manifest.record_results(STAGE, pending, {
+            source: result.startswith("Processed") or result
+            for source, result in results.items()
+        })
     
-    # Print summary of processing
-    print(f"Results: {results}")
+    # Print totals and the slowest files instead of every result
+    print_summary(run_id)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # Adjustable parameters
+    memory_budget = None  # GB for all workers together; None uses 60% of the available memory
+    workers = None  # None uses every core the budget can hold
+    stage_ndjson = NDJSON_STAGING  # Write .ndjson shards for convert_to_parquet's native Arrow reader
+
+    main(memory_budget, workers, stage_ndjson)
@@ -0,0 +1,310 @@
+import os
+import json
+import time
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from manifest import Manifest
+from normalized_tables import NORMALIZED_DIR, REPORTS, list_shard_files, shard_fingerprint
+from parquet_dataset import SHARD_COLUMN
+
+# Deduplication state and results:
+#   Data_dedupe/buckets/bucket-NNN.parquet  every (report id, version) of every
+#       shard whose id hashes to bucket NNN, with the ones superseded marked
+#   Data_dedupe/dropped/<shard>.parquet     (shard, safetyreportid, safetyreportversion)
+#       rows of the shard that a later version elsewhere supersedes
+#   Data_dedupe/summary.jsonl               one line per run
+# Readers drop a shard's superseded rows with an anti-join, e.g. in DuckDB:
+#   SELECT * FROM 'Data_normalized/reports/*/*.parquet' r
+#   ANTI JOIN 'Data_dedupe/dropped/*.parquet' d USING (shard, safetyreportid, safetyreportversion)
+DEDUPE_DIR = 'Data_dedupe'
+
+# Name of this stage in the ingestion manifest
+STAGE = 'dedupe'
+
+# Report ids are hash-partitioned into this many buckets; only one bucket's
+# keys are in memory at a time
+NUM_BUCKETS = 64
+
+# Changed shards whose keys are read per pass over the buckets
+SHARDS_PER_PASS = 64
+
+# Name under which a shard's dropped rows are listed next to its tables
+DROPPED = 'dropped'
+
+# Metadata key of a bucket mapping every shard with keys in it to that shard's fingerprint
+APPLIED_KEY = b'applied_shards'
+
+KEY_SCHEMA = pa.schema([
+    pa.field('safetyreportid', pa.string()),
+    pa.field('safetyreportversion', pa.string()),
+    pa.field('version', pa.int64()),
+    pa.field('transmissiondate', pa.string()),
+    pa.field('duplicate', pa.string()),
+    pa.field('shard', pa.string()),
+    pa.field('dropped', pa.bool_()),
+])
+
+_REPORT_COLUMNS = ['safetyreportid', 'safetyreportversion', 'transmissiondate', 'duplicate']
+
+
+def bucket_path(dedupe_dir, bucket):
+    return os.path.join(dedupe_dir, 'buckets', f"bucket-{bucket:03d}.parquet")
+
+
+def dropped_path(dedupe_dir, shard):
+    return os.path.join(dedupe_dir, DROPPED, f"{shard}.parquet")
+
+
+def attach_dropped(shard_files, dedupe_dir=DEDUPE_DIR):
+    """
+    Add each shard's dropped-rows file, where there is one, to the output of
+    normalized_tables.list_shard_files, so its fingerprint changes when the
+    shard gains or loses superseded rows.
+    """
+    for shard, files in shard_files.items():
+        path = dropped_path(dedupe_dir, shard)
+        if os.path.exists(path):
+            files[DROPPED] = [path]
+    return shard_files
+
+
+def bucket_of(ids, num_buckets=NUM_BUCKETS):
+    """
+    Stable bucket number of every report id.
+    """
+    hashes = pd.util.hash_array(np.asarray(ids.to_numpy(zero_copy_only=False), dtype=object))
+    return pa.array(hashes % num_buckets, pa.int32())
+
+
+def read_shard_keys(shard, paths):
+    """
+    One key row per distinct (safetyreportid, safetyreportversion) of a
+    shard's reports, with the latest transmission date of that version.
+    Compacted files hold several shards, so rows are selected by shard column.
+    """
+    tables = []
+    for path in paths:
+        table = pq.read_table(path, columns=_REPORT_COLUMNS, filters=[(SHARD_COLUMN, '=', shard)])
+        tables.append(table.cast(pa.schema([pa.field(name, pa.string()) for name in _REPORT_COLUMNS])))
+    table = pa.concat_tables(tables).filter(pc.is_valid(pc.field('safetyreportid')))
+    table = table.group_by(['safetyreportid', 'safetyreportversion'], use_threads=False).aggregate(
+        [('transmissiondate', 'max'), ('duplicate', 'max')]
+    )
+    versions = table.column('safetyreportversion')
+    numeric = pc.fill_null(pc.match_substring_regex(versions, r'^\s*\d{1,18}\s*$'), False)
+    return pa.table([
+        table.column('safetyreportid'),
+        versions,
+        pc.cast(pc.utf8_trim_whitespace(pc.if_else(numeric, versions, None)), pa.int64()),
+        table.column('transmissiondate_max'),
+        table.column('duplicate_max'),
+        pa.array([shard] * table.num_rows, pa.string()),
+        pa.array([False] * table.num_rows, pa.bool_()),
+    ], schema=KEY_SCHEMA)
+
+
+def mark_dropped(keys):
+    """
+    Keep the latest version of every report id and mark the other rows dropped.
+    The latest is the highest numeric safetyreportversion, then the latest
+    transmission date; identical copies in several shards keep the one in
+    the shard whose key sorts last.
+    """
+    keys = keys.sort_by([('safetyreportid', 'ascending'), ('version', 'descending'),
+                         ('transmissiondate', 'descending'), ('shard', 'descending')])
+    ids = keys.column('safetyreportid').combine_chunks()
+    if len(ids) == 0:
+        return keys
+    previous = pa.concat_arrays([pa.nulls(1, pa.string()), ids.slice(0, len(ids) - 1)])
+    latest = pc.fill_null(pc.not_equal(ids, previous), True)
+    return keys.set_column(keys.schema.get_field_index('dropped'), 'dropped', pc.invert(latest))
+
+
+def read_applied(dedupe_dir, bucket):
+    path = bucket_path(dedupe_dir, bucket)
+    if not os.path.exists(path):
+        return {}
+    return json.loads(pq.read_schema(path).metadata[APPLIED_KEY])
+
+
+def _write_atomic(table, path, metadata=None):
+    if metadata:
+        table = table.replace_schema_metadata(metadata)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = path + '.tmp'
+    pq.write_table(table, temp_path, compression='snappy')
+    os.replace(temp_path, path)
+
+
+def _dropped_rows(table):
+    return table.filter(pc.field('dropped')).select(['shard', 'safetyreportid', 'safetyreportversion'])
+
+
+def update_bucket(dedupe_dir, bucket, applied, new_keys, new_fingerprints, stale):
+    """
+    Replace the keys of changed and removed shards in one bucket and work out
+    again which rows are superseded.
+
+    Parameters:
+        applied (dict): Shard -> fingerprint currently included in the bucket.
+        new_keys (list): Key tables of this bucket from the shards being added.
+        new_fingerprints (dict): Shard -> fingerprint of the shards being added.
+        stale (set): Shards whose current keys must be removed first.
+
+    Returns:
+        tuple: (shards whose dropped rows changed, new applied dict)
+    """
+    path = bucket_path(dedupe_dir, bucket)
+    old = pq.read_table(path).cast(KEY_SCHEMA) if os.path.exists(path) else KEY_SCHEMA.empty_table()
+    kept = old
+    if stale:
+        kept = old.filter(pc.invert(pc.is_in(old.column('shard'), pa.array(sorted(stale), pa.string()))))
+    table = mark_dropped(pa.concat_tables([kept.cast(KEY_SCHEMA)] + new_keys))
+
+    new_applied = {shard: fingerprint for shard, fingerprint in applied.items() if shard not in stale}
+    new_applied.update(new_fingerprints)
+    _write_atomic(table, path, {APPLIED_KEY: json.dumps(new_applied, sort_keys=True).encode()})
+
+    # Rows dropped before or after but not both belong to shards whose list changed
+    changes = pa.concat_tables([_dropped_rows(old), _dropped_rows(table)])
+    changes = changes.group_by(changes.column_names).aggregate([([], 'count_all')])
+    changed = changes.filter(pc.equal(changes.column('count_all'), 1)).column('shard')
+    return set(pc.unique(changed).to_pylist()), new_applied
+
+
+def write_dropped(dedupe_dir, shards, num_buckets=NUM_BUCKETS):
+    """
+    Rewrite the dropped-rows file of every shard in `shards` from the buckets,
+    deleting it when nothing of the shard is superseded.
+    """
+    if not shards:
+        return
+    wanted = pa.array(sorted(shards), pa.string())
+    parts = []
+    for bucket in range(num_buckets):
+        path = bucket_path(dedupe_dir, bucket)
+        if os.path.exists(path):
+            table = pq.read_table(path, columns=['shard', 'safetyreportid', 'safetyreportversion', 'dropped'])
+            parts.append(_dropped_rows(table.filter(pc.is_in(table.column('shard'), wanted))))
+    rows = pa.concat_tables(parts) if parts else KEY_SCHEMA.empty_table().select(['shard'])
+    for shard in shards:
+        path = dropped_path(dedupe_dir, shard)
+        shard_rows = rows.filter(pc.equal(rows.column('shard'), shard))
+        if shard_rows.num_rows:
+            _write_atomic(shard_rows.sort_by('safetyreportid'), path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+
+def bucket_counts(dedupe_dir, num_buckets=NUM_BUCKETS):
+    """
+    Key rows, superseded rows and kept reports flagged as duplicates over all
+    buckets; only the small columns are read.
+    """
+    totals = {"versions": 0, "dropped": 0, "kept": 0, "flagged_duplicates": 0}
+    for bucket in range(num_buckets):
+        path = bucket_path(dedupe_dir, bucket)
+        if not os.path.exists(path):
+            continue
+        table = pq.read_table(path, columns=['dropped', 'duplicate'])
+        dropped = pc.sum(table.column('dropped').cast(pa.int64())).as_py() or 0
+        flagged = pc.and_(pc.invert(table.column('dropped')), pc.equal(table.column('duplicate'), '1'))
+        totals["versions"] += table.num_rows
+        totals["dropped"] += dropped
+        totals["kept"] += table.num_rows - dropped
+        totals["flagged_duplicates"] += pc.sum(pc.fill_null(flagged, False).cast(pa.int64())).as_py() or 0
+    return totals
+
+
+def main(normalized_dir=NORMALIZED_DIR, dedupe_dir=DEDUPE_DIR, num_buckets=NUM_BUCKETS,
+         shards_per_pass=SHARDS_PER_PASS):
+    """
+    Keep only the latest version of every report across all converted shards.
+
+    Report keys are hash-partitioned on safetyreportid into `num_buckets`
+    bucket files, so each bucket is deduplicated on its own and memory is
+    bounded by one bucket plus the keys of `shards_per_pass` shards. Only
+    new, changed and removed shards are read, and only the buckets their old
+    or new ids fall into are rewritten. Each shard's superseded rows are
+    written to dropped/<shard>.parquet, which rollups.py applies.
+
+    Returns:
+        dict: The run summary, also appended to <dedupe_dir>/summary.jsonl.
+    """
+    start = time.perf_counter()
+    shard_files = {shard: files[REPORTS] for shard, files in list_shard_files(normalized_dir).items()
+                   if files.get(REPORTS)}
+    fingerprints = {shard: shard_fingerprint({REPORTS: paths}) for shard, paths in shard_files.items()}
+    applied = {bucket: read_applied(dedupe_dir, bucket) for bucket in range(num_buckets)}
+    # Buckets holding keys of each shard
+    placed = {}
+    for bucket, shards in applied.items():
+        for shard in shards:
+            placed.setdefault(shard, set()).add(bucket)
+
+    # A shard without any report id is never placed, so it is read again every run
+    changed = sorted(shard for shard, fingerprint in fingerprints.items()
+                     if not placed.get(shard) or any(applied[bucket][shard] != fingerprint for bucket in placed[shard]))
+    removed = sorted(set(placed) - set(shard_files))
+    print(f"{len(shard_files)} shards, {len(changed)} new or changed, {len(removed)} removed.")
+
+    affected = set(removed)
+    rewritten = set()
+    before = bucket_counts(dedupe_dir, num_buckets) if changed or removed else None
+    for offset in range(0, max(len(changed), 1 if removed else 0), shards_per_pass):
+        batch = changed[offset:offset + shards_per_pass]
+        replaced = set(batch) | (set(removed) if offset == 0 else set())
+        keys = [read_shard_keys(shard, shard_files[shard]) for shard in batch]
+        keys = pa.concat_tables(keys) if keys else KEY_SCHEMA.empty_table()
+        buckets = bucket_of(keys.column('safetyreportid'), num_buckets)
+        # Only the buckets the new keys hash to and those holding the old ones change
+        targets = set(pc.unique(buckets).to_pylist())
+        targets |= {bucket for shard in replaced for bucket in placed.get(shard, ())}
+        for bucket in sorted(targets):
+            bucket_keys = keys.filter(pc.equal(buckets, bucket))
+            pending = {shard: fingerprints[shard] for shard in pc.unique(bucket_keys.column('shard')).to_pylist()}
+            stale = {shard for shard in applied[bucket] if shard in replaced}
+            shards, applied[bucket] = update_bucket(dedupe_dir, bucket, applied[bucket], [bucket_keys], pending, stale)
+            affected |= shards
+        rewritten |= targets
+        print(f"Indexed {min(offset + shards_per_pass, len(changed))} of {len(changed)} shards")
+
+    write_dropped(dedupe_dir, affected, num_buckets)
+    after = bucket_counts(dedupe_dir, num_buckets)
+    with Manifest() as manifest:
+        for shard in changed:
+            manifest.mark_done(shard, STAGE, fingerprints[shard])
+
+    summary = {
+        "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "shards": len(shard_files),
+        "shards_indexed": len(changed),
+        "shards_removed": len(removed),
+        "buckets_rewritten": len(rewritten),
+        "shards_with_changed_drops": len(affected),
+        "report_versions": after["versions"],
+        "reports_kept": after["kept"],
+        "duplicates_dropped": after["dropped"],
+        "newly_dropped": after["dropped"] - (before or after)["dropped"],
+        "kept_flagged_duplicate": after["flagged_duplicates"],
+        "seconds": time.perf_counter() - start,
+    }
+    os.makedirs(dedupe_dir, exist_ok=True)
+    with open(os.path.join(dedupe_dir, 'summary.jsonl'), 'a', encoding='utf-8') as f:
+        f.write(json.dumps(summary) + "\n")
+    print(f"{summary['report_versions']} report versions, {summary['reports_kept']} reports kept, "
+          f"{summary['duplicates_dropped']} superseded versions dropped ({summary['newly_dropped']:+d} this run); "
+          f"{summary['kept_flagged_duplicate']} kept reports are flagged as cross-reported (duplicate=1).")
+    return summary
+
+
+if __name__ == "__main__":
+    # Adjustable parameters
+    normalized_directory = NORMALIZED_DIR
+    dedupe_directory = DEDUPE_DIR
+    buckets = NUM_BUCKETS  # Changing this on existing state needs an empty dedupe_directory
+
+    main(normalized_directory, dedupe_directory, buckets)
@@ -0,0 +1,429 @@
+import json
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# Bump whenever DRUG_EVENT_SCHEMA changes; written to every Parquet file's metadata.
+# Version 2 types dates, enums and numbers instead of keeping every value a string.
+# Version 3 files also carry the shard column (see parquet_dataset.SHARD_COLUMN).
+SCHEMA_VERSION = 3
+SCHEMA_VERSION_KEY = b'drug_event_schema_version'
+
+# Column holding fields the schema does not know about, as a JSON object keyed by path
+UNKNOWN_FIELDS_COLUMN = 'unknown_fields'
+
+
+def _strings(*names):
+    return [pa.field(name, pa.string()) for name in names]
+
+
+def _typed(arrow_type, *names):
+    return [pa.field(name, arrow_type) for name in names]
+
+
+# Unit codes of patientonsetage -> years per unit
+# (800 decade, 801 year, 802 month, 803 week, 804 day, 805 hour)
+AGE_UNIT_YEARS = {
+    '800': 10.0,
+    '801': 1.0,
+    '802': 1 / 12,
+    '803': 7 / 365.25,
+    '804': 1 / 365.25,
+    '805': 1 / (365.25 * 24),
+}
+
+
+# Field inventory taken from nested_structure.txt and json_analysis_report.json,
+# completed with the optional openFDA drug-event fields that only appear in some
+# shards. Every openFDA value is delivered as a string; dates (YYYYMMDD, or
+# YYYYMM / YYYY for partial dates) become date32, coded flags small ints and
+# dose, age and weight figures floats (see type_batch). Values that don't
+# parse become null. The fields removed by data_cleaner.FIELDS_TO_REMOVE are
+# deliberately absent from `openfda`.
+OPENFDA_TYPE = pa.struct([
+    pa.field(name, pa.list_(pa.string())) for name in (
+        'brand_name',
+        'generic_name',
+        'manufacturer_name',
+        'product_type',
+        'route',
+        'substance_name',
+        'unii',
+        'pharm_class_epc',
+        'pharm_class_cs',
+        'pharm_class_pe',
+        'pharm_class_moa',
+    )
+])
+
+DRUG_TYPE = pa.struct(
+    _strings(
+        'drugcharacterization',
+        'medicinalproduct',
+        'drugauthorizationnumb',
+        'drugbatchnumb',
+    ) + _typed(pa.float64(), 'drugstructuredosagenumb') + _strings(
+        'drugstructuredosageunit',
+    ) + _typed(pa.float64(), 'drugseparatedosagenumb', 'drugintervaldosageunitnumb') + _strings(
+        'drugintervaldosagedefinition',
+    ) + _typed(pa.float64(), 'drugcumulativedosagenumb') + _strings(
+        'drugcumulativedosageunit',
+        'drugdosagetext',
+        'drugdosageform',
+        'drugadministrationroute',
+        'drugindication',
+        'drugstartdateformat',
+    ) + _typed(pa.date32(), 'drugstartdate') + _strings(
+        'drugenddateformat',
+    ) + _typed(pa.date32(), 'drugenddate') + _typed(pa.float64(), 'drugtreatmentduration') + _strings(
+        'drugtreatmentdurationunit',
+        'actiondrug',
+        'drugrecurreadministration',
+        'drugadditional',
+    ) + [
+        pa.field('activesubstance', pa.struct(_strings('activesubstancename'))),
+        pa.field('openfda', OPENFDA_TYPE),
+    ]
+)
+
+REACTION_TYPE = pa.struct(_strings(
+    'reactionmeddraversionpt',
+    'reactionmeddrapt',
+) + _typed(pa.int8(), 'reactionoutcome'))
+
+PATIENT_TYPE = pa.struct(
+    _typed(pa.float64(), 'patientonsetage') + _strings(
+        'patientonsetageunit',
+    ) + [
+        # Derived: patientonsetage converted to years with AGE_UNIT_YEARS
+        pa.field('patientonsetage_years', pa.float64()),
+    ] + _strings(
+        'patientagegroup',
+    ) + _typed(pa.int8(), 'patientsex') + _typed(pa.float64(), 'patientweight') + [
+        pa.field('patientdeath', pa.struct(
+            _typed(pa.date32(), 'patientdeathdate') + _strings('patientdeathdateformat')
+        )),
+        pa.field('summary', pa.struct(_strings('narrativeincludeclinical'))),
+        pa.field('reaction', pa.list_(REACTION_TYPE)),
+        pa.field('drug', pa.list_(DRUG_TYPE)),
+    ]
+)
+
+DRUG_EVENT_SCHEMA = pa.schema(
+    _strings(
+        'safetyreportversion',
+        'safetyreportid',
+        'primarysourcecountry',
+        'occurcountry',
+        'transmissiondateformat',
+    ) + _typed(pa.date32(), 'transmissiondate') + _strings(
+        'reporttype',
+    ) + _typed(pa.int8(), 'serious') + _strings(
+        'seriousnessdeath',
+        'seriousnesslifethreatening',
+        'seriousnesshospitalization',
+        'seriousnessdisabling',
+        'seriousnesscongenitalanomali',
+        'seriousnessother',
+        'receivedateformat',
+    ) + _typed(pa.date32(), 'receivedate') + _strings(
+        'receiptdateformat',
+    ) + _typed(pa.date32(), 'receiptdate') + _strings(
+        'fulfillexpeditecriteria',
+        'companynumb',
+        'duplicate',
+        'authoritynumb',
+    ) + [
+        pa.field('reportduplicate', pa.struct(_strings('duplicatesource', 'duplicatenumb'))),
+        pa.field('primarysource', pa.struct(_strings('reportercountry', 'qualification', 'literaturereference'))),
+        pa.field('sender', pa.struct(_strings('sendertype', 'senderorganization'))),
+        pa.field('receiver', pa.struct(_strings('receivertype', 'receiverorganization'))),
+        pa.field('patient', PATIENT_TYPE),
+        pa.field(UNKNOWN_FIELDS_COLUMN, pa.string()),
+    ],
+    metadata={SCHEMA_VERSION_KEY: str(SCHEMA_VERSION).encode()},
+)
+
+# Fields computed from their siblings rather than read from the JSON:
+# name -> function of the struct's typed child arrays
+DERIVED_FIELDS = {
+    'patientonsetage_years': lambda children: pc.multiply(
+        children['patientonsetage'],
+        pc.take(pa.array(list(AGE_UNIT_YEARS.values()), pa.float64()),
+                pc.index_in(pc.utf8_trim_whitespace(children['patientonsetageunit']),
+                            value_set=pa.array(list(AGE_UNIT_YEARS), pa.string()))),
+    ),
+}
+
+
+def record_type(schema=DRUG_EVENT_SCHEMA):
+    """
+    The schema as a struct type, without the side-channel column.
+    """
+    return pa.struct([field for field in schema if field.name != UNKNOWN_FIELDS_COLUMN])
+
+
+_RECORD_TYPE = record_type()
+
+
+def _conform(value, arrow_type, path, unknown):
+    """
+    Return `value` reduced to what `arrow_type` can hold, recording anything
+    else in `unknown` under its dotted path.
+    """
+    if value is None:
+        return None
+    if pa.types.is_struct(arrow_type):
+        if not isinstance(value, dict):
+            unknown[path] = value
+            return None
+        known = {}
+        for key, child in value.items():
+            index = arrow_type.get_field_index(key)
+            child_path = f"{path}.{key}" if path else key
+            if index < 0:
+                unknown[child_path] = child
+            else:
+                known[key] = _conform(child, arrow_type.field(index).type, child_path, unknown)
+        return known
+    if pa.types.is_list(arrow_type):
+        if not isinstance(value, list):
+            unknown[path] = value
+            return None
+        item_type = arrow_type.value_type
+        return [_conform(item, item_type, f"{path}.{i}", unknown) for i, item in enumerate(value)]
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    unknown[path] = value
+    return None
+
+
+def conform_record(record, schema=DRUG_EVENT_SCHEMA):
+    """
+    Shape a drug-event record to the canonical schema.
+
+    Fields the schema does not define (or values of an unexpected shape) are
+    removed from the record and collected into the UNKNOWN_FIELDS_COLUMN as a
+    JSON object keyed by dotted path, e.g. {"patient.drug.2.newfield": "..."}.
+
+    Returns:
+        dict: The record with only schema fields plus the side-channel column.
+    """
+    unknown = {}
+    struct_type = _RECORD_TYPE if schema is DRUG_EVENT_SCHEMA else record_type(schema)
+    known = _conform(record, struct_type, '', unknown) or {}
+    known[UNKNOWN_FIELDS_COLUMN] = json.dumps(unknown, separators=(',', ':')) if unknown else None
+    return known
+
+
+def string_type(arrow_type):
+    """
+    `arrow_type` with every leaf replaced by string: the shape the JSON
+    values have before type_batch parses them.
+    """
+    if pa.types.is_struct(arrow_type):
+        return pa.struct([pa.field(field.name, string_type(field.type)) for field in arrow_type])
+    if pa.types.is_list(arrow_type):
+        return pa.list_(string_type(arrow_type.value_type))
+    return pa.string()
+
+
+def string_schema(schema=DRUG_EVENT_SCHEMA):
+    return pa.schema([pa.field(field.name, string_type(field.type)) for field in schema], metadata=schema.metadata)
+
+
+_NUMBER = r'^\s*[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?\s*$'
+_CODE = r'^\s*-?\d{1,3}\s*$'
+
+
+def _matching(strings, pattern):
+    """
+    The strings matching `pattern`, trimmed; null elsewhere.
+    """
+    matches = pc.fill_null(pc.match_substring_regex(strings, pattern), False)
+    return pc.utf8_trim_whitespace(pc.if_else(matches, strings, pa.scalar(None, pa.string())))
+
+
+def parse_dates(strings):
+    """
+    YYYYMMDD strings as date32. Partial dates (YYYYMM, YYYY) fall on the
+    first day of the month or year; anything else becomes null.
+    """
+    strings = pc.utf8_trim_whitespace(strings)
+    lengths = pc.utf8_length(strings)
+    padded = pc.case_when(
+        pc.make_struct(pc.equal(lengths, 6), pc.equal(lengths, 4)),
+        pc.binary_join_element_wise(strings, '01', ''),
+        pc.binary_join_element_wise(strings, '0101', ''),
+        strings,
+    )
+    return pc.strptime(padded, format='%Y%m%d', unit='s', error_is_null=True).cast(pa.date32())
+
+
+def parse_numbers(strings, arrow_type=pa.float64()):
+    """
+    Decimal strings as numbers of `arrow_type`; anything else becomes null.
+    """
+    return pc.cast(_matching(strings, _NUMBER), pa.float64()).cast(arrow_type)
+
+
+def parse_codes(strings, arrow_type=pa.int8()):
+    """
+    Small integer codes ('1', '2', ...) as `arrow_type`; anything else,
+    including codes out of its range, becomes null.
+    """
+    codes = pc.cast(_matching(strings, _CODE), pa.int16())
+    low, high = (-128, 127) if arrow_type == pa.int8() else (-32768, 32767)
+    in_range = pc.and_(pc.greater_equal(codes, low), pc.less_equal(codes, high))
+    return pc.if_else(in_range, codes, pa.scalar(None, pa.int16())).cast(arrow_type)
+
+
+def _child_locator(locate, name):
+    def child(i):
+        row, path = locate(i)
+        return row, f"{path}.{name}"
+    return child
+
+
+def _item_locator(locate, offsets):
+    offsets = offsets.to_numpy()
+
+    def item(j):
+        parent = int(np.searchsorted(offsets, j, side='right')) - 1
+        row, path = locate(parent)
+        return row, f"{path}.{j - offsets[parent]}"
+    return item
+
+
+def _record_failures(strings, typed, locate, failures):
+    """
+    Add the non-blank strings that parsed to null to `failures`, as
+    row -> {dotted path: original string}. Only rows with such values leave
+    Arrow.
+    """
+    failed = pc.fill_null(pc.and_(pc.is_null(typed), pc.greater(pc.utf8_length(pc.utf8_trim_whitespace(strings)), 0)),
+                          False)
+    if not pc.any(failed).as_py():
+        return
+    for i in np.flatnonzero(failed.to_numpy(zero_copy_only=False)):
+        row, path = locate(int(i))
+        failures.setdefault(row, {})[path] = strings[int(i)].as_py()
+
+
+def _type_array(array, arrow_type, locate=None, failures=None):
+    """
+    Parse an array of string leaves (see string_type) into `arrow_type`,
+    descending through structs and lists without leaving Arrow. If
+    `failures` is given, strings that fail to parse are added to it (see
+    _record_failures), with `locate` mapping an element to its row and path.
+    """
+    if pa.types.is_struct(arrow_type):
+        children = {
+            field.name: _type_array(array.field(i), field.type,
+                                    locate and _child_locator(locate, field.name), failures)
+            for i, field in enumerate(arrow_type)
+        }
+        for name, derive in DERIVED_FIELDS.items():
+            if name in children:
+                children[name] = derive(children).cast(arrow_type.field(name).type)
+        return pa.StructArray.from_arrays(list(children.values()), fields=list(arrow_type),
+                                          mask=array.is_null() if array.null_count else None)
+    if pa.types.is_list(arrow_type):
+        values = _type_array(array.values, arrow_type.value_type,
+                             locate and _item_locator(locate, array.offsets), failures)
+        return pa.ListArray.from_arrays(array.offsets, values, type=arrow_type,
+                                        mask=array.is_null() if array.null_count else None)
+    if pa.types.is_string(arrow_type):
+        return array
+    if pa.types.is_date(arrow_type):
+        typed = parse_dates(array).cast(arrow_type)
+    elif pa.types.is_integer(arrow_type):
+        typed = parse_codes(array, arrow_type)
+    elif pa.types.is_floating(arrow_type):
+        typed = parse_numbers(array, arrow_type)
+    else:
+        raise TypeError(f"No parser for {arrow_type}")
+    if failures is not None:
+        _record_failures(array, typed, locate, failures)
+    return typed
+
+
+def _merge_unknown(column, failures):
+    """
+    Add the unparsed strings of each row to its UNKNOWN_FIELDS_COLUMN JSON.
+    """
+    values = column.to_pylist()
+    for row, fields in failures.items():
+        unknown = json.loads(values[row]) if values[row] else {}
+        unknown.update(fields)
+        values[row] = json.dumps(unknown, separators=(',', ':'))
+    return pa.array(values, pa.string())
+
+
+def type_batch(batch, schema=DRUG_EVENT_SCHEMA):
+    """
+    Parse a record batch of string values (string_schema(schema)) into
+    `schema`, with vectorized Arrow kernels over whole columns rather than
+    per-row Python. A value that fails to parse becomes null and its original
+    string is kept in the UNKNOWN_FIELDS_COLUMN under its dotted path, like
+    the fields conform_record sets aside.
+    """
+    failures = {}
+    columns = [
+        _type_array(column, field.type, lambda i, name=field.name: (i, name), failures)
+        for column, field in zip(batch.columns, schema)
+    ]
+    if failures and UNKNOWN_FIELDS_COLUMN in schema.names:
+        index = schema.get_field_index(UNKNOWN_FIELDS_COLUMN)
+        columns[index] = _merge_unknown(columns[index], failures)
+    return pa.RecordBatch.from_arrays(columns, schema=schema)
+
+
+def records_to_batch(records, schema=DRUG_EVENT_SCHEMA):
+    """
+    Build a record batch with the canonical schema from a list of records,
+    without any per-file schema inference. Values are collected as strings
+    and parsed into the schema's types column by column (see type_batch).
+    """
+    batch = pa.RecordBatch.from_pylist([conform_record(record, schema) for record in records],
+                                       schema=string_schema(schema))
+    return type_batch(batch, schema)
+
+
+def schema_paths(arrow_type=None, prefix=''):
+    """
+    List the dotted paths of every field in the schema, descending through
+    structs and lists of structs (lists are not part of the path).
+    """
+    if arrow_type is None:
+        arrow_type = _RECORD_TYPE
+    paths = set()
+    for field in arrow_type:
+        path = f"{prefix}.{field.name}" if prefix else field.name
+        paths.add(path)
+        child = field.type
+        if pa.types.is_list(child):
+            child = child.value_type
+        if pa.types.is_struct(child):
+            paths |= schema_paths(child, path)
+    return paths
+
+
+def missing_from_schema(report_file='json_analysis_report.json'):
+    """
+    Compare a file_analysis report against the schema and return the record
+    paths ('results.' prefix stripped) the schema does not cover yet.
+    """
+    with open(report_file, 'r') as f:
+        report = json.load(f)
+    paths = set(report['common_keys'])
+    if 'profile' in report:
+        paths |= {path.replace('[]', '') for path in report['profile']}
+    else:
+        # Reports written before file_analysis profiled every record
+        for keys in report['unique_keys'].values():
+            paths |= set(keys)
+    record_paths = {path[len('results.'):] for path in paths if path.startswith('results.')}
+    return sorted(record_paths - schema_paths())
@@ -1,8 +1,21 @@
 import os
 import json
 import logging
-from dask import delayed, compute
+import dask.bag as db
 from dask.diagnostics import ProgressBar
+from json_stream import iter_events
+from manifest import Manifest, shard_key, source_fingerprint
+from metrics import print_summary, start_run, track
+from shard_sources import list_json_sources, open_json_source, source_size
+
+# Name of this stage in the ingestion manifest
+STAGE = 'analyze'
+
+# Files profiled per Dask partition, and partial profiles merged per reduction step
+PARTITION_SIZE = 4
+SPLIT_EVERY = 8
+
+logger = logging.getLogger()
 
 
 def configure_logging(log_file):
@@ -23,102 +36,245 @@ def configure_logging(log_file):
     return logging.getLogger()
 
 
-def extract_structure(data, parent_key='', depth=1):
-    """
-    Recursively extract the structure of a JSON object up to the specified depth.
+def _new_path_stats():
+    return {
+        "files": 1,         # Files in which the path occurs
+        "present": 0,       # Values seen at the path, nulls included
+        "nulls": 0,
+        "types": {},        # JSON type name -> count
+        "objects": 0,       # Objects seen at the path (parents of the keys below it)
+        "lists": 0,         # Arrays seen at the path and their total/min/max length
+        "list_items": 0,
+        "list_min": None,
+        "list_max": None,
+    }
 
-    Parameters:
-        data (dict or list): JSON data to analyze.
-        parent_key (str): Current key path (for nested keys).
-        depth (int): Maximum depth to analyze nested structures.
 
-    Returns:
-        set: A set of all nested keys (as "parent.child" paths) in the JSON structure.
+def _json_type(value):
+    if value is None:
+        return "null"
+    if isinstance(value, bool):
+        return "boolean"
+    if isinstance(value, int):
+        return "integer"
+    if isinstance(value, float):
+        return "number"
+    if isinstance(value, str):
+        return "string"
+    if isinstance(value, list):
+        return "array"
+    return "object"
+
+
+def _observe_list_length(stats, length):
+    stats["lists"] += 1
+    stats["list_items"] += length
+    stats["list_min"] = length if stats["list_min"] is None else min(stats["list_min"], length)
+    stats["list_max"] = length if stats["list_max"] is None else max(stats["list_max"], length)
+
+
+def profile_value(paths, path, value):
     """
-    if depth == 0:
-        return {parent_key} if parent_key else set()
+    Add one JSON value and everything nested in it to a path profile.
 
-    keys = set()
-    if isinstance(data, dict):
-        for key, value in data.items():
-            full_key = f"{parent_key}.{key}" if parent_key else key
-            keys |= extract_structure(value, full_key, depth - 1)
-    elif isinstance(data, list):
-        if data:
-            keys |= extract_structure(data[0], parent_key, depth - 1)
-    else:
-        keys.add(parent_key)
+    Object keys extend the path with '.key'; array elements are profiled under
+    '<path>[]', so every element of every record is visited, not just the first.
 
-    return keys
+    Parameters:
+        paths (dict): Path -> statistics, updated in place.
+        path (str): Dotted path of `value`.
+        value: Decoded JSON value.
+    """
+    stack = [(path, value)]
+    while stack:
+        path, value = stack.pop()
+        stats = paths.get(path)
+        if stats is None:
+            stats = paths[path] = _new_path_stats()
+        type_name = _json_type(value)
+        stats["present"] += 1
+        stats["types"][type_name] = stats["types"].get(type_name, 0) + 1
+        if type_name == "null":
+            stats["nulls"] += 1
+        elif type_name == "object":
+            stats["objects"] += 1
+            stack.extend((f"{path}.{key}", child) for key, child in value.items())
+        elif type_name == "array":
+            _observe_list_length(stats, len(value))
+            stack.extend((f"{path}[]", child) for child in value)
+
+
+def empty_profile():
+    """
+    Profile of no files; the identity of merge_profiles.
+    """
+    return {"files": 0, "records": 0, "paths": {}, "errors": []}
 
 
-def analyze_json_structure(file_path, depth=1):
+def profile_json_file(file_path):
     """
-    Analyze the key structure of a JSON file.
+    Profile every record of a JSON shard in one streaming pass.
 
     Parameters:
-        file_path (str): Path to the JSON file.
-        depth (int): Maximum depth to analyze nested structures.
+        file_path (str): Path to the JSON file, or a zip member source.
 
     Returns:
-        dict: A dictionary containing the structure of the JSON file or error details.
+        dict: A mergeable profile {"files", "records", "paths", "errors"} where
+        "paths" maps each dotted path to its statistics.
     """
+    profile = empty_profile()
+    profile["files"] = 1
+    paths = profile["paths"]
     try:
-        with open(file_path, 'r') as f:
-            data = json.load(f)
-
-        structure = extract_structure(data, depth=depth)
-        return {"file": file_path, "structure": structure, "error": None}
+        with open_json_source(file_path) as f:
+            for event, key, value in iter_events(f):
+                if event == "member":
+                    profile_value(paths, key, value)
+                elif event == "start":
+                    record_count = 0
+                elif event == "record":
+                    profile_value(paths, f"{key}[]", value)
+                    record_count += 1
+                else:
+                    # The streamed array itself, now that its length is known
+                    stats = paths.setdefault(key, _new_path_stats())
+                    stats["present"] += 1
+                    stats["types"]["array"] = stats["types"].get("array", 0) + 1
+                    _observe_list_length(stats, record_count)
+                    profile["records"] += record_count
     except Exception as e:
         logger.error(f"Failed to process file {file_path}: {e}")
-        return {"file": file_path, "structure": None, "error": str(e)}
+        return {"files": 1, "records": 0, "paths": {}, "errors": [{"file": file_path, "error": str(e)}]}
+    return profile
 
 
-def compare_structures(results):
+def merge_profiles(left, right):
+    """
+    Combine two profiles into the profile of the union of their files.
+    Associative and commutative, so partial profiles can be merged in any order.
     """
-    Compare the structures of all analyzed JSON files.
+    merged = {
+        "files": left["files"] + right["files"],
+        "records": left["records"] + right["records"],
+        "paths": {path: dict(stats, types=dict(stats["types"])) for path, stats in left["paths"].items()},
+        "errors": left["errors"] + right["errors"],
+    }
+    for path, stats in right["paths"].items():
+        target = merged["paths"].get(path)
+        if target is None:
+            merged["paths"][path] = dict(stats, types=dict(stats["types"]))
+            continue
+        for name in ("files", "present", "nulls", "objects", "lists", "list_items"):
+            target[name] += stats[name]
+        for type_name, count in stats["types"].items():
+            target["types"][type_name] = target["types"].get(type_name, 0) + count
+        for name, pick in (("list_min", min), ("list_max", max)):
+            if stats[name] is not None:
+                target[name] = stats[name] if target[name] is None else pick(target[name], stats[name])
+    return merged
+
+
+def _parent_path(path):
+    """
+    Path of the object holding `path`, or None for top-level keys.
+    """
+    cut = path.rfind(".")
+    return path[:cut] if cut >= 0 else None
 
-    Parameters:
-        results (list): List of dictionaries with file structures.
 
-    Returns:
-        dict: A summary of differences between file structures.
+def key_path(path, depth=None):
     """
-    structures = {result['file']: result['structure'] for result in results if result['error'] is None}
-    errors = [result for result in results if result['error']]
+    Strip array markers from a profile path ('results[].patient.drug[].drugindication'
+    -> 'results.patient.drug.drugindication'), keeping at most `depth` keys.
+    """
+    keys = path.replace("[]", "").split(".")
+    return ".".join(keys[:depth] if depth else keys)
 
-    if not structures:
-        return {"common_keys": [], "unique_keys": {}, "errors": errors}
 
-    # Find common keys across all structures
-    common_keys = set.intersection(*(struct for struct in structures.values()))
+def summarize_profile(profile, depth=None):
+    """
+    Turn a merged profile into a report.
 
-    # Find unique keys for each file
-    unique_keys = {file: list(struct.difference(common_keys)) for file, struct in structures.items()}
+    Parameters:
+        profile (dict): Profile returned by merge_profiles / profile_json_file.
+        depth (int): Maximum number of keys in the paths listed as common or
+            partial keys (the full profile is always reported).
+
+    Returns:
+        dict: Keys present in every profiled file, keys missing from some files
+        (with the number of files that have them), per-path statistics and errors.
+    """
+    files = profile["files"] - len(profile["errors"])
+    paths = profile["paths"]
+    key_files = {}
+    report_paths = {}
+    for path, stats in sorted(paths.items()):
+        key = key_path(path, depth)
+        key_files[key] = max(key_files.get(key, 0), stats["files"])
+
+        parent = paths.get(_parent_path(path)) if not path.endswith("[]") else None
+        entry = {
+            "types": stats["types"],
+            "files": stats["files"],
+            "present": stats["present"],
+            "null_rate": stats["nulls"] / stats["present"] if stats["present"] else 0.0,
+        }
+        if parent is not None and parent["objects"]:
+            entry["presence_rate"] = stats["present"] / parent["objects"]
+        if stats["lists"]:
+            entry["list_length"] = {
+                "min": stats["list_min"],
+                "max": stats["list_max"],
+                "mean": stats["list_items"] / stats["lists"],
+            }
+        report_paths[path] = entry
 
     return {
-        "common_keys": list(common_keys),  # Convert to list for JSON serialization
-        "unique_keys": unique_keys,
-        "errors": errors
+        "files": files,
+        "records": profile["records"],
+        "common_keys": sorted(key for key, count in key_files.items() if count == files),
+        "partial_keys": {key: count for key, count in sorted(key_files.items()) if count < files},
+        "profile": report_paths,
+        "errors": profile["errors"],
     }
 
 
+def load_or_profile(file_path, root_dir, pending_entry):
+    """
+    Return the profile of one file: profiled now and stored in the manifest if
+    `pending_entry` (shard, fingerprint) is given, otherwise read back from the
+    manifest. Runs inside the Dask tasks, so per-file profiles never gather in
+    the driver.
+    """
+    if pending_entry is None:
+        with Manifest() as manifest:
+            return json.loads(manifest.get_detail(shard_key(file_path, root_dir), STAGE))["profile"]
+
+    with track(STAGE, file_path, bytes_in=source_size(file_path)) as m:
+        profile = profile_json_file(file_path)
+        m.records = profile["records"]
+        m.error = profile["errors"][0]["error"] if profile["errors"] else None
+    shard, fingerprint = pending_entry
+    with Manifest() as manifest:
+        if profile["errors"]:
+            manifest.mark_failed(shard, STAGE, fingerprint, profile["errors"][0]["error"])
+        else:
+            manifest.mark_done(shard, STAGE, fingerprint, json.dumps({"profile": profile}))
+    return profile
+
+
 def find_json_files_in_subdirectories(root_dir):
     """
-    Find JSON files in subdirectories of a given root directory.
+    Find JSON files in subdirectories of a given root directory, including
+    drug-event JSON members of zip archives (read without extracting them).
 
     Parameters:
         root_dir (str): Root directory to search.
 
     Returns:
-        list: List of JSON file paths.
+        list: List of JSON file paths and zip member sources.
     """
-    json_files = []
-    for subdir, _, files in os.walk(root_dir):
-        for file in files:
-            if file.endswith(".json"):
-                json_files.append(os.path.join(subdir, file))
-    return json_files
+    return list_json_sources(root_dir)
 
 
 def main(
@@ -136,7 +292,7 @@ def main(
         json_root_dir (str): Root directory containing subdirectories with JSON files.
         log_file (str): Path to the log file.
         report_file (str): Path to save the JSON analysis report.
-        depth (int): Maximum depth to analyze nested structures.
+        depth (int): Maximum number of keys in the paths listed as common or partial keys.
         scheduler (str): Dask scheduler to use ('threads', 'processes', etc.).
         n_workers (int): Number of parallel workers (default is determined by Dask).
     """
@@ -152,14 +308,29 @@ def main(
 
     logger.info(f"Found {len(json_files)} JSON files for analysis.")
 
-    # Use Dask to analyze files in parallel
-    delayed_tasks = [delayed(analyze_json_structure)(file, depth) for file in json_files]
+    # Reuse the stored profile of files whose size and mtime have not changed since their last analysis
+    with Manifest() as manifest:
+        pending = manifest.pending_sources(STAGE, json_files, json_root_dir)
+        tasks = []
+        for file in json_files:
+            if file not in pending:
+                shard = shard_key(file, json_root_dir)
+                if "profile" in json.loads(manifest.get_detail(shard, STAGE)):
+                    tasks.append((file, None))
+                    continue
+                pending[file] = (shard, source_fingerprint(file))
+            tasks.append((file, pending[file]))
+    logger.info(f"{len(json_files) - len(pending)} files unchanged since the last analysis, {len(pending)} to analyze.")
+
+    # Profile files in parallel and merge the partial profiles with a tree reduction
+    bag = db.from_sequence(tasks, partition_size=PARTITION_SIZE)
+    profile = bag.map(lambda task: load_or_profile(task[0], json_root_dir, task[1])).fold(
+        merge_profiles, initial=empty_profile(), split_every=SPLIT_EVERY
+    )
+    run_id = start_run(STAGE)
     with ProgressBar():
-        results = compute(*delayed_tasks, scheduler=scheduler, num_workers=n_workers)
-
-    # Process results
-    results = list(results)
-    summary = compare_structures(results)
+        profile = profile.compute(scheduler=scheduler, num_workers=n_workers)
+    summary = summarize_profile(profile, depth)
 
     # Save the summary to a file
     with open(report_file, "w") as f:
@@ -167,10 +338,12 @@ def main(
     logger.info(f"Analysis complete! Report saved to {report_file}")
 
     # Display progress and summary on terminal
+    logger.info(f"Profiled {summary['records']} records in {summary['files']} files.")
     logger.info(f"Common keys across files: {summary['common_keys']}")
-    logger.info(f"Unique keys in each file: {summary['unique_keys']}")
+    logger.info(f"Keys missing from some files (files that have them): {summary['partial_keys']}")
     if summary["errors"]:
         logger.error(f"Errors encountered: {summary['errors']}")
+    print_summary(run_id)
 
 
 # Run the script
@@ -179,7 +352,7 @@ if __name__ == "__main__":
     json_root_directory = "DataUnzip"  # Root directory containing JSON files in subdirectories
     log_file_path = "json_analysis.log"  # Path to the log file
     report_file_path = "json_analysis_report.json"  # Path to save the JSON analysis report
-    analysis_depth = 5  # Maximum depth to analyze nested structures
+    analysis_depth = 5  # Maximum number of keys in reported paths (the profile covers every path)
     dask_scheduler = "threads"  # Scheduler to use: 'threads', 'processes', or 'synchronous'
     parallel_workers = 8  # Number of parallel workers (set None to use Dask's default)
 
@@ -0,0 +1,254 @@
+import os
+import time
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import clean_to_parquet
+from convert_to_parquet import drop_stale_compacted_rows
+from drug_event_schema import SCHEMA_VERSION
+from manifest import Manifest, shard_key, source_fingerprint
+from metrics import print_summary, start_run
+from catalog import CATALOG_PATH, load_catalog, select_entries
+from parallel_downloader import STAGE as DOWNLOAD_STAGE
+from parallel_downloader import ByteBudget, download_file, plan_downloads, record_download
+from shard_sources import list_zip_members
+
+# Default concurrency of each stage
+DOWNLOAD_WORKERS = 8
+CONVERT_WORKERS = 4
+
+# Archives downloaded but not yet handed to a converter. Downloads block once
+# this many are waiting, which caps the disk used ahead of conversion.
+MAX_QUEUED_ARCHIVES = 8
+
+# Shards submitted to converters beyond the ones running. Queued shards cost
+# no memory until a worker picks them up; a running one buffers up to
+# parquet_dataset.ROW_GROUP_SIZE rows for every partition it has open, so RAM
+# is bounded by the number of workers, not by this backlog.
+MAX_CONVERT_BACKLOG = 2
+
+# Seconds between checks of the stop event while a hand-off is full
+_PUT_TIMEOUT = 1.0
+
+_DONE = object()
+
+
+class StageStats:
+    """
+    Outcome counts and busy time per stage, updated from several threads, to
+    compare the wall time of the overlapped run with the sum of its stages.
+    """
+
+    def __init__(self):
+        self.counts = {key: 0 for key in (
+            "download_done", "download_budget", "download_failed",
+            "convert_done", "convert_failed", "convert_skipped", "records",
+        )}
+        self.busy = {}
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds=0.0, **counts):
+        with self.lock:
+            self.busy[stage] = self.busy.get(stage, 0.0) + seconds
+            for key, value in counts.items():
+                self.counts[key] += value
+
+
+def _put(archive_queue, item, stop):
+    """
+    Queue an item for the converters, giving up once `stop` is set so a
+    failed convert stage can't leave the downloads blocked on a full queue.
+
+    Returns:
+        bool: True if the item was queued.
+    """
+    while not stop.is_set():
+        try:
+            archive_queue.put(item, timeout=_PUT_TIMEOUT)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _download_stage(pending, completed, archive_queue, budget, download_workers, stats, stop):
+    """
+    Download archives in parallel and queue each one for conversion as soon
+    as it is complete. Already-downloaded archives are queued straight away.
+    Downloads not started yet are skipped once `stop` is set.
+    """
+    for _, file_path, _, _ in completed:
+        if not _put(archive_queue, file_path, stop):
+            return
+
+    def download(link, file_path, shard, checksum):
+        if stop.is_set():
+            return
+        start = time.perf_counter()
+        try:
+            result = download_file(link, file_path, budget, checksum=checksum)
+            with Manifest() as manifest:
+                record_download(manifest, shard, result)
+        except Exception as e:
+            print(f"Failed to download {link}: {e}")
+            stats.add("download", time.perf_counter() - start, download_failed=1)
+            with Manifest() as manifest:
+                manifest.mark_failed(shard, DOWNLOAD_STAGE, link, str(e))
+            return
+        stats.add("download", time.perf_counter() - start, **{f"download_{result['status']}": 1})
+        if result["status"] == "done":
+            _put(archive_queue, file_path, stop)  # Blocks while MAX_QUEUED_ARCHIVES are waiting
+
+    try:
+        with ThreadPoolExecutor(max_workers=download_workers) as executor:
+            futures = [executor.submit(download, link, file_path, shard, checksum)
+                       for link, file_path, shard, checksum in pending]
+        for future in futures:
+            if future.exception() is not None:
+                print(f"Download worker failed: {future.exception()}")
+    finally:
+        _put(archive_queue, _DONE, stop)
+
+
+def _convert_stage(archive_queue, data_folder, output_dir, convert_workers, stats):
+    """
+    Hand every member of each queued archive to a converter process, reading
+    it straight from the zip, with at most MAX_CONVERT_BACKLOG shards waiting.
+    An archive that can't be listed, or a converter that crashes, counts as a
+    failed conversion and the stage moves on to the next archive. Workers are
+    spawned rather than forked, since the download threads hold open SQLite
+    connections and HTTP sessions.
+    """
+    slots = threading.BoundedSemaphore(convert_workers + MAX_CONVERT_BACKLOG)
+    context = multiprocessing.get_context('spawn')
+
+    def finished(future, source, entry):
+        slots.release()
+        try:
+            result = future.result()
+        except Exception as e:
+            # The worker died (e.g. killed for memory) or the pool broke
+            result = {"file": source, "records": 0, "seconds": 0.0, "error": f"Converter failed: {e!r}"}
+        try:
+            outcome = "convert_done" if result["error"] is None else "convert_failed"
+            stats.add("convert", result["seconds"], records=result["records"], **{outcome: 1})
+            with Manifest() as manifest:
+                manifest.record_results(clean_to_parquet.STAGE, {source: entry}, {
+                    source: result["error"] is None or result["error"]
+                })
+        except Exception as e:
+            print(f"Failed to record the conversion of {source}: {e}")
+
+    executor = ProcessPoolExecutor(max_workers=convert_workers, mp_context=context)
+    try:
+        while True:
+            archive_path = archive_queue.get()
+            if archive_path is _DONE:
+                break
+            try:
+                members = list_zip_members(archive_path)
+                with Manifest() as manifest:
+                    pending = manifest.pending_sources(clean_to_parquet.STAGE, members, data_folder, SCHEMA_VERSION)
+            except Exception as e:
+                print(f"Skipping archive {archive_path}: {e}")
+                stats.add("convert", convert_failed=1)
+                with Manifest() as manifest:
+                    manifest.mark_failed(shard_key(archive_path, data_folder), clean_to_parquet.STAGE,
+                                         source_fingerprint(archive_path), str(e))
+                continue
+            stats.add("convert", convert_skipped=len(members) - len(pending))
+            for source, entry in pending.items():
+                slots.acquire()
+                try:
+                    try:
+                        future = executor.submit(
+                            clean_to_parquet.clean_and_convert, source, input_dir=data_folder, output_dir=output_dir,
+                        )
+                    except BrokenProcessPool:
+                        # A crashed worker breaks the pool; carry on with a fresh one
+                        executor.shutdown(wait=False)
+                        executor = ProcessPoolExecutor(max_workers=convert_workers, mp_context=context)
+                        future = executor.submit(
+                            clean_to_parquet.clean_and_convert, source, input_dir=data_folder, output_dir=output_dir,
+                        )
+                except BaseException:
+                    # Never submitted, so the done callback won't free the slot
+                    slots.release()
+                    raise
+                future.add_done_callback(lambda f, source=source, entry=entry: finished(f, source, entry))
+    finally:
+        executor.shutdown(wait=True)
+
+
+def run_pipeline(catalog_path=CATALOG_PATH, quarters=None, start=None, end=None, data_folder='Data',
+                 output_dir=clean_to_parquet.OUTPUT_DIR, max_size_gb=100, download_workers=DOWNLOAD_WORKERS,
+                 convert_workers=CONVERT_WORKERS):
+    """
+    Download, decompress and convert archives as one overlapped pipeline, for
+    the shards of the catalog selected by quarter or date range (see
+    catalog.select_entries), largest first.
+
+    Each archive moves on to conversion as soon as its download finishes; the
+    converters stream its drug-event members straight out of the zip, so
+    decompression happens inside the convert stage without an extracted copy.
+    Bounded hand-offs between the stages provide backpressure.
+
+    Returns:
+        dict: Counts per stage outcome plus wall time and busy time per stage.
+    """
+    os.makedirs(data_folder, exist_ok=True)
+    entries = select_entries(load_catalog(catalog_path), quarters, start, end)
+    with Manifest() as manifest:
+        pending, completed = plan_downloads(entries, data_folder, manifest)
+    print(f"{len(completed)} archives already downloaded, {len(pending)} to download.")
+
+    archive_queue = queue.Queue(maxsize=MAX_QUEUED_ARCHIVES)
+    budget = ByteBudget(max_size_gb * (1024 ** 3))
+    stats = StageStats()
+
+    stop = threading.Event()
+
+    run_id = start_run('ingest')
+    started = time.perf_counter()
+    downloader = threading.Thread(
+        target=_download_stage,
+        args=(pending, completed, archive_queue, budget, download_workers, stats, stop),
+    )
+    downloader.start()
+    try:
+        _convert_stage(archive_queue, data_folder, output_dir, convert_workers, stats)
+    finally:
+        # On a fatal error, stop queueing and let running downloads finish
+        stop.set()
+        downloader.join()
+    # Every converter has exited, so compacted files are cleaned up from this process alone
+    drop_stale_compacted_rows(output_dir, clean_to_parquet.NORMALIZED_DIR)
+    wall = time.perf_counter() - started
+
+    counts = stats.counts
+    download_time = stats.busy.get("download", 0.0) / max(download_workers, 1)
+    convert_time = stats.busy.get("convert", 0.0) / max(convert_workers, 1)
+    summary = dict(counts, wall_seconds=wall, download_seconds=download_time, convert_seconds=convert_time)
+    print(f"Downloaded {counts['download_done']} archives ({counts['download_failed']} failed, "
+          f"{counts['download_budget']} over budget); converted {counts['convert_done']} shards "
+          f"({counts['convert_failed']} failed, {counts['convert_skipped']} up to date), {counts['records']} records.")
+    print(f"Wall time {wall:.1f}s vs. download {download_time:.1f}s + convert {convert_time:.1f}s "
+          f"run back to back (busy time divided by workers).")
+    print_summary(run_id)
+    return summary
+
+
+if __name__ == "__main__":
+    # Adjustable parameters
+    run_pipeline(
+        CATALOG_PATH,
+        quarters=None,  # e.g. ['2004q3', '2005']; None for every quarter
+        start=None, end=None,  # or a range such as '2010q1' to '2012-06'
+        data_folder='Data',
+        output_dir='Data_parquet',
+        max_size_gb=100,
+        download_workers=DOWNLOAD_WORKERS,
+        convert_workers=CONVERT_WORKERS,
+    )
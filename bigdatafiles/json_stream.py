@@ -0,0 +1,405 @@
+import os
+import json
+
+# Characters are read from the shard in blocks of this size. Only the current
+# record (plus one block of look-ahead) is ever held in memory.
+CHUNK_SIZE = 1024 * 1024
+
+# Upper bound on the size of a single value. A shard that never closes a record
+# is reported as malformed instead of being pulled into memory up to EOF.
+MAX_VALUE_SIZE = 256 * 1024 * 1024
+
+# Name of the top-level member holding the list of records in openFDA shards
+RESULTS_KEY = "results"
+
+# Member every openFDA drug-event record has. After a corrupt record, reading
+# resumes at the next object that decodes and carries it.
+RECORD_ID_KEY = "safetyreportid"
+
+# Byte ranges skipped while salvaging shards, one JSON line per range
+QUARANTINE_FILE = 'quarantine.jsonl'
+
+# Characters of a skipped range kept in its quarantine entry
+EXCERPT_SIZE = 200
+
+# A decode error this close to the end of the window may just be a value cut
+# off by the window edge (e.g. a literal like 'tru'); anything earlier is corrupt
+_EDGE = 16
+
+_WHITESPACE = " \t\n\r"
+_decoder = json.JSONDecoder()
+
+
+class _Buffer:
+    """
+    Sliding text window over a file object, refilled on demand.
+    """
+
+    def __init__(self, fp, chunk_size=CHUNK_SIZE):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.text = ""
+        self.pos = 0
+        self.eof = False
+        self.offset = 0  # Byte offset of text[0] in the file
+
+    def fill(self):
+        """
+        Read one more block, dropping the part of the window already consumed.
+        Returns False once the end of the file has been reached.
+        """
+        if self.eof:
+            return False
+        chunk = self.fp.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.offset += len(self.text[:self.pos].encode('utf-8', 'surrogateescape'))
+        self.text = self.text[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def byte_offset(self, pos=None):
+        """
+        Byte offset in the file of a position in the window (the current one
+        by default), assuming the file is UTF-8.
+        """
+        pos = self.pos if pos is None else pos
+        return self.offset + len(self.text[:pos].encode('utf-8', 'surrogateescape'))
+
+    def peek(self):
+        """
+        Skip whitespace and return the next significant character ('' at EOF).
+        """
+        while True:
+            while self.pos < len(self.text) and self.text[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            if not self.fill():
+                return ""
+
+    def expect(self, char):
+        """
+        Consume the next significant character, which must be `char`.
+        """
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"Expected {char!r} but found {found or 'end of file'!r}")
+        self.pos += 1
+
+    def decode_value(self):
+        """
+        Decode one complete JSON value starting at the next significant character.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.text, self.pos)
+                # A value that ends exactly at the window edge may be a truncated
+                # number or literal, so only accept it with look-ahead or at EOF.
+                if end < len(self.text) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError as e:
+                cut_off = e.msg.startswith('Unterminated string') or len(self.text) - e.pos < _EDGE
+                if self.eof or not cut_off:
+                    raise
+            if len(self.text) - self.pos > MAX_VALUE_SIZE:
+                raise ValueError(f"Value at offset {self.pos} exceeds {MAX_VALUE_SIZE} characters")
+            self.fill()
+
+    def resync(self, is_record, start):
+        """
+        Find the next object at or after window position `start` that decodes
+        as a whole and satisfies `is_record`, skipping everything before it.
+        Objects nested in a corrupt record fail `is_record` and are skipped too.
+
+        Returns:
+            tuple: (record, byte offset where it starts), or (None, offset of
+            the end of the file) if no record follows.
+        """
+        while True:
+            i = self.text.find("{", start)
+            if i < 0:
+                self.pos = len(self.text)
+                if not self.fill():
+                    return None, self.byte_offset()
+                start = 0
+                continue
+            self.pos = i
+            offset = self.offset
+            try:
+                value = self.decode_value()
+                decoded = True
+            except ValueError:
+                decoded = False
+            # A refill while decoding moves the candidate to the start of the window
+            if self.offset != offset:
+                i = 0
+            if decoded and is_record(value):
+                return value, self.byte_offset(i)
+            # No record starts inside an object that decoded cleanly
+            start = self.pos if decoded else i + 1
+
+
+def is_drug_event_record(value):
+    return isinstance(value, dict) and RECORD_ID_KEY in value
+
+
+class Quarantine:
+    """
+    Error handler for salvaging readers (see iter_events): appends every
+    skipped byte range of a source to the quarantine file as one JSON line
+    with the error and the start of the skipped text, and counts them.
+    Each entry is written with a single append, so concurrent workers don't
+    interleave lines.
+    """
+
+    def __init__(self, source, path=QUARANTINE_FILE):
+        self.source = source
+        self.path = path
+        self.ranges = 0
+        self.bytes = 0
+
+    def __call__(self, start, end, error, excerpt):
+        self.ranges += 1
+        self.bytes += end - start
+        entry = {"source": str(self.source), "start": start, "end": end, "error": error, "excerpt": excerpt}
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def summary(self):
+        return f"{self.ranges} corrupt ranges ({self.bytes} bytes) quarantined to {self.path}"
+
+
+def _skip_corrupt(buf, start, search_from, error, on_error, is_record):
+    """
+    Pass the range from window position `start` up to the next record to
+    `on_error`, searching for that record from `search_from`.
+
+    Returns:
+        The next record, or None if the rest of the file was skipped (a truncated shard).
+    """
+    start_byte = buf.byte_offset(start)
+    excerpt = buf.text[start:start + EXCERPT_SIZE]
+    record, end_byte = buf.resync(is_record, search_from)
+    if record is None:
+        error = f"Truncated: {error}"
+    on_error(start_byte, end_byte, error, excerpt)
+    return record
+
+
+def iter_events(fp, stream_key=RESULTS_KEY, chunk_size=CHUNK_SIZE, on_error=None, is_record=is_drug_event_record):
+    """
+    Walk the top-level object of a shard without loading it as a whole.
+
+    Without `on_error`, any malformed JSON raises. With it, the `stream_key`
+    array is salvaged instead: a record that fails to decode, or garbage
+    between records, is skipped up to the next record and the skipped range is
+    passed to `on_error(start, end, error, excerpt)` with byte offsets into the
+    file. A shard truncated inside the array yields every complete record
+    before the cut and then ends, as if the array and object were closed.
+
+    Yields tuples describing the document in order:
+        ("member", key, value)  for every top-level member except `stream_key`
+        ("start", key, None)    when the `stream_key` array begins
+        ("record", key, record) for every element of the `stream_key` array
+        ("end", key, None)      when the `stream_key` array ends
+
+    Parameters:
+        fp (file object): Text file object opened on the shard.
+        stream_key (str): Top-level member whose array is streamed record by record.
+        chunk_size (int): Number of characters read per block.
+        on_error (callable): Receives the skipped ranges when salvaging, e.g. a Quarantine.
+        is_record (callable): Recognizes the next record after a corrupt one.
+    """
+    buf = _Buffer(fp, chunk_size)
+    buf.expect("{")
+    if buf.peek() == "}":
+        return
+    streamed = False
+    try:
+        while True:
+            key = buf.decode_value()
+            if not isinstance(key, str):
+                raise ValueError(f"Expected an object key but found {key!r}")
+            buf.expect(":")
+            if key == stream_key and buf.peek() == "[":
+                buf.expect("[")
+                yield ("start", key, None)
+                if buf.peek() == "]":
+                    buf.expect("]")
+                else:
+                    record = None
+                    truncated = False
+                    while True:
+                        if record is None:
+                            try:
+                                record = buf.decode_value()
+                            except ValueError as e:
+                                if on_error is None:
+                                    raise
+                                # A failed decode leaves the position at the start of the record
+                                record = _skip_corrupt(buf, buf.pos, buf.pos + 1, getattr(e, 'msg', str(e)),
+                                                       on_error, is_record)
+                                truncated = record is None
+                                if truncated:
+                                    break
+                        yield ("record", key, record)
+                        record = None
+                        separator = buf.peek()
+                        if separator == ",":
+                            buf.expect(",")
+                        elif separator == "]" or on_error is None:
+                            buf.expect("]")
+                            break
+                        else:
+                            error = f"Expected ',' or ']' but found {separator or 'end of file'!r}"
+                            record = _skip_corrupt(buf, buf.pos, buf.pos, error, on_error, is_record)
+                            truncated = record is None
+                            if truncated:
+                                break
+                    if truncated:
+                        # End the stream as if the array and object had been closed
+                        yield ("end", key, None)
+                        return
+                yield ("end", key, None)
+                streamed = True
+            else:
+                yield ("member", key, buf.decode_value())
+            if buf.peek() == ",":
+                buf.expect(",")
+            else:
+                buf.expect("}")
+                break
+        if buf.peek():
+            raise ValueError("Extra data after the top-level object")
+    except ValueError as e:
+        # Once the records are out, a damaged tail only costs the members after them
+        if on_error is None or not streamed:
+            raise
+        start_byte = buf.byte_offset()
+        excerpt = buf.text[buf.pos:buf.pos + EXCERPT_SIZE]
+        buf.pos = len(buf.text)
+        while buf.fill():
+            buf.pos = len(buf.text)
+        on_error(start_byte, buf.byte_offset(), str(e), excerpt)
+
+
+def iter_records(fp, stream_key=RESULTS_KEY, chunk_size=CHUNK_SIZE, on_error=None):
+    """
+    Yield the records of a shard's `results` array one at a time, salvaging
+    corrupt shards when `on_error` is given (see iter_events).
+    """
+    for event, _, value in iter_events(fp, stream_key, chunk_size, on_error):
+        if event == "record":
+            yield value
+
+
+def iter_ndjson_records(fp, on_error=None):
+    """
+    Yield the records of a newline-delimited JSON shard (see write_ndjson)
+    one line at a time. With `on_error`, lines that don't decode are passed
+    to it with their byte offsets instead of raising.
+    """
+    offset = 0
+    for line in fp:
+        size = len(line.encode('utf-8', 'surrogateescape'))
+        text = line.strip()
+        record = None
+        if text:
+            try:
+                record = json.loads(text)
+            except ValueError as e:
+                if on_error is None:
+                    raise
+                on_error(offset, offset + size, getattr(e, 'msg', str(e)), text[:EXCERPT_SIZE])
+        offset += size
+        if record is not None:
+            yield record
+
+
+def dumps_compact(value):
+    """
+    Serialise a value without indentation or padding whitespace.
+    """
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False)
+
+
+def tee_events(events, out, transform=None):
+    """
+    Pass the events produced by `iter_events` through unchanged while writing
+    them to `out` as compact JSON.
+
+    Parameters:
+        events (iterable): Events as yielded by `iter_events`.
+        out (file object): Text file object to write to.
+        transform (callable): Optional function applied to every record and member value
+            before it is written.
+    """
+    transform = transform or (lambda value: value)
+    first_member = True
+    first_record = True
+    out.write("{")
+    for event, key, value in events:
+        if event in ("member", "start"):
+            if not first_member:
+                out.write(",")
+            first_member = False
+            out.write(dumps_compact(key) + ":")
+        if event == "member":
+            out.write(dumps_compact(transform(value)))
+        elif event == "start":
+            out.write("[")
+            first_record = True
+        elif event == "record":
+            if not first_record:
+                out.write(",")
+            first_record = False
+            out.write(dumps_compact(transform(value)))
+        elif event == "end":
+            out.write("]")
+        yield event, key, value
+    out.write("}")
+
+
+def write_events(events, out, transform=None):
+    """
+    Write the events produced by `iter_events` back out as compact JSON.
+
+    Parameters:
+        events (iterable): Events as yielded by `iter_events`.
+        out (file object): Text file object to write to.
+        transform (callable): Optional function applied to every record and member value.
+
+    Returns:
+        int: Number of records written.
+    """
+    record_count = 0
+    for event, _, _ in tee_events(events, out, transform):
+        if event == "record":
+            record_count += 1
+    return record_count
+
+
+def write_ndjson(events, out, transform=None):
+    """
+    Write the records among the events produced by `iter_events` as
+    newline-delimited JSON, one compact record per line, for readers that
+    split the file into blocks of lines (e.g. pyarrow.json). Top-level
+    members such as `meta` are left out.
+
+    Returns:
+        int: Number of records written.
+    """
+    transform = transform or (lambda value: value)
+    record_count = 0
+    for event, _, value in events:
+        if event == "record":
+            out.write(dumps_compact(transform(value)) + "\n")
+            record_count += 1
+    return record_count
@@ -1,17 +1,20 @@
-import re
+from catalog import load_catalog
+
 
 def extract_links(html_file, output_file):
-    # Read the HTML content
-    with open(html_file, 'r', encoding='utf-8') as file:
-        html_content = file.read()
-    
-    # Use regular expressions to find all href links
-    links = re.findall(r'href=["\'](.*?)["\']', html_content)
-    
+    """
+    Write the drug-event shard links of the saved download page to a file, one
+    link per line, in page order (see catalog.load_catalog). Download
+    planning now reads the catalog directly; the list is kept for older tools.
+    """
+    entries = load_catalog(html_file)
+
     # Write links to the output file, one link per line
     with open(output_file, 'w', encoding='utf-8') as file:
-        for link in links:
-            file.write(link + '\n')
+        for entry in entries:
+            file.write(entry["url"] + '\n')
+    return len(entries)
 
 # Usage example
-extract_links('project.html', 'output_links.txt')
\ No newline at end of file
+if __name__ == "__main__":
+    extract_links('Project.html', 'output_links.txt')
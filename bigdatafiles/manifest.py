@@ -0,0 +1,224 @@
+import os
+import time
+import sqlite3
+import zipfile
+from shard_sources import is_zip_member, split_zip_member, relative_source_path
+
+# Shared ingestion manifest, one row per shard and one per (shard, stage)
+MANIFEST_PATH = 'ingest_manifest.sqlite'
+
+# Stages in pipeline order, as reported by the status command
+STAGES = ['download', 'unzip', 'clean', 'convert', 'analyze', 'dedupe', 'rollup']
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS shards (
+    shard TEXT PRIMARY KEY,
+    source_url TEXT,
+    size INTEGER,
+    content_hash TEXT,
+    updated_at REAL
+);
+CREATE TABLE IF NOT EXISTS stage_runs (
+    shard TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    fingerprint TEXT,
+    status TEXT NOT NULL,
+    detail TEXT,
+    completed_at REAL,
+    PRIMARY KEY (shard, stage)
+);
+"""
+
+
+def shard_key(source, root_dir):
+    """
+    Stable key of the shard a stage input belongs to, shared by every stage:
+    the first path component relative to the stage's root, without '.zip' and
+    '.json'. 'Data/18-drug-event-0003-of-0005.json.zip',
+    'DataUnzip/18-drug-event-0003-of-0005.json/drug-event-0003-of-0005.json'
+    and the same member read from the zip all map to '18-drug-event-0003-of-0005'.
+    """
+    first = relative_source_path(source, root_dir).split(os.sep)[0]
+    for suffix in ('.zip', '.json'):
+        if first.endswith(suffix):
+            first = first[:-len(suffix)]
+    return first
+
+
+def source_fingerprint(source):
+    """
+    Cheap change detector for a stage input: size and modification time for
+    files, uncompressed size and CRC-32 for zip members.
+    """
+    if is_zip_member(source):
+        archive_path, member = split_zip_member(source)
+        with zipfile.ZipFile(archive_path, 'r') as zip_ref:
+            info = zip_ref.getinfo(member)
+        return f"{info.file_size}:{info.CRC:08x}"
+    stat = os.stat(source)
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+
+class Manifest:
+    """
+    SQLite-backed record of every shard's source, size and content hash and of
+    which stages have completed for which input fingerprint. Stages consult it
+    to skip work whose input has not changed since it last succeeded.
+    """
+
+    def __init__(self, path=MANIFEST_PATH):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+    def record_shard(self, shard, source_url=None, size=None, content_hash=None):
+        """
+        Insert or update a shard, keeping previously known values for any
+        argument left as None.
+        """
+        with self.conn:
+            self.conn.execute(
+                """
+                INSERT INTO shards (shard, source_url, size, content_hash, updated_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(shard) DO UPDATE SET
+                    source_url = COALESCE(excluded.source_url, source_url),
+                    size = COALESCE(excluded.size, size),
+                    content_hash = COALESCE(excluded.content_hash, content_hash),
+                    updated_at = excluded.updated_at
+                """,
+                (shard, source_url, size, content_hash, time.time()),
+            )
+
+    def get_shard(self, shard):
+        row = self.conn.execute(
+            "SELECT shard, source_url, size, content_hash FROM shards WHERE shard = ?", (shard,)
+        ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(("shard", "source_url", "size", "content_hash"), row))
+
+    def is_done(self, shard, stage, fingerprint):
+        row = self.conn.execute(
+            "SELECT fingerprint, status FROM stage_runs WHERE shard = ? AND stage = ?", (shard, stage)
+        ).fetchone()
+        return row is not None and row[1] == 'done' and row[0] == fingerprint
+
+    def get_detail(self, shard, stage):
+        row = self.conn.execute(
+            "SELECT detail FROM stage_runs WHERE shard = ? AND stage = ? AND status = 'done'", (shard, stage)
+        ).fetchone()
+        return row[0] if row else None
+
+    def _set_status(self, shard, stage, fingerprint, status, detail):
+        with self.conn:
+            self.conn.execute(
+                """
+                INSERT OR REPLACE INTO stage_runs (shard, stage, fingerprint, status, detail, completed_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (shard, stage, fingerprint, status, detail, time.time()),
+            )
+
+    def mark_done(self, shard, stage, fingerprint, detail=None):
+        self._set_status(shard, stage, fingerprint, 'done', detail)
+
+    def mark_failed(self, shard, stage, fingerprint, error):
+        self._set_status(shard, stage, fingerprint, 'failed', error)
+
+    def pending_sources(self, stage, sources, root_dir, output_version=None):
+        """
+        Filter a stage's inputs down to those that changed or never completed.
+        Every input's shard is registered on the way. A stage whose output
+        format is versioned passes `output_version`, so bumping it makes every
+        input pending again.
+
+        Returns:
+            dict: Pending source -> (shard key, fingerprint).
+        """
+        pending = {}
+        for source in sources:
+            shard = shard_key(source, root_dir)
+            fingerprint = source_fingerprint(source)
+            if output_version is not None:
+                fingerprint = f"{fingerprint}:v{output_version}"
+            self.record_shard(shard)
+            if not self.is_done(shard, stage, fingerprint):
+                pending[source] = (shard, fingerprint)
+        return pending
+
+    def record_results(self, stage, pending, succeeded):
+        """
+        Mark the outcome of a stage run over `pending` (as returned by
+        pending_sources); `succeeded` maps each source to True/False or to an
+        error message.
+        """
+        for source, (shard, fingerprint) in pending.items():
+            outcome = succeeded.get(source)
+            if outcome is True:
+                self.mark_done(shard, stage, fingerprint)
+            elif outcome is not None:
+                self.mark_failed(shard, stage, fingerprint, None if outcome is False else str(outcome))
+
+    def version(self):
+        """
+        Changes whenever any stage completes, for callers that cache derived results.
+        """
+        row = self.conn.execute("SELECT COUNT(*), MAX(completed_at) FROM stage_runs WHERE status = 'done'").fetchone()
+        return f"{row[0]}:{row[1] or 0}"
+
+    def status(self):
+        """
+        Summarise progress per stage over every known shard.
+
+        Returns:
+            dict: stage -> {"done", "failed", "pending", "failed_shards"}
+        """
+        total = self.conn.execute("SELECT COUNT(*) FROM shards").fetchone()[0]
+        summary = {}
+        for stage in STAGES:
+            done = self.conn.execute(
+                "SELECT COUNT(*) FROM stage_runs WHERE stage = ? AND status = 'done'", (stage,)
+            ).fetchone()[0]
+            failed = [row[0] for row in self.conn.execute(
+                "SELECT shard FROM stage_runs WHERE stage = ? AND status = 'failed' ORDER BY shard", (stage,)
+            )]
+            summary[stage] = {
+                "done": done,
+                "failed": len(failed),
+                "pending": total - done,
+                "failed_shards": failed,
+            }
+        return summary
+
+
+def main(manifest_path=MANIFEST_PATH):
+    """
+    Print what each stage has done and what is still pending.
+    """
+    if not os.path.exists(manifest_path):
+        print(f"No manifest at {manifest_path}; nothing has been ingested yet.")
+        return
+    with Manifest(manifest_path) as manifest:
+        total = manifest.conn.execute("SELECT COUNT(*) FROM shards").fetchone()[0]
+        print(f"Manifest {manifest_path}: {total} shards known")
+        print(f"{'stage':<10}{'done':>8}{'failed':>8}{'pending':>9}")
+        for stage, counts in manifest.status().items():
+            print(f"{stage:<10}{counts['done']:>8}{counts['failed']:>8}{counts['pending']:>9}")
+            for shard in counts["failed_shards"][:10]:
+                print(f"    failed: {shard}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import resource
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+# Every stage appends one JSON line per file to this file
+METRICS_FILE = 'pipeline_metrics.jsonl'
+
+# Set to 'cprofile' or 'sample' to profile the processing of every file;
+# profiles are written under PROFILE_DIR/<stage>/
+PROFILE_ENV = 'PIPELINE_PROFILE'
+PROFILE_DIR = 'profiles'
+
+# Seconds between stack samples of the 'sample' profiler
+SAMPLE_INTERVAL = 0.005
+
+# Identifies the run a metric belongs to; inherited by worker processes
+RUN_ID_ENV = 'PIPELINE_RUN_ID'
+
+_write_lock = threading.Lock()
+
+
+def start_run(stage):
+    """
+    Start a new run of `stage` and return its id. Worker processes started
+    afterwards inherit it through the environment.
+    """
+    run_id = f"{stage}-{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}"
+    os.environ[RUN_ID_ENV] = run_id
+    return run_id
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process so far, in MB.
+    """
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+def _safe_name(file):
+    return "".join(c if c.isalnum() or c in '-_.' else '_' for c in str(file)).strip('_')[-150:]
+
+
+class _Sampler(threading.Thread):
+    """
+    Samples the stack of one thread at a fixed interval and counts the
+    distinct stacks, in the folded 'outer;inner;leaf count' format read by
+    flame graph tools.
+    """
+
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self, path):
+        self.stopped.set()
+        self.join()
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+@contextmanager
+def _profiled(stage, file):
+    mode = os.environ.get(PROFILE_ENV)
+    if not mode:
+        yield
+        return
+    profile_dir = os.path.join(PROFILE_DIR, stage)
+    os.makedirs(profile_dir, exist_ok=True)
+    base = os.path.join(profile_dir, _safe_name(file))
+    if mode == 'sample':
+        sampler = _Sampler(threading.get_ident())
+        sampler.start()
+        try:
+            yield
+        finally:
+            sampler.stop(base + '.folded')
+    else:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(base + '.prof')
+
+
+class FileMetrics:
+    """
+    Measurements of one file passing through one stage. Stages fill in what
+    they know (records, bytes, error); timing and memory are filled in by track().
+    """
+
+    def __init__(self, stage, file, bytes_in=None):
+        self.stage = stage
+        self.file = str(file)
+        self.run_id = os.environ.get(RUN_ID_ENV)
+        self.bytes_in = bytes_in
+        self.bytes_out = None
+        self.records = None
+        self.error = None
+        self.seconds = None
+        self.peak_rss_mb = None
+
+    def to_dict(self):
+        return {
+            "run_id": self.run_id,
+            "stage": self.stage,
+            "file": self.file,
+            "seconds": self.seconds,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "records": self.records,
+            "peak_rss_mb": self.peak_rss_mb,
+            "error": self.error,
+            "pid": os.getpid(),
+            "finished_at": time.time(),
+        }
+
+
+def write_metrics(entry, metrics_file=METRICS_FILE):
+    """
+    Append one metrics entry as a JSON line. Each entry is written with a
+    single append, so concurrent workers don't interleave lines.
+    """
+    line = json.dumps(entry) + "\n"
+    with _write_lock:
+        with open(metrics_file, 'a', encoding='utf-8') as f:
+            f.write(line)
+
+
+@contextmanager
+def track(stage, file, bytes_in=None, metrics_file=METRICS_FILE):
+    """
+    Measure the processing of one file and append it to the metrics file.
+    An exception escaping the block is recorded as the file's error and re-raised.
+    When PIPELINE_PROFILE is set, the block is also profiled.
+
+    Usage:
+        with track('clean', path, bytes_in=size) as m:
+            m.records = clean(path)
+
+    peak_rss_mb is the peak of the whole worker process at the end of the file.
+    """
+    metrics = FileMetrics(stage, file, bytes_in)
+    start = time.perf_counter()
+    try:
+        with _profiled(stage, file):
+            yield metrics
+    except Exception as e:
+        metrics.error = str(e)
+        raise
+    finally:
+        metrics.seconds = time.perf_counter() - start
+        metrics.peak_rss_mb = peak_rss_mb()
+        write_metrics(metrics.to_dict(), metrics_file)
+
+
+def load_metrics(metrics_file=METRICS_FILE, run_id=None, stage=None):
+    """
+    Entries of the metrics file, optionally only those of one run and/or stage.
+    """
+    if not os.path.exists(metrics_file):
+        return []
+    entries = []
+    with open(metrics_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if (run_id is None or entry["run_id"] == run_id) and (stage is None or entry["stage"] == stage):
+                entries.append(entry)
+    return entries
+
+
+def summarize(entries, top=10):
+    """
+    Totals per stage, the slowest files and the failed files of a set of entries.
+    """
+    stages = {}
+    for entry in entries:
+        totals = stages.setdefault(entry["stage"], {
+            "files": 0, "errors": 0, "seconds": 0.0, "records": 0, "bytes_in": 0, "bytes_out": 0, "peak_rss_mb": 0.0,
+        })
+        totals["files"] += 1
+        totals["errors"] += 1 if entry["error"] else 0
+        totals["seconds"] += entry["seconds"] or 0.0
+        for name in ("records", "bytes_in", "bytes_out"):
+            totals[name] += entry[name] or 0
+        totals["peak_rss_mb"] = max(totals["peak_rss_mb"], entry["peak_rss_mb"] or 0.0)
+    return {
+        "stages": stages,
+        "slowest": sorted(entries, key=lambda entry: entry["seconds"] or 0.0, reverse=True)[:top],
+        "errors": [entry for entry in entries if entry["error"]],
+    }
+
+
+def print_summary(run_id=None, stage=None, metrics_file=METRICS_FILE, top=10):
+    """
+    Print per-stage totals and the slowest files of a run (or of everything
+    recorded), in place of a line per file.
+    """
+    summary = summarize(load_metrics(metrics_file, run_id, stage), top)
+    if not summary["stages"]:
+        print("No metrics recorded.")
+        return summary
+    print(f"{'stage':<10}{'files':>7}{'errors':>7}{'records':>12}{'MB in':>10}{'MB out':>10}"
+          f"{'file-s':>10}{'peak MB':>9}")
+    for name, totals in summary["stages"].items():
+        print(f"{name:<10}{totals['files']:>7}{totals['errors']:>7}{totals['records']:>12}"
+              f"{totals['bytes_in'] / 1024 ** 2:>10.1f}{totals['bytes_out'] / 1024 ** 2:>10.1f}"
+              f"{totals['seconds']:>10.1f}{totals['peak_rss_mb']:>9.0f}")
+    print(f"Slowest {len(summary['slowest'])} files:")
+    for entry in summary["slowest"]:
+        rate = f"{(entry['bytes_in'] or 0) / 1024 ** 2 / entry['seconds']:.1f} MB/s" if entry["seconds"] else ""
+        print(f"  {entry['seconds']:8.2f}s  {rate:>11}  {entry['stage']:<8} {entry['file']}")
+    for entry in summary["errors"][:top]:
+        print(f"  failed: {entry['stage']} {entry['file']}: {entry['error']}")
+    if len(summary["errors"]) > top:
+        print(f"  ... and {len(summary['errors']) - top} more failed files")
+    return summary
+
+
+def print_profile(stage, top=25, profile_dir=PROFILE_DIR):
+    """
+    Merge the cProfile output of every file of a stage and print the functions
+    with the most cumulative time.
+    """
+    directory = os.path.join(profile_dir, stage)
+    paths = [os.path.join(directory, name) for name in sorted(os.listdir(directory)) if name.endswith('.prof')]
+    if not paths:
+        print(f"No profiles in {directory}")
+        return
+    stats = pstats.Stats(*paths)
+    stats.sort_stats('cumulative').print_stats(top)
+
+
+def latest_run_id(metrics_file=METRICS_FILE):
+    entries = load_metrics(metrics_file)
+    return entries[-1]["run_id"] if entries else None
+
+
+if __name__ == "__main__":
+    # Adjustable parameters
+    run_to_summarize = latest_run_id()  # None summarizes every recorded run
+    stage_to_profile = None  # e.g. 'convert', after a run with PIPELINE_PROFILE=cprofile
+
+    print_summary(run_to_summarize)
+    if stage_to_profile:
+        print_profile(stage_to_profile)
@@ -0,0 +1,238 @@
+import os
+import hashlib
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from drug_event_schema import DRUG_EVENT_SCHEMA, DRUG_TYPE, REACTION_TYPE
+from parquet_dataset import PartitionedDatasetWriter, file_shards, is_compacted, list_dataset_files
+from vocab import get_vocabulary
+
+# Root of the normalized tables, one month-partitioned dataset per table:
+#   Data_normalized/reports/receive_month=YYYY-MM/<shard>.parquet
+#   Data_normalized/drugs/receive_month=YYYY-MM/<shard>.parquet
+#   Data_normalized/reactions/receive_month=YYYY-MM/<shard>.parquet
+# Drugs and reactions join to reports on shard and safetyreportid, e.g. in DuckDB:
+#   SELECT d.medicinalproduct, r.reactionmeddrapt, count(*)
+#   FROM 'Data_normalized/drugs/*/*.parquet' d
+#   JOIN 'Data_normalized/reactions/*/*.parquet' r USING (shard, safetyreportid)
+#   GROUP BY ALL
+NORMALIZED_DIR = 'Data_normalized'
+
+REPORTS = 'reports'
+DRUGS = 'drugs'
+REACTIONS = 'reactions'
+
+# Columns repeated on every child row: the join key and the partitioning date
+KEY_FIELDS = [DRUG_EVENT_SCHEMA.field('safetyreportid'), DRUG_EVENT_SCHEMA.field('receivedate')]
+
+# String columns that also get an int32 id column from a global vocabulary
+# (see vocab): table -> [(column, vocabulary, id column)]
+ENCODED_COLUMNS = {
+    REPORTS: [
+        ('occurcountry', 'country', 'occurcountry_id'),
+        ('primarysourcecountry', 'country', 'primarysourcecountry_id'),
+        ('reportercountry', 'country', 'reportercountry_id'),
+    ],
+    DRUGS: [('medicinalproduct', 'drug', 'drug_id')],
+    REACTIONS: [('reactionmeddrapt', 'reaction', 'reaction_id')],
+}
+
+
+def _leaf_fields(struct_type):
+    """
+    Fields of a struct with nested structs flattened into their leaves.
+    Leaf names are unique across the drug-event structs, so no prefix is needed.
+    """
+    fields = []
+    for field in struct_type:
+        if pa.types.is_struct(field.type):
+            fields.extend(_leaf_fields(field.type))
+        else:
+            fields.append(field)
+    return fields
+
+
+def _leaf_arrays(struct_array):
+    """
+    Child arrays of a StructArray matching _leaf_fields, with the nulls of
+    every enclosing struct carried down to the leaves.
+    """
+    arrays = []
+    for field, child in zip(struct_array.type, struct_array.flatten()):
+        if pa.types.is_struct(field.type):
+            arrays.extend(_leaf_arrays(child))
+        else:
+            arrays.append(child)
+    return arrays
+
+
+def _report_fields(schema):
+    """
+    Fields of the report table: every scalar field plus the leaves of every
+    struct, leaving out the drug and reaction lists.
+    """
+    fields = []
+    for field in schema:
+        if pa.types.is_struct(field.type):
+            fields.extend(leaf for leaf in _leaf_fields(field.type) if not pa.types.is_list(leaf.type))
+        else:
+            fields.append(field)
+    return fields
+
+
+def _report_arrays(batch):
+    """
+    Arrays of a record batch matching _report_fields(batch.schema).
+    """
+    arrays = []
+    for field, array in zip(batch.schema, batch.columns):
+        if pa.types.is_struct(field.type):
+            arrays.extend(leaf_array for leaf, leaf_array in zip(_leaf_fields(field.type), _leaf_arrays(array))
+                          if not pa.types.is_list(leaf.type))
+        else:
+            arrays.append(array)
+    return arrays
+
+
+def _id_fields(table):
+    return [pa.field(id_column, pa.int32()) for _, _, id_column in ENCODED_COLUMNS[table]]
+
+
+REPORTS_SCHEMA = pa.schema(
+    _report_fields(DRUG_EVENT_SCHEMA) + [pa.field('drug_count', pa.int32()), pa.field('reaction_count', pa.int32())]
+    + _id_fields(REPORTS),
+    metadata=DRUG_EVENT_SCHEMA.metadata,
+)
+DRUGS_SCHEMA = pa.schema(
+    KEY_FIELDS + [pa.field('drug_index', pa.int32())] + _leaf_fields(DRUG_TYPE) + _id_fields(DRUGS),
+    metadata=DRUG_EVENT_SCHEMA.metadata,
+)
+REACTIONS_SCHEMA = pa.schema(
+    KEY_FIELDS + [pa.field('reaction_index', pa.int32())] + _leaf_fields(REACTION_TYPE) + _id_fields(REACTIONS),
+    metadata=DRUG_EVENT_SCHEMA.metadata,
+)
+
+TABLE_SCHEMAS = {REPORTS: REPORTS_SCHEMA, DRUGS: DRUGS_SCHEMA, REACTIONS: REACTIONS_SCHEMA}
+
+
+def _encode(table, columns, vocabulary):
+    """
+    Id arrays for the ENCODED_COLUMNS of one table, in schema order.
+    """
+    names = [field.name for field in TABLE_SCHEMAS[table]]
+    return [vocabulary.encode(name, columns[names.index(column)]) for column, name, _ in ENCODED_COLUMNS[table]]
+
+
+def _child_batch(batch, lists, table, vocabulary):
+    """
+    Explode a list-of-struct column into one row per element, keyed by the
+    parent's safetyreportid and receivedate and numbered by list position.
+    """
+    parents = pc.list_parent_indices(lists)
+    items = pc.list_flatten(lists)
+    offsets = lists.offsets.to_numpy()
+    positions = np.arange(len(items), dtype=np.int32) + offsets[0] - offsets[parents.to_numpy()]
+    columns = [
+        pc.take(batch.column('safetyreportid'), parents),
+        pc.take(batch.column('receivedate'), parents),
+        pa.array(positions, pa.int32()),
+    ] + _leaf_arrays(items)
+    columns += _encode(table, columns, vocabulary)
+    return pa.RecordBatch.from_arrays(columns, schema=TABLE_SCHEMAS[table])
+
+
+def normalize_batch(batch, vocabulary=None):
+    """
+    Split a record batch with DRUG_EVENT_SCHEMA into the reports, drugs and
+    reactions tables, using vectorized list flattening rather than per-record
+    Python. Drug, reaction and country columns also get id columns from the
+    global vocabularies (the worker's own connection unless one is given).
+
+    Returns:
+        dict: Table name -> RecordBatch.
+    """
+    if vocabulary is None:
+        vocabulary = get_vocabulary()
+    patient = batch.column('patient')
+    patient_fields = dict(zip((field.name for field in patient.type), patient.flatten()))
+    drugs = patient_fields['drug']
+    reactions = patient_fields['reaction']
+
+    columns = _report_arrays(batch)
+    columns.append(pc.fill_null(pc.list_value_length(drugs), 0).cast(pa.int32()))
+    columns.append(pc.fill_null(pc.list_value_length(reactions), 0).cast(pa.int32()))
+    columns += _encode(REPORTS, columns, vocabulary)
+    reports = pa.RecordBatch.from_arrays(columns, schema=REPORTS_SCHEMA)
+
+    return {
+        REPORTS: reports,
+        DRUGS: _child_batch(batch, drugs, DRUGS, vocabulary),
+        REACTIONS: _child_batch(batch, reactions, REACTIONS, vocabulary),
+    }
+
+
+class NormalizedDatasetWriter:
+    """
+    Writes the normalized tables of one source shard, each as its own
+    month-partitioned dataset under `output_dir` (see PartitionedDatasetWriter),
+    with the same file name so reruns overwrite them together.
+    """
+
+    def __init__(self, output_dir, file_name, shard):
+        self.writers = {
+            table: PartitionedDatasetWriter(os.path.join(output_dir, table), file_name, schema, shard)
+            for table, schema in TABLE_SCHEMAS.items()
+        }
+
+    def write_batch(self, batch):
+        for table, table_batch in normalize_batch(batch).items():
+            self.writers[table].write_batch(table_batch)
+
+    def close(self):
+        """
+        Returns:
+            dict: Table name -> paths of the files written.
+        """
+        return {table: writer.close() for table, writer in self.writers.items()}
+
+    def abort(self):
+        for writer in self.writers.values():
+            writer.abort()
+
+
+def list_shard_files(normalized_dir=NORMALIZED_DIR):
+    """
+    Group the files of the normalized tables by the shards they hold rows of,
+    as listed in their footers (see parquet_dataset.SHARDS_KEY). A compacted
+    file is listed under every shard it holds, so readers select a shard's
+    rows with its SHARD_COLUMN. Compacted files still holding a shard's rows
+    from before it was converted again are left out.
+
+    Returns:
+        dict: Shard key -> {table name -> list of paths}
+    """
+    shards = {}
+    for table in (REPORTS, DRUGS, REACTIONS):
+        runs = {path: file_shards(path) for path in list_dataset_files(os.path.join(normalized_dir, table))}
+        current = {}
+        for path in sorted(runs, key=is_compacted):
+            for shard, run in runs[path].items():
+                current.setdefault(shard, run)
+        for path, file_runs in runs.items():
+            for shard, run in file_runs.items():
+                if run == current[shard]:
+                    shards.setdefault(shard, {}).setdefault(table, []).append(path)
+    return shards
+
+
+def shard_fingerprint(files):
+    """
+    Size and modification time of every file of a shard, so a reconverted
+    shard is picked up again.
+    """
+    parts = []
+    for table in sorted(files):
+        for path in sorted(files[table]):
+            stat = os.stat(path)
+            parts.append(f"{table}/{os.path.basename(os.path.dirname(path))}:{stat.st_size}:{stat.st_mtime_ns}")
+    return hashlib.sha1("\n".join(parts).encode()).hexdigest()
@@ -1,75 +1,284 @@
 import os
+import time
+import random
+import hashlib
+import threading
 import requests
+from requests.adapters import HTTPAdapter
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from catalog import CATALOG_PATH, legacy_file_name, load_catalog, select_entries
+from manifest import Manifest, shard_key
+from metrics import print_summary, start_run, track
 
-def download_file(link, line_number, data_folder, max_size_bytes, total_downloaded_size):
-    try:
-        link = link.strip()
-        if not link:
-            return 0  # Skip empty lines
-
-        # Print progress message at the start of download
-        print(f"Starting download for file {line_number}: {link}")
-
-        response = requests.get(link, stream=True)
-        response.raise_for_status()  # Check for request errors
-
-        # Get the filename from the link or use a default naming scheme
-        filename = str(line_number)+"-"+os.path.basename(link) or f'file_{line_number}.html'
-        file_path = os.path.join(data_folder, filename)
-
-        # Write the content to the file in chunks and track the size
-        file_size = 0
-        with open(file_path, 'wb') as output_file:
-            for chunk in response.iter_content(chunk_size=1024 * 1024):  # 1 MB chunks
-                output_file.write(chunk)
-                file_size += len(chunk)
-                
-                # Stop if the cumulative size of all downloads exceeds the limit
-                if total_downloaded_size[0] + file_size > max_size_bytes:
-                    print(f"Reached the 50GB limit. Stopping downloads.")
-                    return file_size  # Return the file size even if interrupted early
-
-        print(f'Completed download for file {line_number}: {file_path}')
-        return file_size
-    except requests.RequestException as e:
-        print(f"Failed to download {link}: {e}")
-        return 0
-
-def download_links_parallel(link_file, start_line, end_line, max_size_gb=50, max_workers=20):
+# Name of this stage in the ingestion manifest
+STAGE = 'download'
+
+# Retry policy: attempts per file and the base of the exponential backoff in seconds
+MAX_ATTEMPTS = 5
+BACKOFF_SECONDS = 1.0
+
+CHUNK_SIZE = 1024 * 1024  # 1 MB chunks
+TIMEOUT_SECONDS = (10, 60)  # (connect, read)
+
+# Suffix of a partially downloaded file; it is resumed with an HTTP Range request
+PART_SUFFIX = '.part'
+
+
+class ByteBudget:
+    """
+    Global download budget shared by all worker threads. Bytes are reserved
+    before a chunk is written, so the limit holds even while many downloads
+    are in flight.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.full = False
+        self.lock = threading.Lock()
+
+    def reserve(self, num_bytes):
+        """
+        Reserve `num_bytes`; returns False (reserving nothing) if that would
+        exceed the budget.
+        """
+        with self.lock:
+            if self.used + num_bytes > self.max_bytes:
+                self.full = True  # Stop starting new work once a chunk no longer fits
+                return False
+            self.used += num_bytes
+            return True
+
+    @property
+    def exhausted(self):
+        with self.lock:
+            return self.full or self.used >= self.max_bytes
+
+
+_thread_local = threading.local()
+
+
+def make_session(pool_size=10):
+    """
+    Session with a keep-alive connection pool. It does not retry on its own:
+    download_one retries every failure itself, resuming from the partial file.
+    """
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session():
+    """
+    One pooled session per worker thread, reused across all its downloads.
+    """
+    if not hasattr(_thread_local, 'session'):
+        _thread_local.session = make_session()
+    return _thread_local.session
+
+
+def _hash_existing(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(block)
+    return digest
+
+
+def download_file(link, file_path, budget, max_attempts=MAX_ATTEMPTS, backoff=BACKOFF_SECONDS, checksum=None):
+    """
+    download_one with its wall time, size and outcome recorded in the metrics
+    file (see metrics). Same parameters and return value.
+    """
+    with track(STAGE, link) as m:
+        result = download_one(link, file_path, budget, max_attempts, backoff, checksum)
+        m.bytes_out = result["bytes"]
+        if result["status"] != "done":
+            m.error = result["error"] or f"Stopped: {result['status']}"
+    return result
+
+
+def download_one(link, file_path, budget, max_attempts=MAX_ATTEMPTS, backoff=BACKOFF_SECONDS, checksum=None):
+    """
+    Download one link to `file_path`.
+
+    Data is written to '<file_path>.part', resumed with an HTTP Range request
+    after a dropped connection (and on the next run), and renamed into place
+    only once complete. Failed attempts are retried with exponential backoff.
+
+    Parameters:
+        link (str): URL to download.
+        file_path (str): Final path of the downloaded file.
+        budget (ByteBudget): Global byte budget shared by all downloads.
+        max_attempts (int): Attempts before giving up on the file.
+        backoff (float): Base delay in seconds, doubled after every failed attempt.
+        checksum (str): Expected SHA-256 from the catalog, if it lists one. A
+            mismatching file is discarded and counts as failed.
+
+    Returns:
+        dict: {"link", "path", "bytes", "sha256", "status", "error"} where status
+        is 'done', 'budget' (stopped by the byte budget) or 'failed'.
+    """
+    part_path = file_path + PART_SUFFIX
+    result = {"link": link, "path": file_path, "bytes": 0, "sha256": None, "status": "failed", "error": None}
+    if budget.exhausted:
+        result["status"] = "budget"
+        return result
+
+    for attempt in range(max_attempts):
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+        try:
+            with get_session().get(link, stream=True, headers=headers, timeout=TIMEOUT_SECONDS) as response:
+                if offset and response.status_code == 416:
+                    # The partial file already holds the whole resource
+                    expected = offset
+                    digest = _hash_existing(part_path)
+                else:
+                    response.raise_for_status()
+                    if offset and response.status_code != 206:
+                        offset = 0  # Server ignored the Range header; start over
+                    content_length = response.headers.get('Content-Length')
+                    expected = offset + int(content_length) if content_length is not None else None
+                    digest = _hash_existing(part_path) if offset else hashlib.sha256()
+
+                    with open(part_path, 'ab' if offset else 'wb') as output_file:
+                        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                            if not budget.reserve(len(chunk)):
+                                print(f"Download budget reached, pausing {link} at {offset} bytes.")
+                                result.update(bytes=offset, status="budget")
+                                return result
+                            output_file.write(chunk)
+                            digest.update(chunk)
+                            offset += len(chunk)
+
+            if expected is not None and offset != expected:
+                raise requests.ConnectionError(f"Received {offset} of {expected} bytes")
+            if checksum and digest.hexdigest() != checksum.lower():
+                os.remove(part_path)
+                result["error"] = f"SHA-256 {digest.hexdigest()} does not match the catalog's {checksum}"
+                break
+            os.replace(part_path, file_path)
+            result.update(bytes=offset, sha256=digest.hexdigest(), status="done")
+            return result
+        except requests.RequestException as e:
+            result["error"] = str(e)
+            status = getattr(e.response, 'status_code', None) if isinstance(e, requests.HTTPError) else None
+            if status is not None and 400 <= status < 500 and status != 429:
+                break  # Retrying will not help
+            if attempt + 1 < max_attempts:
+                delay = backoff * (2 ** attempt) * (1 + random.random() / 2)
+                print(f"Attempt {attempt + 1} for {link} failed ({e}); retrying in {delay:.1f}s")
+                time.sleep(delay)
+
+    print(f"Failed to download {link}: {result['error']}")
+    return result
+
+
+def adopt_legacy_download(entry, file_path, data_folder, manifest):
+    """
+    Rename a complete download kept under the old line-number name (see
+    catalog.legacy_file_name) to the shard's stable name and carry its
+    manifest record over, so it isn't fetched again.
+
+    Returns:
+        bool: True if a file was renamed.
+    """
+    legacy_path = os.path.join(data_folder, legacy_file_name(entry))
+    legacy_shard = shard_key(legacy_path, data_folder)
+    if (os.path.exists(file_path) or not os.path.exists(legacy_path)
+            or not manifest.is_done(legacy_shard, STAGE, entry["url"])):
+        return False
+    os.rename(legacy_path, file_path)
+    known = manifest.get_shard(legacy_shard) or {}
+    shard = shard_key(file_path, data_folder)
+    manifest.record_shard(shard, source_url=entry["url"], size=known.get("size"), content_hash=known.get("content_hash"))
+    manifest.mark_done(shard, STAGE, entry["url"])
+    return True
+
+
+def plan_downloads(entries, data_folder, manifest):
+    """
+    Split catalog entries (see catalog.select_entries) into shards still to
+    download and shards whose file is already complete, keeping their order
+    (largest first). Files are named after their quarter and shard.
+
+    Returns:
+        tuple: (pending, completed), each a list of (link, file_path, shard, checksum).
+    """
+    pending, completed = [], []
+    renamed = 0
+    for entry in entries:
+        link = entry["url"]
+        file_path = os.path.join(data_folder, entry["name"])
+        renamed += adopt_legacy_download(entry, file_path, data_folder, manifest)
+        shard = shard_key(file_path, data_folder)
+        known = manifest.get_shard(shard)
+        # Skip shards whose file was already downloaded completely
+        if (manifest.is_done(shard, STAGE, link) and known and os.path.exists(file_path)
+                and os.path.getsize(file_path) == known["size"]):
+            completed.append((link, file_path, shard, entry["checksum"]))
+        else:
+            pending.append((link, file_path, shard, entry["checksum"]))
+    if renamed:
+        print(f"Renamed {renamed} downloads from line-number names to quarter/shard names; "
+              f"outputs converted under the old names should be rebuilt.")
+    return pending, completed
+
+
+def record_download(manifest, shard, result):
+    """
+    Record the outcome of download_file in the manifest.
+    """
+    if result["status"] == "done":
+        manifest.record_shard(shard, source_url=result["link"], size=result["bytes"], content_hash=result["sha256"])
+        manifest.mark_done(shard, STAGE, result["link"])
+    elif result["status"] == "failed":
+        manifest.mark_failed(shard, STAGE, result["link"], result["error"])
+
+
+def download_links_parallel(catalog_path=CATALOG_PATH, quarters=None, start=None, end=None, max_size_gb=50,
+                            max_workers=20, data_folder='Data'):
+    """
+    Download the shards of the catalog selected by quarter or date range (see
+    catalog.select_entries), largest first, within a global byte budget.
+    """
     # Ensure the Data folder exists
-    data_folder = 'Data'
     if not os.path.exists(data_folder):
         os.makedirs(data_folder)
 
-    # Convert max_size to bytes for comparison
-    max_size_bytes = max_size_gb * (1024 ** 3)
-    total_downloaded_size = [0]  # Using a list for mutable tracking in threads
-
-    # Read the link file and get the specified range of lines
-    with open(link_file, 'r', encoding='utf-8') as file:
-        links = file.readlines()
+    # Global byte budget enforced across all threads
+    budget = ByteBudget(max_size_gb * (1024 ** 3))
 
-    # Adjust end_line to not exceed the number of lines in the file
-    end_line = min(end_line, len(links))
-
-    # Prepare links and line numbers for the specified range
-    links_to_download = [(links[i - 1], i) for i in range(start_line, end_line + 1)]
+    entries = select_entries(load_catalog(catalog_path), quarters, start, end)
+    manifest = Manifest()
+    pending, completed = plan_downloads(entries, data_folder, manifest)
+    expected = sum(entry["size"] or 0 for entry in entries) / 1024 ** 3
+    print(f"{len(entries)} shards selected (about {expected:.1f} GB): "
+          f"{len(completed)} already downloaded, {len(pending)} to download.")
 
     # Use ThreadPoolExecutor to parallelize downloads
+    run_id = start_run(STAGE)
+    counts = {"done": 0, "budget": 0, "failed": 0}
     with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = [executor.submit(download_file, link, line_number, data_folder, max_size_bytes, total_downloaded_size)
-                   for link, line_number in links_to_download]
+        futures = {executor.submit(download_file, link, file_path, budget, checksum=checksum): shard
+                   for link, file_path, shard, checksum in pending}
 
         for future in as_completed(futures):
-            downloaded_size = future.result()
-            total_downloaded_size[0] += downloaded_size
+            shard = futures[future]
+            result = future.result()
+            counts[result["status"]] += 1
+            record_download(manifest, shard, result)
+    manifest.close()
 
-            # Stop all tasks if the size limit is reached
-            if total_downloaded_size[0] >= max_size_bytes:
-                print("Download limit reached. Cancelling remaining downloads.")
-                break
+    print(f"Downloads: {counts['done']} completed, {counts['budget']} stopped by the "
+          f"{max_size_gb} GB budget, {counts['failed']} failed; {budget.used / 1024 ** 3:.2f} GB downloaded.")
+    print_summary(run_id)
+    return counts
 
 # Usage example:
-# Specify the file with links, range of lines, and number of parallel downloads
-download_links_parallel('output_links.txt', 1, 1568, max_size_gb=100, max_workers=50)
+# Select the quarters (or a date range) from the download index and the number of parallel downloads
+if __name__ == "__main__":
+    download_links_parallel(CATALOG_PATH, quarters=None, start=None, end=None, max_size_gb=100, max_workers=50)
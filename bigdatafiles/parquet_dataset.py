@@ -0,0 +1,258 @@
+import os
+import glob
+import json
+import uuid
+import tempfile
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from shard_sources import relative_source_path
+
+# Hive-style partition directory for the month a report was received, e.g.
+# 'receive_month=2004-03'. A separate name keeps it from shadowing the
+# `receivedate` column when readers enable hive partitioning.
+PARTITION_KEY = 'receive_month'
+UNKNOWN_PARTITION = 'unknown'
+
+# Parquet layout settings. A row group is only flushed once this many rows have
+# accumulated for a partition, so small record batches don't become tiny row groups.
+ROW_GROUP_SIZE = 128 * 1024
+DATA_PAGE_SIZE = 1024 * 1024
+COMPRESSION = 'snappy'
+
+# Every file carries the key of the shard each row came from (see
+# manifest.shard_key) in SHARD_COLUMN, and lists in its footer metadata under
+# SHARDS_KEY the shards it holds, each with the id of the writer run that
+# converted it. A file merged by compact_parquet is named
+# 'compacted-<digest>.parquet', holds the rows of several shards and also
+# lists the files it was merged from (COMPACTED_INPUTS_KEY). A shard whose id
+# in a compacted file differs from its id in its own files was converted again
+# since, and its rows there are stale (see drop_stale_rows).
+SHARD_COLUMN = 'shard'
+SHARDS_KEY = b'shards'
+COMPACTED_PREFIX = 'compacted-'
+COMPACTED_INPUTS_KEY = b'compacted_inputs'
+
+
+def dataset_file_name(source, root_dir):
+    """
+    Deterministic Parquet file name for a source shard, built from its path
+    relative to the input root, e.g.
+    '18-drug-event-0003-of-0005.json/drug-event-0003-of-0005.json' becomes
+    '18-drug-event-0003-of-0005_drug-event-0003-of-0005.parquet'.
+    Rerunning a shard therefore overwrites its previous output.
+    """
+    relative_path = relative_source_path(source, root_dir)
+    parts = [os.path.splitext(part)[0] for part in relative_path.split(os.sep)]
+    return "_".join(parts) + '.parquet'
+
+
+def partition_values(batch, date_column='receivedate'):
+    """
+    Compute the 'YYYY-MM' partition value of every row from a date column
+    (date32, or YYYYMMDD strings in files written before the schema was
+    typed); rows with a missing or malformed date get UNKNOWN_PARTITION.
+    """
+    dates = batch.column(date_column)
+    if pa.types.is_date(dates.type):
+        return pc.fill_null(pc.strftime(dates, format='%Y-%m'), UNKNOWN_PARTITION)
+    valid = pc.fill_null(pc.match_substring_regex(dates, r'^\d{6}'), False)
+    months = pc.binary_join_element_wise(
+        pc.utf8_slice_codeunits(dates, 0, 4),
+        pc.utf8_slice_codeunits(dates, 4, 6),
+        '-',
+    )
+    return pc.if_else(valid, months, UNKNOWN_PARTITION)
+
+
+def list_dataset_files(output_dir):
+    """
+    Parquet files of every partition of a dataset, without temporary files.
+    """
+    return sorted(glob.glob(os.path.join(output_dir, f"{PARTITION_KEY}=*", "*.parquet")))
+
+
+def is_compacted(path):
+    return os.path.basename(path).startswith(COMPACTED_PREFIX)
+
+
+def file_shards(path):
+    """
+    Shard key -> writer run id of every shard with rows in a file, read from
+    its footer; empty for files written before the shard column.
+    """
+    metadata = pq.read_metadata(path).metadata or {}
+    return json.loads(metadata[SHARDS_KEY]) if SHARDS_KEY in metadata else {}
+
+
+def compacted_inputs(path):
+    """
+    Names of the files a compacted file was merged from.
+    """
+    metadata = pq.read_metadata(path).metadata or {}
+    return json.loads(metadata.get(COMPACTED_INPUTS_KEY, b'[]'))
+
+
+def rewrite_without_shards(path, shards):
+    """
+    Rewrite a file without the rows of `shards`, a row group at a time,
+    through a uniquely named temporary file in the same partition, or delete
+    it if nothing else is left.
+
+    Returns:
+        int: Number of rows removed.
+    """
+    parquet_file = pq.ParquetFile(path)
+    footer = {key: value for key, value in (parquet_file.metadata.metadata or {}).items()
+              if key in (SHARDS_KEY, COMPACTED_INPUTS_KEY)}
+    remaining = {shard: run for shard, run in json.loads(footer.get(SHARDS_KEY, b'{}')).items()
+                 if shard not in shards}
+    footer[SHARDS_KEY] = json.dumps(remaining, sort_keys=True).encode()
+    unwanted = pa.array(sorted(shards), pa.string())
+    fd, temp_path = tempfile.mkstemp(prefix=f".{os.path.basename(path)}.", suffix='.tmp', dir=os.path.dirname(path))
+    os.close(fd)
+    kept = 0
+    try:
+        with pq.ParquetWriter(temp_path, parquet_file.schema_arrow, compression=COMPRESSION,
+                              data_page_size=DATA_PAGE_SIZE, write_statistics=True) as writer:
+            for row_group in range(parquet_file.num_row_groups):
+                table = parquet_file.read_row_group(row_group)
+                table = table.filter(pc.invert(pc.is_in(table.column(SHARD_COLUMN), unwanted)))
+                if table.num_rows:
+                    writer.write_table(table)
+                    kept += table.num_rows
+            writer.add_key_value_metadata(footer)
+        if kept:
+            os.replace(temp_path, path)
+        else:
+            os.remove(temp_path)
+            os.remove(path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return parquet_file.metadata.num_rows - kept
+
+
+def drop_stale_rows(output_dir):
+    """
+    Take the rows of shards converted again after compaction out of the
+    compacted files of a dataset, so they aren't counted twice. The footers
+    are read once for the whole dataset. Only one process may run this on a
+    dataset at a time: it runs once after a conversion run, in the process
+    that scheduled it, and at the start of compaction.
+
+    Returns:
+        int: Number of rows removed.
+    """
+    shards_by_file = {path: file_shards(path) for path in list_dataset_files(output_dir)}
+    current = {}
+    for path, shards in shards_by_file.items():
+        if not is_compacted(path):
+            current.update(shards)
+    removed = 0
+    for path, shards in shards_by_file.items():
+        stale = {shard for shard, run in shards.items() if shard in current and current[shard] != run}
+        if is_compacted(path) and stale:
+            removed += rewrite_without_shards(path, stale)
+    return removed
+
+
+class PartitionedDatasetWriter:
+    """
+    Writes the record batches of one source shard into a month-partitioned
+    dataset, one file per partition the shard touches:
+
+        <output_dir>/receive_month=YYYY-MM/<file_name>
+
+    Every row gets the shard key in SHARD_COLUMN, and every file lists the
+    shard and the id of this run under SHARDS_KEY. Files are written under a
+    temporary name and renamed into place on close, and copies of `file_name`
+    left in other partitions by earlier runs are removed, so rerunning a shard
+    is idempotent. Its earlier rows inside compacted files are left for
+    drop_stale_rows, run once after the conversion run.
+    """
+
+    def __init__(self, output_dir, file_name, schema, shard, row_group_size=ROW_GROUP_SIZE,
+                 data_page_size=DATA_PAGE_SIZE, compression=COMPRESSION):
+        self.output_dir = output_dir
+        self.file_name = file_name
+        self.schema = schema.append(pa.field(SHARD_COLUMN, pa.string()))
+        self.shard = shard
+        self.run_id = uuid.uuid4().hex
+        self.row_group_size = row_group_size
+        self.data_page_size = data_page_size
+        self.compression = compression
+        self.writers = {}
+        self.pending = {}
+
+    def partition_dir(self, value):
+        return os.path.join(self.output_dir, f"{PARTITION_KEY}={value}")
+
+    def _temp_path(self, value):
+        return os.path.join(self.partition_dir(value), f".{self.file_name}.tmp")
+
+    def _flush(self, value, force=False):
+        batches = self.pending.get(value)
+        rows = sum(batch.num_rows for batch in batches) if batches else 0
+        if not rows or (rows < self.row_group_size and not force):
+            return
+        if value not in self.writers:
+            os.makedirs(self.partition_dir(value), exist_ok=True)
+            self.writers[value] = pq.ParquetWriter(
+                self._temp_path(value),
+                self.schema,
+                compression=self.compression,
+                data_page_size=self.data_page_size,
+                write_statistics=True,
+            )
+        table = pa.Table.from_batches(batches, schema=self.schema)
+        self.writers[value].write_table(table, row_group_size=self.row_group_size)
+        self.pending[value] = []
+
+    def write_batch(self, batch):
+        """
+        Route the rows of a record batch to their partitions.
+        """
+        values = partition_values(batch)
+        batch = batch.append_column(SHARD_COLUMN, pa.array([self.shard] * batch.num_rows, pa.string()))
+        for value in pc.unique(values).to_pylist():
+            part = batch.filter(pc.equal(values, value))
+            self.pending.setdefault(value, []).append(part)
+            self._flush(value)
+
+    def close(self):
+        """
+        Flush remaining rows, move finished files into place and drop stale
+        copies from partitions this run did not write.
+
+        Returns:
+            list: Paths of the files written.
+        """
+        for value in list(self.pending):
+            self._flush(value, force=True)
+        shards = json.dumps({self.shard: self.run_id}).encode()
+        for writer in self.writers.values():
+            writer.add_key_value_metadata({SHARDS_KEY: shards})
+            writer.close()
+        paths = []
+        for value in self.writers:
+            path = os.path.join(self.partition_dir(value), self.file_name)
+            os.replace(self._temp_path(value), path)
+            paths.append(path)
+        self.writers = {}
+        self.pending = {}
+        for path in glob.glob(os.path.join(self.output_dir, f"{PARTITION_KEY}=*", self.file_name)):
+            if path not in paths:
+                os.remove(path)
+        return paths
+
+    def abort(self):
+        """
+        Discard everything written so far, leaving earlier outputs untouched.
+        """
+        for value, writer in self.writers.items():
+            writer.close()
+            os.remove(self._temp_path(value))
+        self.writers = {}
+        self.pending = {}
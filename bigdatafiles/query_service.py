@@ -0,0 +1,363 @@
+import os
+import re
+import sys
+import glob
+import queue
+import argparse
+import threading
+import time
+import hashlib
+from collections import OrderedDict
+from contextlib import contextmanager
+import duckdb
+import pandas as pd
+from dedupe import DEDUPE_DIR, DROPPED
+from manifest import MANIFEST_PATH, Manifest
+from normalized_tables import NORMALIZED_DIR, REPORTS, DRUGS, REACTIONS
+from parquet_dataset import PARTITION_KEY
+from term_index import INDEX_PATH, lookup, read_matching, update_index
+
+# Nested drug-event dataset written by the conversion stage
+DATASET_DIR = 'Data_parquet'
+
+# Number of cached results and of pooled DuckDB cursors
+CACHE_SIZE = 128
+POOL_SIZE = 4
+
+# View name -> (dataset under the roots below, country column it can be filtered on).
+# Drugs and reactions have no country; they are filtered through their reports.
+VIEWS = {
+    'drug_events': ('dataset', 'occurcountry'),
+    REPORTS: (REPORTS, 'occurcountry'),
+    DRUGS: (DRUGS, None),
+    REACTIONS: (REACTIONS, None),
+}
+
+_QUOTED = re.compile(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")")
+
+
+def normalize_sql(sql):
+    """
+    Cache key form of a query: whitespace collapsed and the trailing semicolon
+    dropped outside quoted literals and identifiers, keywords lower-cased.
+    """
+    parts = []
+    for i, part in enumerate(_QUOTED.split(sql.strip().rstrip(';'))):
+        parts.append(part if i % 2 else re.sub(r'\s+', ' ', part).lower())
+    return "".join(parts).strip()
+
+
+def _month_in_range(month, start_month, end_month):
+    if month == 'unknown':
+        return start_month is None and end_month is None
+    return (start_month is None or month >= start_month) and (end_month is None or month <= end_month)
+
+
+def _quote(value):
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def _file_list(paths):
+    return "[" + ", ".join(_quote(path) for path in paths) + "]"
+
+
+class QueryService:
+    """
+    Warm DuckDB connection over the Parquet lake.
+
+    The views drug_events, reports, drugs and reactions are registered once
+    over the partition files, which are listed again only when the data
+    changes. Queries run on a small pool of cursors. A query may be restricted
+    to a range of receive months and a set of countries. The month range
+    prunes whole partition directories before DuckDB opens any file. The
+    country filter is pushed into the view, where DuckDB checks it against
+    row-group statistics; drugs and reactions keep the rows whose report
+    passes it.
+
+    The reports, drugs and reactions views leave out the report versions that
+    dedupe superseded, anti-joining each shard's dropped/<shard>.parquet list.
+
+    Results are cached by normalized SQL, filters and the data version (the
+    manifest version plus the path, size and modification time of every
+    dataset file and dropped list), with least-recently-used eviction, so new
+    data invalidates them.
+    """
+
+    def __init__(self, dataset_dir=DATASET_DIR, normalized_dir=NORMALIZED_DIR, manifest_path=MANIFEST_PATH,
+                 cache_size=CACHE_SIZE, pool_size=POOL_SIZE, index_path=INDEX_PATH, dedupe_dir=DEDUPE_DIR):
+        self.index_path = index_path
+        self.index_version = None
+        self.roots = {'dataset': dataset_dir}
+        self.roots.update({table: os.path.join(normalized_dir, table) for table in (REPORTS, DRUGS, REACTIONS)})
+        self.dropped_dir = os.path.join(dedupe_dir, DROPPED)
+        self.dropped_files = []
+        self.manifest_path = manifest_path
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.conn = duckdb.connect()
+        self.pool = queue.Queue()
+        for _ in range(pool_size):
+            self.pool.put(self.conn.cursor())
+        self.version = None
+        self.partitions = {}
+        self.stats = {"hits": 0, "misses": 0, "row_groups_read": 0}
+
+    def close(self):
+        while not self.pool.empty():
+            self.pool.get().close()
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def data_version(self):
+        """
+        Changes whenever a stage completes or a file is added, removed or
+        rewritten in place (e.g. by compaction or a reconversion). Directory
+        modification times would miss the last.
+        """
+        manifest_version = None
+        if os.path.exists(self.manifest_path):
+            with Manifest(self.manifest_path) as manifest:
+                manifest_version = manifest.version()
+        patterns = [os.path.join(root, f"{PARTITION_KEY}=*", "*.parquet") for root in self.roots.values()]
+        patterns.append(os.path.join(self.dropped_dir, "*.parquet"))
+        listing = hashlib.sha1()
+        for path in sorted(path for pattern in patterns for path in glob.glob(pattern)):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            listing.update(f"{path}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+        return (manifest_version, listing.hexdigest())
+
+    def _list_partitions(self, root):
+        """
+        Partition month -> Parquet files of one dataset.
+        """
+        partitions = {}
+        for path in sorted(glob.glob(os.path.join(root, f"{PARTITION_KEY}=*", "*.parquet"))):
+            month = os.path.basename(os.path.dirname(path)).split('=', 1)[1]
+            partitions.setdefault(month, []).append(path)
+        return partitions
+
+    def _files(self, dataset, start_month=None, end_month=None):
+        """
+        Files of a dataset within the month range and whether any were left,
+        or (None, None) if the dataset has no files at all.
+        """
+        partitions = self.partitions.get(dataset) or {}
+        files = [path for month, paths in sorted(partitions.items())
+                 if _month_in_range(month, start_month, end_month) for path in paths]
+        if files:
+            return files, True
+        if not partitions:
+            return None, None
+        # Keep the columns but select nothing
+        return next(iter(partitions.values()))[:1], False
+
+    def _anti_join_dropped(self, alias):
+        """
+        Anti-join clause removing the report versions dedupe superseded from
+        the relation `alias`, matched on the shard column.
+        """
+        dropped = (f"SELECT shard, safetyreportid, safetyreportversion "
+                   f"FROM read_parquet({_file_list(self.dropped_files)})")
+        return (f"ANTI JOIN ({dropped}) d ON d.shard = {alias}.shard "
+                f"AND d.safetyreportid = {alias}.safetyreportid AND d.safetyreportversion = {alias}.safetyreportversion")
+
+    def _view_sql(self, view, start_month=None, end_month=None, countries=None):
+        dataset, country_column = VIEWS[view]
+        files, selected = self._files(dataset, start_month, end_month)
+        if files is None:
+            return None
+        conditions = [] if selected else ["false"]
+        in_countries = f"IN ({', '.join(_quote(c) for c in countries)})" if countries else None
+        if in_countries and country_column:
+            conditions.append(f"{country_column} {in_countries}")
+        source = f"read_parquet({_file_list(files)}, hive_partitioning = true, union_by_name = true"
+        report_files, _ = self._files(REPORTS, start_month, end_month)
+        if view in (DRUGS, REACTIONS) and in_countries and not report_files:
+            # No reports to take the countries from
+            conditions.append("false")
+        if view == REPORTS and self.dropped_files:
+            # Superseded versions are left out (see dedupe)
+            sql = f"SELECT x.* FROM {source}) x {self._anti_join_dropped('x')}"
+        elif view in (DRUGS, REACTIONS) and (self.dropped_files or in_countries) and report_files:
+            # Child rows carry no version or country, so like rollups keep
+            # those whose report still has a kept version in the same shard,
+            # from one of the countries
+            kept = f"SELECT r.shard, r.safetyreportid FROM read_parquet({_file_list(report_files)}) r"
+            if self.dropped_files:
+                kept += f" {self._anti_join_dropped('r')}"
+            if in_countries:
+                kept += f" WHERE r.{VIEWS[REPORTS][1]} {in_countries}"
+            sql = (f"SELECT x.* FROM {source}) x "
+                   f"SEMI JOIN ({kept}) k ON k.shard = x.shard AND k.safetyreportid = x.safetyreportid")
+        else:
+            sql = f"SELECT * FROM {source})"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        return sql
+
+    def refresh(self):
+        """
+        Re-list the partitions and re-register the views if the data changed.
+
+        Returns:
+            The current data version.
+        """
+        version = self.data_version()
+        with self.lock:
+            if version != self.version:
+                self.partitions = {dataset: self._list_partitions(root) for dataset, root in self.roots.items()}
+                self.dropped_files = sorted(glob.glob(os.path.join(self.dropped_dir, "*.parquet")))
+                for view in VIEWS:
+                    view_sql = self._view_sql(view)
+                    if view_sql is None:
+                        self.conn.execute(f"DROP VIEW IF EXISTS {view}")
+                    else:
+                        self.conn.execute(f"CREATE OR REPLACE VIEW {view} AS {view_sql}")
+                self.cache.clear()
+                self.version = version
+        return version
+
+    @contextmanager
+    def _cursor(self):
+        cursor = self.pool.get()
+        try:
+            yield cursor
+        finally:
+            self.pool.put(cursor)
+
+    def query(self, sql, start_month=None, end_month=None, countries=None, use_cache=True):
+        """
+        Run SQL against the views, returning a pandas DataFrame.
+
+        Parameters:
+            sql (str): Query over drug_events, reports, drugs and/or reactions.
+            start_month, end_month (str): Inclusive 'YYYY-MM' range of receive
+                months; partitions outside it are never opened.
+            countries (list): Keep only reports from these countries.
+            use_cache (bool): Reuse and store results in the cache.
+
+        Returns:
+            pandas.DataFrame: The result. Cached results are shared, so treat
+            them as read-only.
+        """
+        version = self.refresh()
+        countries = tuple(sorted(countries)) if countries else None
+        key = (normalize_sql(sql), start_month, end_month, countries, version)
+        if use_cache:
+            with self.lock:
+                if key in self.cache:
+                    self.cache.move_to_end(key)
+                    self.stats["hits"] += 1
+                    return self.cache[key]
+                self.stats["misses"] += 1
+
+        with self._cursor() as cursor:
+            pruned = start_month is not None or end_month is not None or countries is not None
+            if pruned:
+                with self.lock:
+                    view_sqls = {view: self._view_sql(view, start_month, end_month, countries) for view in VIEWS}
+                for view, view_sql in view_sqls.items():
+                    if view_sql is not None:
+                        cursor.execute(f"CREATE OR REPLACE TEMP VIEW {view} AS {view_sql}")
+            try:
+                result = cursor.execute(sql).df()
+            finally:
+                if pruned:
+                    for view in VIEWS:
+                        cursor.execute(f"DROP VIEW IF EXISTS temp.{view}")
+
+        if use_cache:
+            with self.lock:
+                self.cache[key] = result
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return result
+
+    def reports_for(self, drug=None, reaction=None, start_month=None, end_month=None, use_cache=True):
+        """
+        Reports of the nested dataset mentioning a drug and/or a reaction term,
+        as a pandas DataFrame. The term index (see term_index) names the row
+        groups holding the terms, so only those are read instead of scanning
+        every file. The index is brought up to date first whenever the data
+        changed.
+        """
+        version = self.refresh()
+        key = ('reports_for', drug, reaction, start_month, end_month, version)
+        if use_cache:
+            with self.lock:
+                if key in self.cache:
+                    self.cache.move_to_end(key)
+                    self.stats["hits"] += 1
+                    return self.cache[key]
+                self.stats["misses"] += 1
+
+        with self.lock:
+            if self.index_version != version:
+                update_index(self.roots['dataset'], self.index_path)
+                self.index_version = version
+        locations = {
+            path: row_groups for path, row_groups in lookup(drug, reaction, self.index_path).items()
+            if _month_in_range(os.path.basename(os.path.dirname(path)).split('=', 1)[1], start_month, end_month)
+        }
+        table = read_matching(locations, drug, reaction)
+        result = table.to_pandas() if table is not None else pd.DataFrame()
+        with self.lock:
+            self.stats["row_groups_read"] += sum(len(row_groups) for row_groups in locations.values())
+            if use_cache:
+                self.cache[key] = result
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return result
+
+
+def main(argv=None):
+    """
+    Command line entry point. Runs the given SQL, or reads one query per line
+    from stdin when none is given, keeping the connection and cache warm.
+    With --drug and/or --reaction, prints the matching reports found through
+    the term index instead.
+    """
+    parser = argparse.ArgumentParser(description="Query the drug-event Parquet lake with DuckDB.")
+    parser.add_argument('sql', nargs='?', help="SQL over drug_events, reports, drugs, reactions")
+    parser.add_argument('--start', help="first receive month, YYYY-MM")
+    parser.add_argument('--end', help="last receive month, YYYY-MM")
+    parser.add_argument('--country', action='append', help="restrict to a country (repeatable)")
+    parser.add_argument('--drug', help="look up the reports mentioning this drug")
+    parser.add_argument('--reaction', help="look up the reports mentioning this MedDRA reaction term")
+    parser.add_argument('--dataset-dir', default=DATASET_DIR)
+    parser.add_argument('--normalized-dir', default=NORMALIZED_DIR)
+    parser.add_argument('--dedupe-dir', default=DEDUPE_DIR, help="dedupe state whose dropped lists are applied")
+    args = parser.parse_args(argv)
+
+    with QueryService(args.dataset_dir, args.normalized_dir, dedupe_dir=args.dedupe_dir) as service:
+        if args.drug or args.reaction:
+            start = time.perf_counter()
+            result = service.reports_for(args.drug, args.reaction, args.start, args.end)
+            print(result.to_string(max_rows=50))
+            print(f"{len(result)} reports in {(time.perf_counter() - start) * 1000:.1f} ms "
+                  f"({service.stats['row_groups_read']} row groups read)")
+            return
+        queries = [args.sql] if args.sql else (line for line in sys.stdin if line.strip())
+        for sql in queries:
+            start = time.perf_counter()
+            try:
+                result = service.query(sql, args.start, args.end, args.country)
+            except duckdb.Error as e:
+                print(f"Query failed: {e}")
+                continue
+            print(result.to_string(max_rows=50))
+            print(f"{len(result)} rows in {(time.perf_counter() - start) * 1000:.1f} ms "
+                  f"(cache hits {service.stats['hits']}, misses {service.stats['misses']})")
+
+
+if __name__ == "__main__":
+    main()
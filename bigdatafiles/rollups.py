@@ -0,0 +1,365 @@
+import os
+import json
+import time
+import hashlib
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from manifest import Manifest
+from dedupe import DEDUPE_DIR, DROPPED, attach_dropped
+from normalized_tables import NORMALIZED_DIR, REPORTS, DRUGS, REACTIONS, list_shard_files, shard_fingerprint
+from parquet_dataset import SHARD_COLUMN, partition_values
+from vocab import normalize_terms
+
+# Where the cubes and the per-shard deltas they were built from are kept
+ROLLUP_DIR = 'Data_rollups'
+
+# Name of this stage in the ingestion manifest
+STAGE = 'rollup'
+
+# Dimensions shared by every cube; counts are numbers of distinct reports
+DIMENSIONS = ['year_month', 'country', 'serious']
+COUNT_COLUMN = 'reports'
+
+# Cube name -> its dimensions. 'pairs' counts reports that mention both the
+# drug and the reaction.
+CUBES = {
+    'reports': DIMENSIONS,
+    'drugs': ['drug'] + DIMENSIONS,
+    'reactions': ['reaction'] + DIMENSIONS,
+    'pairs': ['drug', 'reaction'] + DIMENSIONS,
+}
+
+# Metadata key of a cube mapping every shard it includes to that shard's fingerprint
+APPLIED_KEY = b'applied_shards'
+
+# Deltas folded into a cube per merge, which bounds memory when every shard
+# changed (first run, schema bump)
+MERGE_CHUNK = 64
+
+
+def cube_path(rollup_dir, cube):
+    return os.path.join(rollup_dir, f"{cube}.parquet")
+
+
+def delta_path(rollup_dir, cube, shard, fingerprint):
+    digest = hashlib.sha1(fingerprint.encode()).hexdigest()[:12]
+    return os.path.join(rollup_dir, 'deltas', cube, f"{shard}.{digest}.parquet")
+
+
+def _read(paths, columns, shard=None):
+    # Compacted files hold several shards; keep the rows of `shard` only
+    filters = [(SHARD_COLUMN, '=', shard)] if shard is not None else None
+    return pa.concat_tables(pq.read_table(path, columns=columns, filters=filters) for path in paths)
+
+
+def _report_dimensions(reports):
+    """
+    One row per report with the cube dimensions: 'YYYY-MM' of receivedate,
+    occurcountry (falling back to the primary source's country) and the
+    serious flag.
+    """
+    table = pa.table({
+        'safetyreportid': reports.column('safetyreportid'),
+        'year_month': partition_values(reports),
+        'country': pc.coalesce(reports.column('occurcountry'), reports.column('reportercountry')),
+        # An int8 code since the schema was typed; cubes keep the '1'/'2' strings
+        'serious': pc.cast(reports.column('serious'), pa.string()),
+    })
+    # A report listed twice in one shard is counted once
+    table = table.group_by(['safetyreportid'], use_threads=False).aggregate(
+        [(name, 'first') for name in DIMENSIONS]
+    )
+    return table.rename_columns({f"{name}_first": name for name in DIMENSIONS})
+
+
+def _count(table, keys):
+    counted = table.group_by(keys).aggregate([([], 'count_all')])
+    return counted.rename_columns({'count_all': COUNT_COLUMN}).select(keys + [COUNT_COLUMN])
+
+
+def _empty_cube(cube):
+    fields = [pa.field(name, pa.string()) for name in CUBES[cube]] + [pa.field(COUNT_COLUMN, pa.int64())]
+    return pa.schema(fields).empty_table()
+
+
+def _distinct_names(shard, files, table, column, name):
+    """
+    Distinct (safetyreportid, name) pairs of a child table, with names in the
+    canonical form of the `name` vocabulary (see vocab.normalize_terms).
+    """
+    if not files.get(table):
+        return pa.schema([pa.field('safetyreportid', pa.string()), pa.field(name, pa.string())]).empty_table()
+    rows = _read(files[table], ['safetyreportid', column], shard)
+    rows = pa.table({
+        'safetyreportid': rows.column('safetyreportid'),
+        name: normalize_terms(rows.column(column), name),
+    })
+    return rows.drop_null().group_by(['safetyreportid', name]).aggregate([])
+
+
+def compute_deltas(shard, files):
+    """
+    Count one shard's reports into every cube.
+
+    Parameters:
+        shard (str): Shard key, selecting the shard's rows in compacted files.
+        files (dict): Table name -> paths, as returned by list_shard_files,
+            plus the shard's superseded rows under DROPPED (see dedupe).
+
+    Returns:
+        dict: Cube name -> table of dimension columns and a report count.
+    """
+    if not files.get(REPORTS):
+        return {cube: _empty_cube(cube) for cube in CUBES}
+    reports = _read(files[REPORTS], ['safetyreportid', 'safetyreportversion', 'receivedate', 'occurcountry',
+                                     'reportercountry', 'serious'], shard)
+    if files.get(DROPPED):
+        # Versions superseded by a later one in another shard (see dedupe)
+        reports = reports.join(_read(files[DROPPED], ['safetyreportid', 'safetyreportversion']),
+                               ['safetyreportid', 'safetyreportversion'], join_type='left anti')
+    reports = _report_dimensions(reports)
+    drugs = _distinct_names(shard, files, DRUGS, 'medicinalproduct', 'drug')
+    reactions = _distinct_names(shard, files, REACTIONS, 'reactionmeddrapt', 'reaction')
+
+    drug_rows = drugs.join(reports, 'safetyreportid', join_type='inner')
+    reaction_rows = reactions.join(reports, 'safetyreportid', join_type='inner')
+    pair_rows = drugs.join(reaction_rows, 'safetyreportid', join_type='inner')
+    return {
+        'reports': _count(reports, CUBES['reports']),
+        'drugs': _count(drug_rows, CUBES['drugs']),
+        'reactions': _count(reaction_rows, CUBES['reactions']),
+        'pairs': _count(pair_rows, CUBES['pairs']),
+    }
+
+
+def merge_counts(tables, keys):
+    """
+    Sum counts over identical keys and drop rows whose count reaches zero.
+    """
+    tables = [table.select(keys + [COUNT_COLUMN]).cast(tables[0].select(keys + [COUNT_COLUMN]).schema)
+              for table in tables]
+    merged = pa.concat_tables(tables).group_by(keys).aggregate([(COUNT_COLUMN, 'sum')])
+    merged = merged.rename_columns({f"{COUNT_COLUMN}_sum": COUNT_COLUMN}).select(keys + [COUNT_COLUMN])
+    return merged.filter(pc.not_equal(merged.column(COUNT_COLUMN), 0))
+
+
+def _negate(table):
+    index = table.schema.get_field_index(COUNT_COLUMN)
+    return table.set_column(index, COUNT_COLUMN, pc.negate(table.column(COUNT_COLUMN)))
+
+
+def read_applied(rollup_dir, cube):
+    """
+    Shards (and their fingerprints) already counted into a cube.
+    """
+    path = cube_path(rollup_dir, cube)
+    if not os.path.exists(path):
+        return {}
+    return json.loads(pq.read_schema(path).metadata[APPLIED_KEY])
+
+
+def _write_atomic(table, path, metadata=None):
+    if metadata:
+        table = table.replace_schema_metadata(metadata)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = path + '.tmp'
+    pq.write_table(table, temp_path, compression='snappy')
+    os.replace(temp_path, path)
+
+
+def update_cube(rollup_dir, cube, applied, new_deltas, removed):
+    """
+    Fold changed shards into a cube: subtract the delta each shard contributed
+    last time, add its new delta, and subtract shards that no longer exist.
+    Deltas are read back from disk MERGE_CHUNK at a time.
+
+    The cube's metadata records which delta of every shard it includes and is
+    replaced atomically with the counts, so an interrupted update is simply
+    redone on the next run.
+
+    Parameters:
+        applied (dict): Shard -> fingerprint currently included in the cube.
+        new_deltas (dict): Shard -> fingerprint of the delta to include,
+            already written to its delta_path.
+        removed (list): Shards to take out of the cube.
+
+    Returns:
+        int: Number of cells in the updated cube.
+    """
+    keys = CUBES[cube]
+    path = cube_path(rollup_dir, cube)
+    merged = pq.read_table(path) if os.path.exists(path) else None
+    new_applied = dict(applied)
+    steps = []  # (sign, delta file)
+    for shard in list(new_deltas) + list(removed):
+        if shard in applied:
+            steps.append((-1, delta_path(rollup_dir, cube, shard, applied[shard])))
+            del new_applied[shard]
+    for shard, fingerprint in new_deltas.items():
+        steps.append((1, delta_path(rollup_dir, cube, shard, fingerprint)))
+        new_applied[shard] = fingerprint
+    if merged is None and not steps:
+        return 0
+
+    for i in range(0, max(len(steps), 1), MERGE_CHUNK):
+        parts = [merged] if merged is not None else []
+        for sign, delta_file in steps[i:i + MERGE_CHUNK]:
+            delta = pq.read_table(delta_file)
+            parts.append(delta if sign > 0 else _negate(delta))
+        merged = merge_counts(parts, keys)
+    merged = merged.sort_by([(COUNT_COLUMN, 'descending')] + [(key, 'ascending') for key in keys])
+    _write_atomic(merged, path, {APPLIED_KEY: json.dumps(new_applied, sort_keys=True).encode()})
+
+    # Deltas no longer referenced by the cube; a rerun after an interrupted
+    # cleanup finds some of them gone already
+    for shard, fingerprint in applied.items():
+        superseded = delta_path(rollup_dir, cube, shard, fingerprint)
+        if new_applied.get(shard) != fingerprint and os.path.exists(superseded):
+            os.remove(superseded)
+    return merged.num_rows
+
+
+# Cube path -> (mtime, table), so repeated queries don't reread the file
+_cube_cache = {}
+
+
+def load_cube(cube, rollup_dir=ROLLUP_DIR):
+    """
+    Read a cube, reusing the copy in memory until the file changes.
+    """
+    path = cube_path(rollup_dir, cube)
+    mtime = os.stat(path).st_mtime_ns
+    cached = _cube_cache.get(path)
+    if cached is None or cached[0] != mtime:
+        cached = _cube_cache[path] = (mtime, pq.read_table(path))
+    return cached[1]
+
+
+def query(cube, group_by, top=None, start_month=None, end_month=None, country=None, serious=None,
+          drug=None, reaction=None, rollup_dir=ROLLUP_DIR):
+    """
+    Total report counts of a cube over `group_by`, after filtering.
+
+    Parameters:
+        cube (str): One of CUBES.
+        group_by (list): Dimensions to keep; every other dimension is summed over.
+        top (int): Keep only the `top` largest groups.
+        start_month, end_month (str): Inclusive 'YYYY-MM' range.
+        country (str): Country code, e.g. 'US'.
+        serious (str): '1' for serious reports, '2' for non-serious ones.
+        drug, reaction (str): Restrict to one drug (upper case) or reaction.
+
+    Returns:
+        pandas.DataFrame: `group_by` columns and the report count, largest first
+        (in month order when grouping by month only).
+    """
+    table = load_cube(cube, rollup_dir)
+    mask = None
+    conditions = [
+        ('year_month', pc.greater_equal, start_month),
+        ('year_month', pc.less_equal, end_month),
+        ('country', pc.equal, country),
+        ('serious', pc.equal, serious),
+        ('drug', pc.equal, drug),
+        ('reaction', pc.equal, reaction),
+    ]
+    for column, compare, value in conditions:
+        if value is None:
+            continue
+        if column not in table.column_names:
+            raise ValueError(f"Cube {cube!r} has no {column!r} dimension")
+        condition = pc.fill_null(compare(table.column(column), value), False)
+        mask = condition if mask is None else pc.and_(mask, condition)
+    if mask is not None:
+        table = table.filter(mask)
+
+    result = table.group_by(group_by).aggregate([(COUNT_COLUMN, 'sum')])
+    result = result.rename_columns({f"{COUNT_COLUMN}_sum": COUNT_COLUMN}).select(group_by + [COUNT_COLUMN])
+    if group_by == ['year_month']:
+        result = result.sort_by('year_month')
+    else:
+        result = result.sort_by([(COUNT_COLUMN, 'descending')] + [(key, 'ascending') for key in group_by])
+    if top is not None:
+        result = result.slice(0, top)
+    return result.to_pandas()
+
+
+def top_drugs(n=10, **filters):
+    """
+    Drugs mentioned in the most reports.
+    """
+    return query('drugs', ['drug'], top=n, **filters)
+
+
+def top_reactions(n=10, **filters):
+    """
+    Most frequently reported reactions.
+    """
+    return query('reactions', ['reaction'], top=n, **filters)
+
+
+def reports_by_country(n=None, **filters):
+    """
+    Number of reports per country, largest first.
+    """
+    return query('reports', ['country'], top=n, **filters)
+
+
+def reports_over_time(**filters):
+    """
+    Number of reports received per month.
+    """
+    return query('reports', ['year_month'], **filters)
+
+
+def top_reactions_for_drug(drug, n=10, **filters):
+    """
+    Reactions reported most often together with `drug`.
+    """
+    return query('pairs', ['reaction'], top=n, drug=drug.strip().upper(), **filters)
+
+
+def main(normalized_dir=NORMALIZED_DIR, rollup_dir=ROLLUP_DIR, dedupe_dir=DEDUPE_DIR):
+    """
+    Bring every cube up to date with the normalized tables, reading only the
+    shards that changed since the cubes were last updated. Report versions
+    superseded in later shards are left out once dedupe.py has run; a shard
+    whose superseded rows change counts as changed.
+    """
+    start = time.perf_counter()
+    shard_files = attach_dropped(list_shard_files(normalized_dir), dedupe_dir)
+    fingerprints = {shard: shard_fingerprint(files) for shard, files in shard_files.items()}
+    applied = {cube: read_applied(rollup_dir, cube) for cube in CUBES}
+
+    changed = sorted(shard for shard, fingerprint in fingerprints.items()
+                     if any(applied[cube].get(shard) != fingerprint for cube in CUBES))
+    removed = sorted({shard for cube in CUBES for shard in applied[cube]} - set(shard_files))
+    print(f"{len(shard_files)} shards, {len(changed)} new or changed, {len(removed)} removed.")
+    if not changed and not removed:
+        return
+
+    # Each shard's deltas go to disk before the next shard is read, so a full
+    # rebuild never holds the deltas of the whole history at once
+    deltas = {cube: {} for cube in CUBES}
+    for shard in changed:
+        for cube, delta in compute_deltas(shard, shard_files[shard]).items():
+            if applied[cube].get(shard) != fingerprints[shard]:
+                _write_atomic(delta, delta_path(rollup_dir, cube, shard, fingerprints[shard]))
+                deltas[cube][shard] = fingerprints[shard]
+
+    for cube in CUBES:
+        cells = update_cube(rollup_dir, cube, applied[cube], deltas[cube],
+                            [shard for shard in removed if shard in applied[cube]])
+        print(f"Cube {cube}: {len(deltas[cube])} shards merged, {cells} cells")
+
+    with Manifest() as manifest:
+        for shard in changed:
+            manifest.mark_done(shard, STAGE, fingerprints[shard])
+    print(f"Rollups updated in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
+    print(top_drugs(10))
+    print(top_reactions(10))
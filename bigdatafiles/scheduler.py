@@ -0,0 +1,202 @@
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from shard_sources import source_size
+
+# Share of the available RAM the stage workers may use together
+MEMORY_BUDGET_FRACTION = 0.6
+
+# Peak memory of loading a shard with json.load, as a multiple of its size
+# (Python objects take roughly ten times the JSON text)
+IN_MEMORY_FACTOR = 10
+
+# Working set of a worker on the streaming path, whatever the shard size:
+# one record, one record batch and the open Parquet writers
+STREAMING_MEMORY_MB = 512
+
+# Memory of an idle worker process (interpreter, pyarrow, pandas)
+WORKER_MEMORY_MB = 150
+
+# Shards at least this large are "huge"; at most MAX_HUGE_FILES of them run at
+# once so they don't crowd out the rest of the work or saturate the disk
+HUGE_FILE_GB = 1
+MAX_HUGE_FILES = 2
+
+
+def available_memory_bytes():
+    """
+    Memory available for new work: MemAvailable on Linux, physical memory
+    elsewhere.
+    """
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
+def default_memory_budget():
+    return int(available_memory_bytes() * MEMORY_BUDGET_FRACTION)
+
+
+def plan_tasks(sources, memory_budget, in_memory=False, in_memory_factor=IN_MEMORY_FACTOR,
+               streaming_memory_mb=STREAMING_MEMORY_MB, huge_file_gb=HUGE_FILE_GB):
+    """
+    Estimate the memory each source needs from its on-disk (uncompressed)
+    size and order the work largest-first, so the longest shards start early
+    instead of finishing last.
+
+    Parameters:
+        sources (list): Stage inputs, files or zip member sources.
+        memory_budget (int): Bytes all workers may use together.
+        in_memory (bool): The stage loads whole shards when they fit. Shards
+            whose in-memory estimate doesn't fit in a worker's share of the
+            budget fall back to the streaming path.
+        in_memory_factor (float): Peak memory of an in-memory load per byte of JSON.
+        streaming_memory_mb (int): Working set of the streaming path.
+        huge_file_gb (float): Size from which a shard counts as huge.
+
+    Returns:
+        list: One dict per source with its size, memory estimate, whether it
+        is huge, and the extra keyword arguments for the stage function
+        ({"streaming": ...} when `in_memory` is set).
+    """
+    streaming_memory = streaming_memory_mb * 1024 ** 2
+    tasks = []
+    for source in sources:
+        size = source_size(source)
+        task = {"source": source, "size": size, "memory": streaming_memory,
+                "huge": size >= huge_file_gb * 1024 ** 3, "kwargs": {}}
+        if in_memory:
+            # Leave room for at least one streaming worker next to an in-memory load
+            streaming = size * in_memory_factor > memory_budget - streaming_memory
+            task["kwargs"]["streaming"] = streaming
+            if not streaming:
+                task["memory"] = max(size * in_memory_factor, streaming_memory)
+        tasks.append(task)
+    tasks.sort(key=lambda task: task["size"], reverse=True)
+    return tasks
+
+
+def default_workers(memory_budget, streaming_memory_mb=STREAMING_MEMORY_MB):
+    """
+    As many workers as there are cores, but no more than the budget can hold
+    on the streaming path.
+    """
+    per_worker = (WORKER_MEMORY_MB + streaming_memory_mb) * 1024 ** 2
+    return max(1, min(os.cpu_count() or 1, memory_budget // per_worker))
+
+
+def error_message(source, error):
+    """
+    Default result of a task that raised or whose worker died: the stages
+    return "Processed ..." on success and a message otherwise.
+    """
+    return f"Error processing {source}: {error}"
+
+
+def run_tasks(func, tasks, memory_budget, max_workers, max_huge=MAX_HUGE_FILES, error_result=error_message, **kwargs):
+    """
+    Run `func(source, **kwargs, **task["kwargs"])` for every task in worker
+    processes, admitting a task only while the memory estimates of the running
+    tasks plus their workers' base memory stay within `memory_budget` and
+    fewer than `max_huge` huge tasks run.
+
+    Tasks start in plan order (largest-first). When the next task doesn't fit,
+    smaller ones behind it are started instead so no core idles; a task that
+    exceeds the budget on its own runs alone.
+
+    A task that raises gets `error_result(source, message)` as its result. A
+    worker that dies (e.g. killed for memory) breaks the pool and fails every
+    task running with it, so the pool is replaced and those tasks are retried
+    one at a time; one that breaks the pool again on its own is failed.
+
+    Returns:
+        dict: source -> return value of `func`, or of `error_result`.
+    """
+    worker_memory = WORKER_MEMORY_MB * 1024 ** 2
+    pending = list(tasks)
+    running = {}
+    results = {}
+    used = huge = 0
+    context = multiprocessing.get_context('spawn')
+    executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=context)
+    try:
+        while pending or running:
+            broken, pool_broken = [], False
+            for task in list(pending):
+                # A retried task runs alone, so a crash can be pinned on it
+                if len(running) >= max_workers or any(t.get("alone") for t in running.values()):
+                    break
+                if task.get("alone") and running:
+                    break
+                need = task["memory"] + worker_memory
+                fits = used + need <= memory_budget and not (task["huge"] and huge >= max_huge)
+                if fits or not running:
+                    try:
+                        future = executor.submit(func, task["source"], **kwargs, **task["kwargs"])
+                    except BrokenProcessPool:
+                        pool_broken = True
+                        break
+                    pending.remove(task)
+                    running[future] = task
+                    used += need
+                    huge += task["huge"]
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            if any(isinstance(future.exception(), BrokenProcessPool) for future in done):
+                # Every task running in the broken pool fails; collect all of them
+                done, _ = wait(running)
+            for future in done:
+                task = running.pop(future)
+                used -= task["memory"] + worker_memory
+                huge -= task["huge"]
+                error = future.exception()
+                if error is None:
+                    results[task["source"]] = future.result()
+                elif isinstance(error, BrokenProcessPool):
+                    broken.append(task)
+                else:
+                    results[task["source"]] = error_result(task["source"], f"{type(error).__name__}: {error}")
+
+            if broken or pool_broken:
+                executor.shutdown(wait=False)
+                executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=context)
+                retried = [task for task in broken if not task.get("alone")]
+                for task in broken:
+                    if task.get("alone"):
+                        results[task["source"]] = error_result(
+                            task["source"], "Worker process died while running this file alone (out of memory?)"
+                        )
+                pending[:0] = [dict(task, alone=True) for task in retried]
+                print(f"A worker process died; retrying {len(retried)} interrupted files one at a time.")
+    finally:
+        executor.shutdown(wait=True)
+    return results
+
+
+def run_scheduled(func, sources, memory_budget_gb=None, max_workers=None, in_memory=False,
+                  streaming_memory_mb=STREAMING_MEMORY_MB, error_result=error_message, **kwargs):
+    """
+    Plan and run a stage over `sources` within a memory budget (see plan_tasks
+    and run_tasks). `memory_budget_gb` defaults to MEMORY_BUDGET_FRACTION of
+    the available memory and `max_workers` to what that budget can hold.
+    `error_result(source, message)` builds the result of a task that failed
+    or whose worker died.
+
+    Returns:
+        dict: source -> return value of `func`.
+    """
+    memory_budget = (int(memory_budget_gb * 1024 ** 3) if memory_budget_gb is not None
+                     else default_memory_budget())
+    max_workers = max_workers or default_workers(memory_budget, streaming_memory_mb)
+    tasks = plan_tasks(sources, memory_budget, in_memory, streaming_memory_mb=streaming_memory_mb)
+    streamed = sum(1 for task in tasks if task["kwargs"].get("streaming"))
+    print(f"Scheduling {len(tasks)} files on {max_workers} workers within "
+          f"{memory_budget / 1024 ** 3:.1f} GB ({sum(task['huge'] for task in tasks)} huge"
+          + (f", {streamed} too large to load in memory and streamed" if in_memory else "") + ").")
+    return run_tasks(func, tasks, memory_budget, max_workers, error_result=error_result, **kwargs)
@@ -0,0 +1,119 @@
+import io
+import os
+import zipfile
+import fnmatch
+from contextlib import contextmanager
+
+# A JSON member inside a zip archive is addressed as '<archive path>::<member name>'
+ZIP_MEMBER_SEPARATOR = '::'
+
+# Archive members that hold openFDA drug-event records
+MEMBER_PATTERN = 'drug-event-*.json'
+
+# Shards staged as newline-delimited JSON by data_cleaner (see NDJSON_STAGING)
+NDJSON_SUFFIX = '.ndjson'
+
+
+def is_zip_member(source):
+    """
+    Check whether a source refers to a member inside a zip archive.
+    """
+    return ZIP_MEMBER_SEPARATOR in source
+
+
+def split_zip_member(source):
+    """
+    Split a zip member source into (archive path, member name).
+    """
+    archive_path, member = source.split(ZIP_MEMBER_SEPARATOR, 1)
+    return archive_path, member
+
+
+def list_zip_members(archive_path, pattern=MEMBER_PATTERN):
+    """
+    List the drug-event JSON members of a zip archive as sources.
+    macOS resource forks ('__MACOSX/', '._*') are skipped.
+    """
+    sources = []
+    with zipfile.ZipFile(archive_path, 'r') as zip_ref:
+        for info in zip_ref.infolist():
+            name = os.path.basename(info.filename)
+            if info.is_dir() or info.filename.startswith('__MACOSX/') or name.startswith('._'):
+                continue
+            if fnmatch.fnmatch(name, pattern):
+                sources.append(f"{archive_path}{ZIP_MEMBER_SEPARATOR}{info.filename}")
+    return sources
+
+
+def list_json_sources(root_dir, include_zips=True):
+    """
+    Find JSON shards under a root directory, both as plain files (.json, or
+    .ndjson when staged as newline-delimited JSON) and, if include_zips is
+    set, as members of the zip archives found there.
+
+    Parameters:
+        root_dir (str): Root directory to search.
+        include_zips (bool): Whether to look inside .zip archives.
+
+    Returns:
+        list: Sorted list of sources (file paths or archive members).
+    """
+    sources = []
+    for dirpath, _, filenames in os.walk(root_dir):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            if filename.endswith(('.json', NDJSON_SUFFIX)) and not filename.startswith('._'):
+                sources.append(path)
+            elif include_zips and filename.endswith('.zip') and zipfile.is_zipfile(path):
+                try:
+                    sources.extend(list_zip_members(path))
+                except zipfile.BadZipFile as e:
+                    print(f"Skipping unreadable archive {path}: {e}")
+    return sorted(sources)
+
+
+@contextmanager
+def open_json_source(source, encoding='utf-8', errors='strict'):
+    """
+    Open a source as a text stream. Zip members are decompressed on the fly,
+    so the uncompressed file is never written to disk.
+    Use errors='replace' to read past invalid bytes when salvaging a shard.
+    """
+    if not is_zip_member(source):
+        with open(source, 'r', encoding=encoding, errors=errors) as f:
+            yield f
+        return
+    archive_path, member = split_zip_member(source)
+    with zipfile.ZipFile(archive_path, 'r') as zip_ref:
+        with zip_ref.open(member, 'r') as raw:
+            with io.TextIOWrapper(raw, encoding=encoding, errors=errors) as f:
+                yield f
+
+
+def is_ndjson(source):
+    return source.endswith(NDJSON_SUFFIX)
+
+
+def source_size(source):
+    """
+    Uncompressed size of a source in bytes.
+    """
+    if not is_zip_member(source):
+        return os.path.getsize(source)
+    archive_path, member = split_zip_member(source)
+    with zipfile.ZipFile(archive_path, 'r') as zip_ref:
+        return zip_ref.getinfo(member).file_size
+
+
+def relative_source_path(source, root_dir):
+    """
+    Path of a source relative to the root directory. Zip members are placed in a
+    folder named after the archive, matching the layout unzipper.py extracts to,
+    e.g. 'Data/18-drug-event-0003-of-0005.json.zip::drug-event-0003-of-0005.json'
+    becomes '18-drug-event-0003-of-0005.json/drug-event-0003-of-0005.json'.
+    """
+    if not is_zip_member(source):
+        return os.path.relpath(source, root_dir)
+    archive_path, member = split_zip_member(source)
+    archive_folder = os.path.splitext(os.path.relpath(archive_path, root_dir))[0]
+    return os.path.join(archive_folder, *member.split('/'))
@@ -0,0 +1,401 @@
+import os
+import glob
+import json
+import time
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from rollups import CUBES, COUNT_COLUMN, ROLLUP_DIR, load_cube
+from vocab import VOCABULARY_PATH, Vocabulary
+
+# Per-quarter contingency counts and the signal table computed from them:
+#   Data_signals/strata/<quarter>/pairs.parquet      drug_id, reaction_id, a
+#   Data_signals/strata/<quarter>/drugs.parquet      drug_id, reports with the drug
+#   Data_signals/strata/<quarter>/reactions.parquet  reaction_id, reports with the reaction
+#   Data_signals/signals.parquet                     one row per drug-reaction pair
+SIGNAL_DIR = 'Data_signals'
+
+# Pairs reported together fewer times than this are left out of the signal table
+MIN_REPORTS = 1
+
+# Evans et al. criteria for flagging a signal: at least this many reports,
+# PRR at least 2 and a chi-squared statistic of at least 4
+SIGNAL_MIN_REPORTS = 3
+SIGNAL_MIN_PRR = 2.0
+SIGNAL_MIN_CHI2 = 4.0
+
+# Two-sided 95% confidence intervals
+Z = 1.959963984540054
+
+# Pairs whose strata are expanded into dense (pairs x quarters) arrays at once
+PAIR_CHUNK = 100_000
+
+# Metadata keys of a stratum's pairs file
+FINGERPRINT_KEY = b'fingerprint'
+REPORTS_KEY = b'reports'
+
+UNKNOWN_QUARTER = 'unknown'
+
+
+def quarter_of(year_months):
+    """
+    'YYYYQn' of every 'YYYY-MM' value; anything else becomes UNKNOWN_QUARTER.
+    """
+    valid = pc.fill_null(pc.match_substring_regex(year_months, r'^\d{4}-(0[1-9]|1[0-2])$'), False)
+    months = pc.cast(pc.utf8_slice_codeunits(pc.if_else(valid, year_months, '0000-01'), 5, 7), pa.int8())
+    quarters = pc.cast(pc.add(pc.divide(pc.subtract(months, 1), 3), 1), pa.string())
+    joined = pc.binary_join_element_wise(pc.utf8_slice_codeunits(year_months, 0, 4), quarters, 'Q')
+    return pc.if_else(valid, joined, UNKNOWN_QUARTER)
+
+
+def _stratum_dir(signal_dir, quarter):
+    return os.path.join(signal_dir, 'strata', quarter)
+
+
+def _with_quarter(cube, rollup_dir):
+    table = load_cube(cube, rollup_dir)
+    return table.append_column('quarter', quarter_of(table.column('year_month')))
+
+
+def quarter_fingerprints(rollup_dir=ROLLUP_DIR):
+    """
+    Row count and report total of every cube per quarter. A quarter's strata
+    are rebuilt only when this changes, e.g. when shards of a new quarter
+    arrive.
+
+    Returns:
+        dict: Quarter -> fingerprint string.
+    """
+    parts = {}
+    for cube in CUBES:
+        table = _with_quarter(cube, rollup_dir)
+        totals = table.group_by('quarter').aggregate([(COUNT_COLUMN, 'sum'), (COUNT_COLUMN, 'count')])
+        for quarter, total, rows in zip(*(totals.column(name).to_pylist() for name in
+                                          ('quarter', f"{COUNT_COLUMN}_sum", f"{COUNT_COLUMN}_count"))):
+            parts.setdefault(quarter, []).append(f"{cube}:{rows}:{total}")
+    return {quarter: ";".join(values) for quarter, values in parts.items()}
+
+
+def read_stratum_fingerprint(signal_dir, quarter):
+    path = os.path.join(_stratum_dir(signal_dir, quarter), 'pairs.parquet')
+    if not os.path.exists(path):
+        return None
+    return pq.read_schema(path).metadata[FINGERPRINT_KEY].decode()
+
+
+def _quarter_counts(cube, keys, quarters, rollup_dir):
+    """
+    Report counts of a cube summed over every dimension but `keys`, for the
+    given quarters only.
+    """
+    table = _with_quarter(cube, rollup_dir)
+    table = table.filter(pc.is_in(table.column('quarter'), pa.array(quarters, pa.string())))
+    counts = table.group_by(['quarter'] + keys).aggregate([(COUNT_COLUMN, 'sum')])
+    return counts.rename_columns({f"{COUNT_COLUMN}_sum": COUNT_COLUMN})
+
+
+def _write_atomic(table, path, metadata=None):
+    if metadata:
+        table = table.replace_schema_metadata(metadata)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = path + '.tmp'
+    pq.write_table(table, temp_path, compression='snappy')
+    os.replace(temp_path, path)
+
+
+def update_strata(quarters, fingerprints, vocabulary, rollup_dir=ROLLUP_DIR, signal_dir=SIGNAL_DIR):
+    """
+    Rebuild the contingency counts of `quarters` from the rollup cubes, in
+    one pass over each cube: co-reports per (drug, reaction) and reports per
+    drug, per reaction and in total. Drugs and reactions are stored by their
+    global vocabulary ids, so the strata of different runs line up.
+    """
+    if not quarters:
+        return
+    pairs = _quarter_counts('pairs', ['drug', 'reaction'], quarters, rollup_dir)
+    drugs = _quarter_counts('drugs', ['drug'], quarters, rollup_dir)
+    reactions = _quarter_counts('reactions', ['reaction'], quarters, rollup_dir)
+    reports = _quarter_counts('reports', [], quarters, rollup_dir)
+    totals = dict(zip(reports.column('quarter').to_pylist(), reports.column(COUNT_COLUMN).to_pylist()))
+
+    def split(table, columns):
+        encoded = pa.table({
+            name: vocabulary.encode(name.split('_')[0], table.column(name.split('_')[0])) if name.endswith('_id')
+            else table.column(name)
+            for name in columns
+        })
+        for quarter in quarters:
+            yield quarter, encoded.filter(pc.equal(table.column('quarter'), quarter))
+
+    for table, name, columns in ((drugs, 'drugs', ['drug_id', COUNT_COLUMN]),
+                                 (reactions, 'reactions', ['reaction_id', COUNT_COLUMN])):
+        for quarter, part in split(table, columns):
+            _write_atomic(part, os.path.join(_stratum_dir(signal_dir, quarter), f"{name}.parquet"))
+    # The pairs file goes last: its fingerprint marks the stratum complete
+    for quarter, part in split(pairs, ['drug_id', 'reaction_id', COUNT_COLUMN]):
+        _write_atomic(part, os.path.join(_stratum_dir(signal_dir, quarter), 'pairs.parquet'), {
+            FINGERPRINT_KEY: fingerprints[quarter].encode(),
+            REPORTS_KEY: str(totals.get(quarter, 0)).encode(),
+        })
+
+
+def _dense_margins(tables, id_column, ids):
+    """
+    Reports per id and quarter as a dense (ids x quarters) array, with rows
+    in the order of the sorted `ids`.
+    """
+    margins = np.zeros((len(ids), len(tables)), dtype=np.int32)
+    for k, table in enumerate(tables):
+        rows = np.searchsorted(ids, table.column(id_column).to_numpy())
+        margins[rows, k] = table.column(COUNT_COLUMN).to_numpy()
+    return margins
+
+
+def _safe_divide(numerator, denominator):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(denominator != 0, numerator / np.where(denominator != 0, denominator, 1), np.nan)
+
+
+def _interval(estimate, standard_error):
+    with np.errstate(invalid='ignore', over='ignore'):
+        return estimate * np.exp(-Z * standard_error), estimate * np.exp(Z * standard_error)
+
+
+def disproportionality(a, b, c, d):
+    """
+    PRR and ROR with 95% confidence intervals, and the Yates-corrected
+    chi-squared statistic, of 2x2 tables given as arrays:
+
+                      reaction    other reactions
+        drug             a              b
+        other drugs      c              d
+
+    Returns:
+        dict: Column name -> array.
+    """
+    a, b, c, d = (np.asarray(x, dtype=np.float64) for x in (a, b, c, d))
+    n = a + b + c + d
+    with np.errstate(divide='ignore', invalid='ignore'):
+        prr = _safe_divide(a / (a + b), c / (c + d))
+        prr_se = np.sqrt(1 / a - 1 / (a + b) + 1 / c - 1 / (c + d))
+        ror = _safe_divide(a * d, b * c)
+        ror_se = np.sqrt(1 / a + 1 / b + 1 / c + 1 / d)
+        chi2 = _safe_divide(n * np.maximum(np.abs(a * d - b * c) - n / 2, 0) ** 2,
+                            (a + b) * (c + d) * (a + c) * (b + d))
+    prr_lower, prr_upper = _interval(prr, prr_se)
+    ror_lower, ror_upper = _interval(ror, ror_se)
+    return {
+        'prr': prr, 'prr_lower': prr_lower, 'prr_upper': prr_upper,
+        'ror': ror, 'ror_lower': ror_lower, 'ror_upper': ror_upper,
+        'chi2': chi2,
+    }
+
+
+def mantel_haenszel(A, Nd, Nr, N):
+    """
+    Quarter-stratified (Mantel-Haenszel) PRR and ROR with 95% confidence
+    intervals, for a block of pairs.
+
+    Parameters:
+        A (ndarray): Co-reports per pair and quarter (pairs x quarters).
+        Nd, Nr (ndarray): Reports with the pair's drug / reaction per quarter.
+        N (ndarray): Reports per quarter (quarters).
+
+    Returns:
+        dict: Column name -> array over the pairs.
+    """
+    B = Nd - A
+    C = Nr - A
+    D = N - Nd - Nr + A
+    with np.errstate(divide='ignore', invalid='ignore'):
+        inv_n = np.where(N > 0, 1 / np.where(N > 0, N, 1), 0.0)
+        # Odds ratio, with the Robins-Breslow-Greenland variance
+        R = A * D * inv_n
+        S = B * C * inv_n
+        P = (A + D) * inv_n
+        Q = (B + C) * inv_n
+        sum_r, sum_s = R.sum(axis=1), S.sum(axis=1)
+        ror = _safe_divide(sum_r, sum_s)
+        ror_var = ((P * R).sum(axis=1) / (2 * sum_r ** 2)
+                   + (P * S + Q * R).sum(axis=1) / (2 * sum_r * sum_s)
+                   + (Q * S).sum(axis=1) / (2 * sum_s ** 2))
+        # Risk ratio, with the Greenland-Robins variance
+        numerator = (A * (C + D) * inv_n).sum(axis=1)
+        denominator = (C * (A + B) * inv_n).sum(axis=1)
+        prr = _safe_divide(numerator, denominator)
+        prr_var = (((A + B) * (C + D) * (A + C) - A * C * N) * inv_n ** 2).sum(axis=1) / (numerator * denominator)
+    prr_lower, prr_upper = _interval(prr, np.sqrt(prr_var))
+    ror_lower, ror_upper = _interval(ror, np.sqrt(ror_var))
+    return {
+        'prr_mh': prr, 'prr_mh_lower': prr_lower, 'prr_mh_upper': prr_upper,
+        'ror_mh': ror, 'ror_mh_lower': ror_lower, 'ror_mh_upper': ror_upper,
+    }
+
+
+def load_strata(signal_dir=SIGNAL_DIR):
+    """
+    Read every stored stratum.
+
+    Returns:
+        tuple: (quarters, pair tables, drug tables, reaction tables, reports per quarter)
+    """
+    quarters = sorted(os.path.basename(os.path.dirname(path))
+                      for path in glob.glob(os.path.join(signal_dir, 'strata', '*', 'pairs.parquet')))
+    pairs, drugs, reactions, reports = [], [], [], []
+    for quarter in quarters:
+        folder = _stratum_dir(signal_dir, quarter)
+        table = pq.read_table(os.path.join(folder, 'pairs.parquet'))
+        pairs.append(table)
+        reports.append(int(table.schema.metadata[REPORTS_KEY]))
+        drugs.append(pq.read_table(os.path.join(folder, 'drugs.parquet')))
+        reactions.append(pq.read_table(os.path.join(folder, 'reactions.parquet')))
+    return quarters, pairs, drugs, reactions, np.array(reports, dtype=np.float64)
+
+
+def compute_signals(signal_dir=SIGNAL_DIR, min_reports=MIN_REPORTS, pair_chunk=PAIR_CHUNK):
+    """
+    Disproportionality statistics of every drug-reaction pair reported
+    together at least `min_reports` times, over all stored quarters.
+
+    The co-report counts form a sparse drug x reaction x quarter array held
+    as coordinate arrays; only the drug and reaction margins are dense. Crude
+    statistics use the totals over all quarters, the _mh columns stratify by
+    quarter (see mantel_haenszel).
+
+    Returns:
+        pyarrow.Table: drug_id, reaction_id, a, b, c, d and the statistics.
+    """
+    quarters, pairs, drugs, reactions, N = load_strata(signal_dir)
+    if not quarters:
+        raise FileNotFoundError(f"No strata in {signal_dir}; run update_strata first")
+    # Compact row numbers for the drugs and reactions that occur
+    drug_universe = np.unique(np.concatenate([t.column('drug_id').to_numpy() for t in drugs]))
+    reaction_universe = np.unique(np.concatenate([t.column('reaction_id').to_numpy() for t in reactions]))
+    drug_margin = _dense_margins(drugs, 'drug_id', drug_universe)
+    reaction_margin = _dense_margins(reactions, 'reaction_id', reaction_universe)
+
+    # Coordinates of the non-zero cells: pair key, quarter, count
+    width = np.int64(len(reaction_universe))
+    keys = np.concatenate([np.searchsorted(drug_universe, t.column('drug_id').to_numpy()).astype(np.int64) * width
+                           + np.searchsorted(reaction_universe, t.column('reaction_id').to_numpy())
+                           for t in pairs])
+    strata = np.concatenate([np.full(t.num_rows, k, dtype=np.int64) for k, t in enumerate(pairs)])
+    counts = np.concatenate([t.column(COUNT_COLUMN).to_numpy() for t in pairs]).astype(np.float64)
+
+    order = np.argsort(keys, kind='stable')
+    keys, strata, counts = keys[order], strata[order], counts[order]
+    unique_keys, starts = np.unique(keys, return_index=True)
+    totals = np.add.reduceat(counts, starts) if len(keys) else np.zeros(0)
+    selected = totals >= min_reports
+    pair_keys, pair_totals = unique_keys[selected], totals[selected]
+    drug_rows = pair_keys // width
+    reaction_rows = pair_keys % width
+    cell_pair = np.searchsorted(pair_keys, keys)
+    in_selection = (cell_pair < len(pair_keys)) & (pair_keys[np.minimum(cell_pair, len(pair_keys) - 1)] == keys)
+
+    a = pair_totals
+    nd = drug_margin.sum(axis=1, dtype=np.float64)[drug_rows]
+    nr = reaction_margin.sum(axis=1, dtype=np.float64)[reaction_rows]
+    columns = {'drug_id': drug_universe[drug_rows].astype(np.int32),
+               'reaction_id': reaction_universe[reaction_rows].astype(np.int32), 'a': a,
+               'b': nd - a, 'c': nr - a, 'd': N.sum() - nd - nr + a}
+    columns.update(disproportionality(columns['a'], columns['b'], columns['c'], columns['d']))
+
+    stratified = {}
+    cells = np.flatnonzero(in_selection)
+    for start in range(0, len(pair_keys), pair_chunk):
+        stop = min(start + pair_chunk, len(pair_keys))
+        block = cells[(cell_pair[cells] >= start) & (cell_pair[cells] < stop)]
+        A = np.zeros((stop - start, len(quarters)))
+        A[cell_pair[block] - start, strata[block]] = counts[block]
+        part = mantel_haenszel(A, drug_margin[drug_rows[start:stop]].astype(np.float64),
+                               reaction_margin[reaction_rows[start:stop]].astype(np.float64), N)
+        for name, values in part.items():
+            stratified.setdefault(name, []).append(values)
+    columns.update({name: np.concatenate(values) for name, values in stratified.items()})
+
+    columns['signal'] = ((columns['a'] >= SIGNAL_MIN_REPORTS) & (columns['prr'] >= SIGNAL_MIN_PRR)
+                         & (columns['chi2'] >= SIGNAL_MIN_CHI2))
+    table = pa.table({name: pa.array(values) for name, values in columns.items()})
+    return table.replace_schema_metadata({b'quarters': json.dumps(quarters).encode()})
+
+
+def signals_path(signal_dir=SIGNAL_DIR):
+    return os.path.join(signal_dir, 'signals.parquet')
+
+
+def _decode(table, vocabulary):
+    drugs = vocabulary.decode('drug', table.column('drug_id')).dictionary_decode()
+    reactions = vocabulary.decode('reaction', table.column('reaction_id')).dictionary_decode()
+    return table.add_column(0, 'reaction', reactions).add_column(0, 'drug', drugs)
+
+
+# Signal table path -> (mtime, table), so repeated queries don't reread the file
+_signal_cache = {}
+
+
+def load_signals(signal_dir=SIGNAL_DIR):
+    path = signals_path(signal_dir)
+    mtime = os.stat(path).st_mtime_ns
+    cached = _signal_cache.get(path)
+    if cached is None or cached[0] != mtime:
+        cached = _signal_cache[path] = (mtime, pq.read_table(path))
+    return cached[1]
+
+
+def top_signals(n=20, min_reports=SIGNAL_MIN_REPORTS, by='prr_mh_lower', drug=None, reaction=None,
+                signal_dir=SIGNAL_DIR):
+    """
+    Pairs with the strongest disproportionality, largest `by` first.
+
+    Parameters:
+        n (int): Number of pairs to return.
+        min_reports (int): Minimum number of co-reports.
+        by (str): Statistic to rank by; the lower confidence bound of the
+            stratified PRR by default, which favours well-supported signals.
+        drug, reaction (str): Restrict to one drug (upper case) or reaction.
+
+    Returns:
+        pandas.DataFrame
+    """
+    table = load_signals(signal_dir)
+    mask = pc.greater_equal(table.column('a'), min_reports)
+    if drug is not None:
+        mask = pc.and_(mask, pc.equal(table.column('drug'), drug.strip().upper()))
+    if reaction is not None:
+        mask = pc.and_(mask, pc.equal(table.column('reaction'), reaction.strip()))
+    table = table.filter(mask)
+    table = table.filter(pc.fill_null(pc.is_finite(table.column(by)), False))
+    return table.sort_by([(by, 'descending')]).slice(0, n).to_pandas()
+
+
+def main(rollup_dir=ROLLUP_DIR, signal_dir=SIGNAL_DIR, min_reports=MIN_REPORTS, vocabulary_path=VOCABULARY_PATH):
+    """
+    Bring the per-quarter strata up to date with the rollup cubes (only
+    quarters whose counts changed are rebuilt) and recompute the signal table.
+    """
+    start = time.perf_counter()
+    fingerprints = quarter_fingerprints(rollup_dir)
+    changed = sorted(quarter for quarter, fingerprint in fingerprints.items()
+                     if read_stratum_fingerprint(signal_dir, quarter) != fingerprint)
+    print(f"{len(fingerprints)} quarters, {len(changed)} new or changed.")
+    with Vocabulary(vocabulary_path) as vocabulary:
+        update_strata(changed, fingerprints, vocabulary, rollup_dir, signal_dir)
+        for path in glob.glob(os.path.join(signal_dir, 'strata', '*', 'pairs.parquet')):
+            quarter = os.path.basename(os.path.dirname(path))
+            if quarter not in fingerprints:
+                for name in ('pairs', 'drugs', 'reactions'):
+                    os.remove(os.path.join(_stratum_dir(signal_dir, quarter), f"{name}.parquet"))
+                os.rmdir(_stratum_dir(signal_dir, quarter))
+
+        table = _decode(compute_signals(signal_dir, min_reports), vocabulary)
+    _write_atomic(table, signals_path(signal_dir))
+    flagged = pc.sum(table.column('signal').cast(pa.int64())).as_py() or 0
+    print(f"{table.num_rows} drug-reaction pairs, {flagged} flagged as signals, "
+          f"in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
+    print(top_signals(20).to_string())
@@ -0,0 +1,253 @@
+import os
+import json
+import random
+import zipfile
+from datetime import date, timedelta
+
+# Output layout mirrors the unzipper: <dir>/<n>-drug-event-000i-of-000N.json/drug-event-000i-of-000N.json
+OUTPUT_DIR = 'DataSynthetic'
+
+# Records per shard in the openFDA bulk files (see nested_structure.txt)
+RECORDS_PER_SHARD = 12000
+
+META = {
+    "disclaimer": "Synthetic data generated for benchmarking; not openFDA data.",
+    "terms": "https://open.fda.gov/terms/",
+    "license": "https://open.fda.gov/license/",
+    "last_updated": "2024-01-01",
+}
+
+# Small vocabularies; drugs and reactions are drawn with a long-tailed
+# (Zipf-like) distribution so a few names dominate, as in the real data.
+DRUGS = [
+    "ASPIRIN", "HUMIRA", "METFORMIN", "LISINOPRIL", "ATORVASTATIN", "ENBREL", "PREDNISONE",
+    "LEVOTHYROXINE", "AMLODIPINE", "OMEPRAZOLE", "XARELTO", "ELIQUIS", "REVLIMID", "OTEZLA",
+    "IBUPROFEN", "ACETAMINOPHEN", "WARFARIN", "GABAPENTIN", "METHOTREXATE", "INSULIN GLARGINE",
+] + [f"DRUG {i:04d}" for i in range(500)]
+REACTIONS = [
+    "Drug ineffective", "Nausea", "Fatigue", "Headache", "Diarrhoea", "Off label use", "Pain",
+    "Dyspnoea", "Dizziness", "Rash", "Vomiting", "Pruritus", "Arthralgia", "Death", "Pneumonia",
+] + [f"Reaction {i:04d}" for i in range(300)]
+COUNTRIES = ["US", "US", "US", "US", "GB", "CA", "JP", "DE", "FR", "BR", "IT", "ES", "AU", "CN"]
+ROUTES = ["048", "058", "042", "065", "061", "030"]
+AGE_UNITS = ["801", "801", "801", "802", "803", "804", "805", "800"]
+
+
+def _zipf_choice(rng, values, s=1.1):
+    """
+    Draw from `values` with probability falling off as 1 / rank**s.
+    """
+    weights = _zipf_choice.cache.get((len(values), s))
+    if weights is None:
+        weights = _zipf_choice.cache[(len(values), s)] = [1 / (rank + 1) ** s for rank in range(len(values))]
+    return rng.choices(values, weights=weights)[0]
+
+
+_zipf_choice.cache = {}
+
+
+def _date(rng, start, days):
+    return (start + timedelta(days=rng.randrange(days))).strftime("%Y%m%d")
+
+
+def generate_drug(rng):
+    drug = {
+        "drugcharacterization": rng.choice(["1", "1", "2", "3"]),
+        "medicinalproduct": _zipf_choice(rng, DRUGS),
+    }
+    # Optional fields appear with very different frequencies
+    if rng.random() < 0.3:
+        drug["drugbatchnumb"] = f"B{rng.randrange(10 ** 6):06d}"
+    if rng.random() < 0.5:
+        drug["drugseparatedosagenumb"] = "1"
+        drug["drugintervaldosageunitnumb"] = str(rng.choice([1, 2, 12, 24]))
+        drug["drugintervaldosagedefinition"] = rng.choice(["801", "802", "803", "804"])
+    if rng.random() < 0.4:
+        drug["drugstructuredosagenumb"] = str(rng.choice([5, 10, 20, 40, 100, 500]))
+        drug["drugstructuredosageunit"] = "003"
+    if rng.random() < 0.6:
+        drug["drugdosagetext"] = f"{rng.choice([5, 10, 20, 40])} MG, {rng.choice(['QD', 'BID', 'QW'])}"
+    if rng.random() < 0.7:
+        drug["drugadministrationroute"] = rng.choice(ROUTES)
+    if rng.random() < 0.6:
+        drug["drugindication"] = _zipf_choice(rng, REACTIONS).upper()
+    if rng.random() < 0.4:
+        drug["drugstartdateformat"] = "102"
+        drug["drugstartdate"] = _date(rng, date(2010, 1, 1), 4000)
+    if rng.random() < 0.2:
+        drug["drugenddateformat"] = "102"
+        drug["drugenddate"] = _date(rng, date(2015, 1, 1), 3000)
+    if rng.random() < 0.5:
+        drug["actiondrug"] = rng.choice(["1", "2", "3", "4", "5", "6"])
+    if rng.random() < 0.1:
+        drug["drugadditional"] = rng.choice(["1", "2", "3"])
+    drug["activesubstance"] = {"activesubstancename": drug["medicinalproduct"]}
+    if rng.random() < 0.55:
+        # openFDA harmonization, including the identifiers data_cleaner removes
+        drug["openfda"] = {
+            "application_number": [f"NDA{rng.randrange(10 ** 6):06d}"],
+            "brand_name": [drug["medicinalproduct"]],
+            "generic_name": [drug["medicinalproduct"]],
+            "manufacturer_name": [f"MANUFACTURER {rng.randrange(50)}"],
+            "product_ndc": [f"{rng.randrange(10 ** 4):04d}-{rng.randrange(10 ** 3):03d}"],
+            "product_type": ["HUMAN PRESCRIPTION DRUG"],
+            "route": ["ORAL"],
+            "substance_name": [drug["medicinalproduct"]],
+            "rxcui": [str(rng.randrange(10 ** 6)) for _ in range(rng.randrange(1, 4))],
+            "spl_id": [f"{rng.getrandbits(128):032x}"],
+            "spl_set_id": [f"{rng.getrandbits(128):032x}"],
+            "package_ndc": [f"{rng.randrange(10 ** 4):04d}-{rng.randrange(10 ** 3):03d}-{rng.randrange(100):02d}"],
+            "nui": ["N0000175503"],
+            "pharm_class_epc": ["Nonsteroidal Anti-inflammatory Drug [EPC]"],
+            "unii": [f"{rng.getrandbits(40):010X}"],
+        }
+    return drug
+
+
+def generate_record(rng, report_id, start=date(2004, 1, 1), days=365 * 20):
+    """
+    One synthetic drug-event report with the structure of nested_structure.txt.
+    """
+    receivedate = _date(rng, start, days)
+    country = rng.choice(COUNTRIES)
+    serious = rng.random() < 0.55
+    record = {
+        "safetyreportversion": str(rng.choice([1, 1, 1, 2, 3])),
+        "safetyreportid": str(report_id),
+        "primarysourcecountry": country,
+        "occurcountry": country,
+        "transmissiondateformat": "102",
+        "transmissiondate": receivedate,
+        "reporttype": rng.choice(["1", "1", "2"]),
+        "serious": "1" if serious else "2",
+    }
+    if serious:
+        for flag in ("seriousnessdeath", "seriousnesshospitalization", "seriousnessother",
+                     "seriousnesslifethreatening", "seriousnessdisabling"):
+            if rng.random() < 0.3:
+                record[flag] = "1"
+    record.update({
+        "receivedateformat": "102",
+        "receivedate": receivedate,
+        "receiptdateformat": "102",
+        "receiptdate": receivedate,
+        "fulfillexpeditecriteria": rng.choice(["1", "2"]),
+        "companynumb": f"{country}-COMPANY-{rng.randrange(10 ** 7)}",
+        "duplicate": "1",
+        "reportduplicate": {"duplicatesource": "COMPANY", "duplicatenumb": f"{country}-{rng.randrange(10 ** 7)}"},
+        "primarysource": {"reportercountry": country, "qualification": rng.choice(["1", "2", "3", "5"])},
+        "sender": {"sendertype": "2", "senderorganization": "FDA-Public Use"},
+        "receiver": {"receivertype": "6", "receiverorganization": "FDA"},
+    })
+
+    patient = {}
+    # patientonsetage and friends only appear in some reports
+    if rng.random() < 0.6:
+        patient["patientonsetage"] = str(rng.randrange(1, 95))
+        patient["patientonsetageunit"] = rng.choice(AGE_UNITS)
+    if rng.random() < 0.3:
+        patient["patientagegroup"] = rng.choice(["1", "2", "3", "4", "5", "6"])
+    if rng.random() < 0.85:
+        patient["patientsex"] = rng.choice(["1", "2", "2", "0"])
+    if rng.random() < 0.25:
+        patient["patientweight"] = f"{rng.uniform(3, 150):.1f}"
+    if rng.random() < 0.05:
+        patient["patientdeath"] = {"patientdeathdateformat": "102", "patientdeathdate": receivedate}
+    patient["reaction"] = [
+        {
+            "reactionmeddraversionpt": "26.0",
+            "reactionmeddrapt": _zipf_choice(rng, REACTIONS),
+            "reactionoutcome": rng.choice(["1", "2", "3", "4", "5", "6"]),
+        }
+        for _ in range(min(1 + int(rng.expovariate(0.6)), 30))
+    ]
+    patient["drug"] = [generate_drug(rng) for _ in range(min(1 + int(rng.expovariate(0.3)), 60))]
+    if rng.random() < 0.1:
+        patient["summary"] = {"narrativeincludeclinical": "CASE EVENT DATE: " + receivedate}
+    record["patient"] = patient
+    return record
+
+
+def write_shard(path, records, seed, first_id=10 ** 7, indent=None):
+    """
+    Write one shard of `records` synthetic reports to `path`, streaming the
+    records so any scale fits in memory.
+
+    Returns:
+        int: Size of the file in bytes.
+    """
+    rng = random.Random(seed)
+    meta = dict(META, results={"skip": 0, "limit": records, "total": records})
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    separator = ",\n" if indent else ","
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('{"meta":' + json.dumps(meta, indent=indent) + ',"results":[')
+        for i in range(records):
+            if i:
+                f.write(separator)
+            f.write(json.dumps(generate_record(rng, first_id + i), indent=indent, separators=None if indent else (',', ':')))
+        f.write(']}')
+    return os.path.getsize(path)
+
+
+def generate_dataset(output_dir=OUTPUT_DIR, shards=4, records_per_shard=RECORDS_PER_SHARD, corrupt=1, empty=1,
+                     seed=0, as_zip=False, indent=None):
+    """
+    Generate a synthetic corpus of drug-event shards.
+
+    Parameters:
+        output_dir (str): Root directory of the corpus.
+        shards (int): Number of valid shards.
+        records_per_shard (int): Reports per valid shard.
+        corrupt (int): Extra shards truncated in the middle of a record.
+        empty (int): Extra zero-byte shards.
+        seed (int): Seed; the same arguments always produce the same files.
+        as_zip (bool): Write '<n>-drug-event-...json.zip' archives like the
+            downloader instead of the extracted layout.
+        indent (int): Pretty-print with this indent instead of compact JSON.
+
+    Returns:
+        dict: {"files", "records", "bytes"} for the valid shards.
+    """
+    total = shards + corrupt + empty
+    summary = {"files": [], "records": 0, "bytes": 0}
+    for i in range(total):
+        name = f"drug-event-{i + 1:04d}-of-{total:04d}.json"
+        folder = os.path.join(output_dir, f"{i + 1}-{name}")
+        path = os.path.join(folder, name)
+        if i < shards:
+            size = write_shard(path, records_per_shard, seed * 100003 + i, first_id=10 ** 7 + i * records_per_shard,
+                               indent=indent)
+            summary["files"].append(path)
+            summary["records"] += records_per_shard
+            summary["bytes"] += size
+        elif i < shards + corrupt:
+            write_shard(path, max(records_per_shard // 10, 2), seed * 100003 + i, indent=indent)
+            with open(path, 'r+b') as f:
+                f.truncate(os.path.getsize(path) * 2 // 3)
+        else:
+            os.makedirs(folder, exist_ok=True)
+            open(path, 'w').close()
+
+        if as_zip:
+            with zipfile.ZipFile(folder + '.zip', 'w', zipfile.ZIP_DEFLATED) as zip_ref:
+                zip_ref.write(path, name)
+            os.remove(path)
+            os.rmdir(folder)
+            if i < shards:
+                summary["files"][-1] = folder + '.zip'
+    return summary
+
+
+if __name__ == "__main__":
+    # Adjustable parameters
+    output_directory = OUTPUT_DIR
+    number_of_shards = 4
+    records_in_each_shard = RECORDS_PER_SHARD
+    corrupt_shards = 1
+    empty_shards = 1
+
+    result = generate_dataset(output_directory, number_of_shards, records_in_each_shard, corrupt_shards, empty_shards)
+    print(f"Generated {len(result['files'])} shards with {result['records']} records "
+          f"({result['bytes'] / 1024 ** 2:.1f} MB) plus {corrupt_shards} corrupt and {empty_shards} empty shards "
+          f"in {output_directory}")
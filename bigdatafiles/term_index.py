@@ -0,0 +1,314 @@
+import os
+import glob
+import time
+import sqlite3
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from metrics import print_summary, start_run, track
+from parquet_dataset import PARTITION_KEY
+from vocab import VOCABULARY_PATH, Vocabulary, normalize_terms
+
+# Nested drug-event dataset written by the conversion stage
+DATASET_DIR = 'Data_parquet'
+
+# Inverted index: (vocabulary, term id) -> files and row groups holding the term
+INDEX_PATH = 'term_index.sqlite'
+
+# Name of this stage in the metrics file
+STAGE = 'index'
+
+# Vocabulary -> (struct, list, leaf) of its terms in the drug-event schema
+INDEXED_COLUMNS = {
+    'drug': ('patient', 'drug', 'medicinalproduct'),
+    'reaction': ('patient', 'reaction', 'reactionmeddrapt'),
+}
+
+# Most SQLite builds allow 999 parameters per statement
+_LOOKUP_CHUNK = 500
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    file_id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    fingerprint TEXT NOT NULL,
+    row_groups INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS postings (
+    vocabulary TEXT NOT NULL,
+    term_id INTEGER NOT NULL,
+    file_id INTEGER NOT NULL,
+    row_group INTEGER NOT NULL,
+    PRIMARY KEY (vocabulary, term_id, file_id, row_group)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS postings_file ON postings (file_id);
+"""
+
+
+def column_path(vocabulary):
+    """
+    Parquet column path of a vocabulary's terms, for reading only that column,
+    e.g. 'patient.drug.list.element.medicinalproduct'.
+    """
+    struct_name, list_name, leaf_name = INDEXED_COLUMNS[vocabulary]
+    return f"{struct_name}.{list_name}.list.element.{leaf_name}"
+
+
+def list_terms(table, vocabulary):
+    """
+    Normalized terms of a vocabulary in a table with the drug-event schema
+    (see vocab.normalize_terms), with the row each term belongs to.
+
+    Returns:
+        tuple: (terms, row indices) as arrays of the same length.
+    """
+    struct_name, list_name, leaf_name = INDEXED_COLUMNS[vocabulary]
+    structs = table.column(struct_name).combine_chunks()
+    lists = pc.struct_field(structs, list_name)
+    rows = pc.list_parent_indices(lists)
+    terms = pc.struct_field(pc.list_flatten(lists), leaf_name)
+    return normalize_terms(terms, vocabulary), rows
+
+
+def file_fingerprint(path):
+    stat = os.stat(path)
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def list_dataset_files(dataset_dir=DATASET_DIR):
+    return sorted(glob.glob(os.path.join(dataset_dir, f"{PARTITION_KEY}=*", "*.parquet")))
+
+
+def index_file(path, vocabulary):
+    """
+    Read the term columns of one Parquet file, a row group at a time, and
+    collect the distinct term ids of every row group.
+
+    Returns:
+        tuple: (number of row groups, list of (vocabulary, term id, row group))
+    """
+    parquet_file = pq.ParquetFile(path)
+    columns = [column_path(name) for name in INDEXED_COLUMNS]
+    postings = []
+    for row_group in range(parquet_file.num_row_groups):
+        table = parquet_file.read_row_group(row_group, columns=columns)
+        for name in INDEXED_COLUMNS:
+            terms = pc.unique(list_terms(table, name)[0]).drop_null().to_pylist()
+            ids = vocabulary.ids(name, terms)
+            postings.extend((name, term_id, row_group) for term_id in sorted(ids.values()))
+    return parquet_file.num_row_groups, postings
+
+
+class TermIndex:
+    """
+    SQLite inverted index from every drug and reaction term to the files and
+    row groups of the dataset that contain it. Terms are stored by their
+    global vocabulary ids (see vocab), and files by path together with the
+    size and modification time they were indexed at, so an update only reads
+    new or rewritten files (e.g. after compaction) and drops vanished ones.
+    """
+
+    def __init__(self, path=INDEX_PATH):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def indexed_files(self):
+        """
+        Returns:
+            dict: Path -> fingerprint it was indexed at.
+        """
+        return dict(self.conn.execute("SELECT path, fingerprint FROM files"))
+
+    def remove_files(self, paths):
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            for path in paths:
+                row = self.conn.execute("SELECT file_id FROM files WHERE path = ?", (path,)).fetchone()
+                if row:
+                    self.conn.execute("DELETE FROM postings WHERE file_id = ?", row)
+                    self.conn.execute("DELETE FROM files WHERE file_id = ?", row)
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    def add_file(self, path, fingerprint, row_groups, postings):
+        """
+        Replace the postings of one file in a single transaction.
+        """
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.conn.execute("SELECT file_id FROM files WHERE path = ?", (path,)).fetchone()
+            if row:
+                self.conn.execute("DELETE FROM postings WHERE file_id = ?", row)
+                self.conn.execute("DELETE FROM files WHERE file_id = ?", row)
+            file_id = self.conn.execute(
+                "INSERT INTO files (path, fingerprint, row_groups) VALUES (?, ?, ?)",
+                (path, fingerprint, row_groups),
+            ).lastrowid
+            self.conn.executemany(
+                "INSERT INTO postings (vocabulary, term_id, file_id, row_group) VALUES (?, ?, ?, ?)",
+                [(name, term_id, file_id, row_group) for name, term_id, row_group in postings],
+            )
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    def locate(self, vocabulary, term_ids):
+        """
+        Files and row groups holding any of `term_ids`.
+
+        Returns:
+            dict: Path -> sorted list of row group numbers.
+        """
+        term_ids = list(term_ids)
+        locations = {}
+        for i in range(0, len(term_ids), _LOOKUP_CHUNK):
+            chunk = term_ids[i:i + _LOOKUP_CHUNK]
+            placeholders = ",".join("?" * len(chunk))
+            for path, row_group in self.conn.execute(
+                f"""
+                SELECT f.path, p.row_group FROM postings p JOIN files f USING (file_id)
+                WHERE p.vocabulary = ? AND p.term_id IN ({placeholders})
+                """,
+                [vocabulary] + chunk,
+            ):
+                locations.setdefault(path, set()).add(row_group)
+        return {path: sorted(groups) for path, groups in sorted(locations.items())}
+
+    def total_row_groups(self):
+        return self.conn.execute("SELECT COALESCE(SUM(row_groups), 0) FROM files").fetchone()[0]
+
+
+def update_index(dataset_dir=DATASET_DIR, index_path=INDEX_PATH, vocabulary_path=VOCABULARY_PATH):
+    """
+    Bring the index up to date with the files of the dataset: index new and
+    rewritten files and forget the ones that no longer exist.
+
+    Returns:
+        dict: Numbers of files indexed, removed and unchanged.
+    """
+    files = {path: file_fingerprint(path) for path in list_dataset_files(dataset_dir)}
+    with TermIndex(index_path) as index, Vocabulary(vocabulary_path) as vocabulary:
+        indexed = index.indexed_files()
+        changed = [path for path, fingerprint in files.items() if indexed.get(path) != fingerprint]
+        removed = sorted(set(indexed) - set(files))
+        if removed:
+            index.remove_files(removed)
+        for path in changed:
+            with track(STAGE, path, bytes_in=os.path.getsize(path)) as m:
+                row_groups, postings = index_file(path, vocabulary)
+                index.add_file(path, files[path], row_groups, postings)
+                m.records = len(postings)
+    return {"indexed": len(changed), "removed": len(removed), "unchanged": len(files) - len(changed)}
+
+
+def lookup(drug=None, reaction=None, index_path=INDEX_PATH, vocabulary_path=VOCABULARY_PATH):
+    """
+    Files and row groups that may hold reports mentioning `drug` and/or
+    `reaction`. Terms are normalized like the vocabularies. With both terms,
+    only row groups containing both are returned; the rows themselves still
+    need filtering (see read_matching).
+
+    Returns:
+        dict: Path -> sorted list of row group numbers.
+    """
+    terms = {name: term for name, term in (('drug', drug), ('reaction', reaction)) if term is not None}
+    if not terms:
+        raise ValueError("Give a drug and/or a reaction to look up.")
+    locations = None
+    with TermIndex(index_path) as index, Vocabulary(vocabulary_path) as vocabulary:
+        for name, term in terms.items():
+            normalized = normalize_terms(pa.array([term], pa.string()), name)[0].as_py()
+            term_id = vocabulary.ids(name, [normalized], assign=False).get(normalized)
+            found = index.locate(name, [term_id]) if term_id is not None else {}
+            if locations is None:
+                locations = found
+            else:
+                locations = {path: sorted(set(groups) & set(found[path]))
+                             for path, groups in locations.items() if path in found}
+    return {path: groups for path, groups in locations.items() if groups}
+
+
+def matching_rows(table, drug=None, reaction=None):
+    """
+    Boolean mask of the rows of a drug-event table mentioning `drug` and/or
+    `reaction` (normalized like the vocabularies).
+    """
+    mask = np.ones(table.num_rows, dtype=bool)
+    for name, term in (('drug', drug), ('reaction', reaction)):
+        if term is None:
+            continue
+        normalized = normalize_terms(pa.array([term], pa.string()), name)[0]
+        terms, rows = list_terms(table, name)
+        hits = pc.fill_null(pc.equal(terms, normalized), False).to_numpy(zero_copy_only=False)
+        found = np.zeros(table.num_rows, dtype=bool)
+        found[rows.to_numpy()[hits]] = True
+        mask &= found
+    return mask
+
+
+def read_matching(locations, drug=None, reaction=None, columns=None):
+    """
+    Read only the located row groups and keep the rows that mention the terms.
+
+    Parameters:
+        locations (dict): Path -> row groups, from lookup().
+        columns (list): Top-level columns to return; None returns every column.
+            Only these and the term columns are read.
+
+    Returns:
+        pyarrow.Table: The matching reports, with the partition month as a
+        'receive_month' column.
+    """
+    read_columns = None
+    if columns is not None:
+        read_columns = list(columns) + [column_path(name) for name in INDEXED_COLUMNS
+                                        if INDEXED_COLUMNS[name][0] not in columns]
+    tables = []
+    for path, row_groups in locations.items():
+        parquet_file = pq.ParquetFile(path)
+        table = parquet_file.read_row_groups(row_groups, columns=read_columns)
+        table = table.filter(pa.array(matching_rows(table, drug, reaction)))
+        if columns is not None:
+            table = table.select(columns)
+        month = os.path.basename(os.path.dirname(path)).split('=', 1)[1]
+        tables.append(table.append_column(PARTITION_KEY, pa.array([month] * table.num_rows, pa.string())))
+    if not tables:
+        return None
+    return pa.concat_tables(tables, promote_options='default')
+
+
+def main(dataset_dir=DATASET_DIR, index_path=INDEX_PATH):
+    """
+    Update the term index after conversion (or compaction) of the dataset.
+    """
+    start = time.perf_counter()
+    run_id = start_run(STAGE)
+    counts = update_index(dataset_dir, index_path)
+    with TermIndex(index_path) as index:
+        row_groups = index.total_row_groups()
+    print(f"Indexed {counts['indexed']} files, removed {counts['removed']}, {counts['unchanged']} unchanged; "
+          f"{row_groups} row groups in the index, updated in {time.perf_counter() - start:.1f}s")
+    if counts['indexed']:
+        print_summary(run_id)
+
+
+if __name__ == "__main__":
+    # Adjustable parameters
+    dataset_directory = DATASET_DIR  # Nested dataset written by convert_to_parquet / clean_to_parquet
+
+    main(dataset_directory)
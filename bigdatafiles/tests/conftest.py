@@ -0,0 +1,39 @@
+import os
+import sys
+import functools
+from datetime import date
+import pytest
+
+# The pipeline scripts import each other as top-level modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(autouse=True)
+def work_dir(tmp_path, monkeypatch):
+    """
+    Run every test in its own directory, since the scripts keep their
+    manifest, metrics and vocabularies relative to the working directory.
+    """
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def converted(work_dir, monkeypatch):
+    """
+    A small synthetic corpus converted to a month-partitioned dataset, with
+    receive dates confined to 2010 so it has twelve partitions.
+
+    Returns:
+        dict: {"raw": input root, "out": dataset root, "files": shard paths}
+    """
+    import synthetic_data
+    import clean_to_parquet
+    monkeypatch.setattr(synthetic_data, 'generate_record',
+                        functools.partial(synthetic_data.generate_record, start=date(2010, 1, 1), days=365))
+    raw, out = str(work_dir / 'raw'), str(work_dir / 'out')
+    corpus = synthetic_data.generate_dataset(raw, shards=3, records_per_shard=400, corrupt=0, empty=0)
+    for path in corpus["files"]:
+        result = clean_to_parquet.clean_and_convert(path, input_dir=raw, output_dir=out, normalized_dir=None)
+        assert result["error"] is None
+    return {"raw": raw, "out": out, "files": corpus["files"]}
@@ -0,0 +1,18 @@
+import os
+import benchmark
+import synthetic_data
+
+
+def test_staging_failures_are_recorded_and_bytes_are_the_staged_size(work_dir):
+    corpus = synthetic_data.generate_dataset(str(work_dir / 'raw'), shards=2, records_per_shard=40, corrupt=0, empty=0)
+    missing = str(work_dir / 'raw' / '3-drug-event-0003-of-0003.json' / 'drug-event-0003-of-0003.json')
+    os.makedirs(str(work_dir / 'run'))
+    measured = benchmark._run_stage('convert_ndjson', corpus["files"] + [missing], str(work_dir / 'raw'),
+                                    str(work_dir / 'run'))
+
+    assert measured["records"] == 80
+    assert measured["errors"] == 1
+    assert [failure["file"] for failure in measured["staging_errors"]] == [missing]
+    staged = [os.path.join(root, name) for root, _, names in os.walk(str(work_dir / 'run' / 'staged')) for name in names]
+    assert len(staged) == 2
+    assert measured["bytes"] == sum(os.path.getsize(path) for path in staged)
@@ -0,0 +1,63 @@
+import json
+import pytest
+from catalog import OTHER_QUARTER, load_catalog, select_entries
+
+BASE = 'https://download.open.fda.gov/drug/event'
+
+# (quarter, shard, shards, size in MB)
+SHARDS = [
+    ('2004q3', 1, 2, 5.0), ('2004q3', 2, 2, 7.5), ('2004q4', 1, 1, 3.0), ('2005q1', 1, 1, 9.0),
+    ('2005q2', 1, 1, None), ('2012q4', 1, 1, 11.0), (OTHER_QUARTER, 1, 1, 1.0),
+]
+
+
+@pytest.fixture
+def entries(work_dir):
+    partitions = [{"file": f"{BASE}/{quarter}/drug-event-{shard:04d}-of-{shards:04d}.json.zip",
+                   "size_mb": size, "records": 100}
+                  for quarter, shard, shards, size in SHARDS]
+    partitions.append({"file": f"{BASE}/../device/event/x.json.zip", "size_mb": 1})  # Not a drug-event shard
+    with open('download.json', 'w', encoding='utf-8') as f:
+        json.dump({"results": {"drug": {"event": {"partitions": partitions}}}}, f)
+    return load_catalog('download.json')
+
+
+def _selected(entries, **kwargs):
+    return [(entry["quarter"], entry["shard"]) for entry in select_entries(entries, **kwargs)]
+
+
+def test_everything_is_selected_largest_first(entries):
+    assert len(entries) == len(SHARDS)
+    assert entries[0]["name"] == '2004q3-drug-event-0001-of-0002.json.zip'
+    assert _selected(entries) == [('2012q4', 1), ('2005q1', 1), ('2004q3', 2), ('2004q3', 1), ('2004q4', 1),
+                                  (OTHER_QUARTER, 1), ('2005q2', 1)]
+
+
+@pytest.mark.parametrize('kwargs, expected', [
+    ({"quarters": ['2004Q3']}, [('2004q3', 2), ('2004q3', 1)]),
+    ({"quarters": ['2005', OTHER_QUARTER]}, [('2005q1', 1), (OTHER_QUARTER, 1), ('2005q2', 1)]),
+    ({"start": '2004q4', "end": '2005'}, [('2005q1', 1), ('2004q4', 1), ('2005q2', 1)]),
+    # A month range keeps the quarters overlapping it
+    ({"start": '2004-09', "end": '2004-10'}, [('2004q3', 2), ('2004q3', 1), ('2004q4', 1)]),
+    ({"start": '2006'}, [('2012q4', 1)]),
+    ({"start": '2006', "include_other": True}, [('2012q4', 1), (OTHER_QUARTER, 1)]),
+    ({"quarters": ['2004'], "end": '2004q3'}, [('2004q3', 2), ('2004q3', 1)]),
+    ({"quarters": []}, []),
+])
+def test_selection_by_quarter_and_range(entries, kwargs, expected):
+    assert _selected(entries, **kwargs) == expected
+
+
+def test_page_and_link_list_give_the_same_shards(entries):
+    links = [entry["url"] for entry in entries]
+    with open('links.txt', 'w', encoding='utf-8') as f:
+        f.write("\n".join(links + ['https://example.org/not-a-shard']) + "\n")
+    with open('page.html', 'w', encoding='utf-8') as f:
+        f.write("<ul>" + "".join(f'<li><a href="{entry["url"]}">{entry["name"]}</a> <span>{mb} MB</span></li>'
+                                 for entry, (_, _, _, mb) in zip(entries, SHARDS)) + "</ul>")
+
+    from_list = load_catalog('links.txt')
+    from_page = load_catalog('page.html')
+    assert [entry["url"] for entry in from_list] == [entry["url"] for entry in from_page] == links
+    assert [entry["size"] for entry in from_page] == [entry["size"] for entry in entries]
+    assert all(entry["size"] is None for entry in from_list)
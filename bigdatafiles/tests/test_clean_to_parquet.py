@@ -0,0 +1,60 @@
+import os
+import json
+import pyarrow as pa
+import pyarrow.parquet as pq
+import clean_to_parquet
+import data_cleaner
+import synthetic_data
+from convert_to_parquet import write_records_to_dataset
+from json_stream import iter_records
+from manifest import shard_key
+from parquet_dataset import dataset_file_name
+
+
+def _dataset(dataset_dir):
+    paths = sorted(os.path.join(root, name) for root, _, names in os.walk(dataset_dir) for name in names)
+    table = pa.concat_tables(pq.read_table(path) for path in paths)
+    return table.sort_by([('safetyreportid', 'ascending'), ('safetyreportversion', 'ascending')])
+
+
+def _keys(value):
+    if isinstance(value, dict):
+        return set(value) | {key for child in value.values() for key in _keys(child)}
+    if isinstance(value, list):
+        return {key for child in value for key in _keys(child)}
+    return set()
+
+
+def test_fused_pipeline_matches_clean_then_convert(work_dir):
+    corpus = synthetic_data.generate_dataset('raw', shards=2, records_per_shard=200, corrupt=0, empty=0)
+    for path in corpus["files"]:
+        result = clean_to_parquet.clean_and_convert(path, input_dir='raw', output_dir='fused',
+                                                    debug_json_dir='debug', normalized_dir=None)
+        assert result["error"] is None and result["records"] == 200
+
+        # The two-stage path: a cleaned JSON copy, then conversion of that copy
+        relative = os.path.relpath(path, 'raw')
+        cleaned = os.path.join('cleaned', relative)
+        os.makedirs(os.path.dirname(cleaned))
+        data_cleaner.clean_file_streaming(path, cleaned)
+        with open(cleaned, encoding='utf-8') as f:
+            write_records_to_dataset(iter_records(f), 'staged', dataset_file_name(cleaned, 'cleaned'),
+                                     shard_key(cleaned, 'cleaned'))
+
+        with open(os.path.join('debug', relative), encoding='utf-8') as f:
+            debug = json.load(f)
+        with open(cleaned, encoding='utf-8') as f:
+            assert debug == json.load(f)
+        assert not _keys(debug) & set(data_cleaner.FIELDS_TO_REMOVE)
+
+    assert _dataset('fused').equals(_dataset('staged'))
+
+
+def test_main_skips_shards_already_converted(work_dir):
+    synthetic_data.generate_dataset('raw', shards=2, records_per_shard=50, corrupt=0, empty=0)
+
+    first = clean_to_parquet.main(input_dir='raw', output_dir='out', normalized_dir=None, max_workers=1)
+    assert first["files"] == 2 and first["records"] == 100 and not first["errors"]
+    second = clean_to_parquet.main(input_dir='raw', output_dir='out', normalized_dir=None, max_workers=1)
+    assert second["files"] == 0
+    assert _dataset('out').num_rows == 100
@@ -0,0 +1,84 @@
+import glob
+import os
+import pyarrow as pa
+import pyarrow.parquet as pq
+import clean_to_parquet
+import compact_parquet
+from convert_to_parquet import drop_stale_compacted_rows
+from parquet_dataset import compacted_inputs, dataset_file_name, file_shards
+
+
+def report_ids(dataset_dir):
+    tables = [pq.read_table(path, columns=['safetyreportid'])
+              for path in glob.glob(os.path.join(dataset_dir, '*', '*.parquet'))]
+    return sorted(pa.concat_tables(tables).column(0).to_pylist())
+
+
+def test_sorted_compaction_merges_runs(converted, monkeypatch):
+    # Tiny runs and batches so every partition goes through the k-way merge
+    monkeypatch.setattr(compact_parquet, 'SORT_RUN_ROWS', 3)
+    monkeypatch.setattr(compact_parquet, 'READ_BATCH_SIZE', 2)
+    before = report_ids(converted["out"])
+
+    compact_parquet.main(converted["out"], sort=True)
+
+    assert report_ids(converted["out"]) == before
+    for partition_dir in compact_parquet.list_partitions(converted["out"]):
+        files = os.listdir(partition_dir)
+        assert len(files) == 1 and files[0].startswith('compacted-')
+        path = os.path.join(partition_dir, files[0])
+        table = pq.read_table(path, columns=['receivedate', 'safetyreportid'])
+        assert table.equals(table.sort_by(compact_parquet.SORT_COLUMNS))
+        shards = set(pq.read_table(path, columns=['shard']).column(0).to_pylist())
+        assert set(file_shards(path)) == shards
+
+
+def test_reconversion_after_compaction_is_idempotent(converted):
+    before = report_ids(converted["out"])
+    compact_parquet.main(converted["out"])
+
+    result = clean_to_parquet.clean_and_convert(converted["files"][1], input_dir=converted["raw"],
+                                                output_dir=converted["out"], normalized_dir=None)
+
+    assert result["error"] is None
+    assert drop_stale_compacted_rows(converted["out"]) > 0
+    assert report_ids(converted["out"]) == before
+    # Merging compacted files with per-shard files keeps provenance intact
+    compact_parquet.main(converted["out"])
+    clean_to_parquet.clean_and_convert(converted["files"][0], input_dir=converted["raw"],
+                                       output_dir=converted["out"], normalized_dir=None)
+    # Compaction drops the stale rows itself before merging
+    compact_parquet.main(converted["out"])
+    assert report_ids(converted["out"]) == before
+    assert not glob.glob(os.path.join(converted["out"], '*', '.*'))
+
+
+def test_interrupted_compaction_is_finished(converted):
+    partition_dir = compact_parquet.list_partitions(converted["out"])[0]
+    inputs = compact_parquet.list_files(partition_dir)
+    before = report_ids(converted["out"])
+    # Merged file in place, inputs not deleted yet
+    compact_parquet.merge_files(inputs, os.path.join(partition_dir, compact_parquet.compacted_file_name(inputs)))
+
+    compact_parquet.recover_partition(partition_dir)
+
+    assert len(compact_parquet.list_files(partition_dir)) == 1
+    assert report_ids(converted["out"]) == before
+
+
+def test_recovery_keeps_inputs_reconverted_since_the_merge(converted):
+    partition_dir = compact_parquet.list_partitions(converted["out"])[0]
+    inputs = compact_parquet.list_files(partition_dir)
+    merged = os.path.join(partition_dir, compact_parquet.compacted_file_name(inputs))
+    compact_parquet.merge_files(inputs, merged)
+    assert compacted_inputs(merged) == [os.path.basename(path) for path in inputs]
+    # A shard converted again before the interrupted compaction was finished
+    clean_to_parquet.clean_and_convert(converted["files"][0], input_dir=converted["raw"],
+                                       output_dir=converted["out"], normalized_dir=None)
+    name = dataset_file_name(converted["files"][0], converted["raw"])
+    reconverted = [path for path in inputs if os.path.basename(path) == name]
+
+    compact_parquet.recover_partition(partition_dir)
+
+    assert reconverted and all(os.path.exists(path) for path in reconverted)
+    assert sorted(compact_parquet.list_files(partition_dir)) == sorted(reconverted + [merged])
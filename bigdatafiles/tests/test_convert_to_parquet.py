@@ -0,0 +1,78 @@
+import os
+import json
+import pyarrow as pa
+import pyarrow.parquet as pq
+import convert_to_parquet
+import data_cleaner
+import synthetic_data
+from drug_event_schema import UNKNOWN_FIELDS_COLUMN
+
+
+def _dataset(dataset_dir):
+    paths = sorted(os.path.join(root, name) for root, _, names in os.walk(dataset_dir) for name in names)
+    table = pa.concat_tables(pq.read_table(path) for path in paths)
+    return table.sort_by([('safetyreportid', 'ascending'), ('safetyreportversion', 'ascending')])
+
+
+def _clean(monkeypatch, ndjson):
+    monkeypatch.setattr(data_cleaner, 'INPUT_DIR', 'raw')
+    monkeypatch.setattr(data_cleaner, 'OUTPUT_DIR', 'cleaned')
+    for source in sorted(os.listdir('raw')):
+        directory = os.path.join('raw', source)
+        result = data_cleaner.process_large_file(os.path.join(directory, os.listdir(directory)[0]), ndjson=ndjson)
+        assert result.endswith("successfully.")
+
+
+def _convert(monkeypatch, output_dir, native):
+    monkeypatch.setattr(convert_to_parquet, 'INPUT_DIR', 'cleaned')
+    monkeypatch.setattr(convert_to_parquet, 'OUTPUT_DIR', output_dir)
+    monkeypatch.setattr(convert_to_parquet, 'NORMALIZED_DIR', None)
+    monkeypatch.setattr(convert_to_parquet, 'NATIVE_JSON', native)
+    for root, _, names in sorted(os.walk('cleaned')):
+        for name in names:
+            result = convert_to_parquet.convert_json_to_parquet(os.path.join(root, name))
+            assert result.endswith("successfully."), result
+
+
+def test_ndjson_staging_converts_like_the_json_shards(work_dir, monkeypatch):
+    synthetic_data.generate_dataset('raw', shards=2, records_per_shard=150, corrupt=0, empty=0)
+    _clean(monkeypatch, ndjson=False)
+    _convert(monkeypatch, 'from_json', native=False)
+
+    # Restaging as NDJSON replaces the JSON copy of every shard
+    _clean(monkeypatch, ndjson=True)
+    staged = sorted(os.path.join(root, name) for root, _, names in os.walk('cleaned') for name in names)
+    assert len(staged) == 2 and all(path.endswith('.ndjson') for path in staged)
+    with open(staged[0], encoding='utf-8') as f:
+        lines = f.read().splitlines()
+    assert len(lines) == 150 and all('meta' not in json.loads(line) for line in lines)
+
+    _convert(monkeypatch, 'native', native=True)
+    _convert(monkeypatch, 'python', native=False)
+    expected = _dataset('from_json')
+    assert _dataset('native').equals(expected)
+    assert _dataset('python').equals(expected)
+
+
+def test_shards_the_native_reader_rejects_fall_back_to_python(work_dir, monkeypatch):
+    synthetic_data.generate_dataset('raw', shards=1, records_per_shard=100, corrupt=0, empty=0)
+    _clean(monkeypatch, ndjson=True)
+    _convert(monkeypatch, 'expected', native=False)
+
+    # A field the schema doesn't know, which the native reader refuses
+    (staged,) = [os.path.join(root, name) for root, _, names in os.walk('cleaned') for name in names]
+    with open(staged, encoding='utf-8') as f:
+        records = [json.loads(line) for line in f]
+    records[40]["newfield"] = "kept"
+    with open(staged, 'w', encoding='utf-8') as f:
+        f.writelines(json.dumps(record) + "\n" for record in records)
+
+    _convert(monkeypatch, 'fallback', native=True)
+    table = _dataset('fallback')
+    assert table.num_rows == 100
+    expected = _dataset('expected')
+    assert table.drop_columns([UNKNOWN_FIELDS_COLUMN]).equals(expected.drop_columns([UNKNOWN_FIELDS_COLUMN]))
+    unknown = [value for value in table.column(UNKNOWN_FIELDS_COLUMN).to_pylist() if value]
+    assert len(unknown) == 1 and json.loads(unknown[0]) == {"newfield": "kept"}
+    with open(convert_to_parquet.ERROR_LOG, encoding='utf-8') as f:
+        assert "Native JSON reader rejected the shard" in f.read()
@@ -0,0 +1,33 @@
+import os
+import json
+import pytest
+import data_cleaner
+import synthetic_data
+
+
+def test_failed_clean_keeps_the_previous_output(work_dir):
+    corpus = synthetic_data.generate_dataset('raw', shards=1, records_per_shard=50, corrupt=1, empty=0)
+    good, truncated = corpus["files"][0], os.path.join('raw', '2-drug-event-0002-of-0002.json',
+                                                      'drug-event-0002-of-0002.json')
+    assert data_cleaner.clean_file_streaming(good, 'out.json') == 50
+    before = open('out.json', 'rb').read()
+
+    with pytest.raises(ValueError):
+        data_cleaner.clean_file_streaming(truncated, 'out.json')
+    assert open('out.json', 'rb').read() == before
+    assert len(json.loads(before)["results"]) == 50
+    assert sorted(os.listdir('.')) == ['out.json', 'raw']
+
+
+@pytest.mark.parametrize("document", [[{"safetyreportid": "1"}], "not a shard", {"meta": {}}])
+def test_in_memory_ndjson_staging_of_documents_without_results(work_dir, monkeypatch, document):
+    monkeypatch.setattr(data_cleaner, 'INPUT_DIR', 'raw')
+    monkeypatch.setattr(data_cleaner, 'OUTPUT_DIR', 'cleaned')
+    os.makedirs(os.path.join('raw', 'shard.json'))
+    with open(os.path.join('raw', 'shard.json', 'shard.json'), 'w', encoding='utf-8') as f:
+        json.dump(document, f)
+
+    result = data_cleaner.process_large_file(os.path.join('raw', 'shard.json', 'shard.json'),
+                                             streaming=False, ndjson=True)
+    assert result.endswith("successfully.")
+    assert os.path.getsize(os.path.join('cleaned', 'shard.json', 'shard.ndjson')) == 0
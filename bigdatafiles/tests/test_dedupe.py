@@ -0,0 +1,97 @@
+import os
+import json
+import random
+import shutil
+import pyarrow as pa
+import pyarrow.parquet as pq
+import clean_to_parquet
+import dedupe
+import synthetic_data
+
+NUM_BUCKETS = 8
+
+
+def _write_shard(name, versions):
+    """
+    Write and convert a shard holding report id -> safetyreportversion.
+    """
+    rng = random.Random(name)
+    records = []
+    for report_id, version in versions.items():
+        record = synthetic_data.generate_record(rng, report_id)
+        record["safetyreportversion"] = version
+        records.append(record)
+    path = os.path.join('raw', f"{name}.json", f"{name}.json")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({"results": records}, f)
+    result = clean_to_parquet.clean_and_convert(path, input_dir='raw', output_dir='out', normalized_dir='norm')
+    assert result["error"] is None
+
+
+def _dropped(shard):
+    path = dedupe.dropped_path('dedupe', shard)
+    if not os.path.exists(path):
+        return None
+    table = pq.read_table(path)
+    assert set(table.column('shard').to_pylist()) == {shard}
+    return sorted(zip(table.column('safetyreportid').to_pylist(), table.column('safetyreportversion').to_pylist()))
+
+
+def _bucket_mtimes():
+    return {bucket: os.stat(dedupe.bucket_path('dedupe', bucket)).st_mtime_ns
+            for bucket in range(NUM_BUCKETS) if os.path.exists(dedupe.bucket_path('dedupe', bucket))}
+
+
+def _all_keys(dedupe_dir):
+    rows = []
+    for bucket in range(NUM_BUCKETS):
+        if os.path.exists(dedupe.bucket_path(dedupe_dir, bucket)):
+            table = pq.read_table(dedupe.bucket_path(dedupe_dir, bucket), columns=['safetyreportid', 'shard', 'dropped'])
+            rows.extend(table.to_pylist())
+    return sorted(rows, key=lambda row: (row['safetyreportid'], row['shard']))
+
+
+def _buckets(ids):
+    return set(dedupe.bucket_of(pa.array([str(i) for i in ids]), NUM_BUCKETS).to_pylist())
+
+
+def test_later_versions_in_other_shards_supersede_and_reruns_are_incremental(work_dir):
+    _write_shard('old_q1', {i: '1' for i in range(1, 41)})
+    _write_shard('new_q2', {**{i: '2' for i in range(1, 21)}, **{i: '1' for i in range(100, 110)}})
+    _write_shard('other_q3', {i: '1' for i in range(200, 210)})
+
+    summary = dedupe.main('norm', 'dedupe', NUM_BUCKETS)
+    assert summary["duplicates_dropped"] == 20
+    assert _dropped('old_q1') == sorted((str(i), '1') for i in range(1, 21))
+    assert _dropped('new_q2') is None and _dropped('other_q3') is None
+
+    # Nothing changed: nothing is read or rewritten
+    mtimes = _bucket_mtimes()
+    summary = dedupe.main('norm', 'dedupe', NUM_BUCKETS)
+    assert summary["shards_indexed"] == 0 and summary["buckets_rewritten"] == 0
+    assert _bucket_mtimes() == mtimes
+
+    # A changed shard rewrites only the buckets of its old and new ids
+    _write_shard('new_q2', {1: '2', 300: '1'})
+    summary = dedupe.main('norm', 'dedupe', NUM_BUCKETS)
+    touched = _buckets(list(range(1, 21)) + list(range(100, 110)) + [300])
+    assert summary["shards_indexed"] == 1 and summary["buckets_rewritten"] == len(touched)
+    after = _bucket_mtimes()
+    assert {bucket for bucket in after if after[bucket] != mtimes.get(bucket)} == touched
+    assert _dropped('old_q1') == [('1', '1')]
+
+    # The same result as deduplicating from scratch
+    shutil.copytree('dedupe', 'incremental')
+    shutil.rmtree('dedupe')
+    fresh = dedupe.main('norm', 'dedupe', NUM_BUCKETS)
+    assert fresh["duplicates_dropped"] == summary["duplicates_dropped"] == 1
+    assert _all_keys('incremental') == _all_keys('dedupe')
+
+    # A removed shard no longer supersedes anything
+    for path in dedupe.list_shard_files('norm')['new_q2'].values():
+        for file_path in path:
+            os.remove(file_path)
+    summary = dedupe.main('norm', 'dedupe', NUM_BUCKETS)
+    assert summary["shards_removed"] == 1 and summary["duplicates_dropped"] == 0
+    assert _dropped('old_q1') is None
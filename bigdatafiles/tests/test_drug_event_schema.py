@@ -0,0 +1,109 @@
+import json
+import random
+from datetime import datetime
+import pyarrow as pa
+import convert_to_parquet
+import synthetic_data
+from data_cleaner import FIELDS_TO_REMOVE, remove_fields_from_dict
+from drug_event_schema import (AGE_UNIT_YEARS, DERIVED_FIELDS, DRUG_EVENT_SCHEMA, UNKNOWN_FIELDS_COLUMN, conform_record,
+                               record_type, records_to_batch)
+
+
+def _records(count, seed=0):
+    rng = random.Random(seed)
+    return [synthetic_data.generate_record(rng, 10 ** 7 + i) for i in range(count)]
+
+
+def _check(raw, typed, arrow_type, path, unknown):
+    """
+    Assert that `typed` holds `raw` parsed into `arrow_type`, with whatever
+    the type cannot hold listed in `unknown` under its dotted path.
+    """
+    if pa.types.is_struct(arrow_type):
+        for key, value in raw.items():
+            child_path = f"{path}.{key}" if path else key
+            if arrow_type.get_field_index(key) < 0:
+                assert unknown.pop(child_path) == value
+            else:
+                _check(value, typed[key], arrow_type.field(key).type, child_path, unknown)
+        for field in arrow_type:
+            if field.name not in raw and field.name not in DERIVED_FIELDS:
+                assert typed[field.name] is None, f"{path}.{field.name}"
+    elif pa.types.is_list(arrow_type):
+        assert len(typed) == len(raw)
+        for i, (raw_item, typed_item) in enumerate(zip(raw, typed)):
+            _check(raw_item, typed_item, arrow_type.value_type, f"{path}.{i}", unknown)
+    elif pa.types.is_date(arrow_type):
+        assert typed == datetime.strptime(raw, '%Y%m%d').date()
+    elif pa.types.is_integer(arrow_type):
+        assert typed == int(raw)
+    elif pa.types.is_floating(arrow_type):
+        assert typed == float(raw)
+    else:
+        assert typed == raw
+
+
+def test_typed_records_and_unknown_fields_hold_the_original_record():
+    records = _records(200)
+    records[0]["patient"]["drug"][0]["newfield"] = "new"
+    records[1]["sender"] = "not an object"
+    typed = records_to_batch(records).to_pylist()
+
+    for raw, row in zip(records, typed):
+        unknown = json.loads(row[UNKNOWN_FIELDS_COLUMN]) if row[UNKNOWN_FIELDS_COLUMN] else {}
+        if isinstance(raw.get("sender"), str):
+            assert unknown.pop("sender") == raw.pop("sender")
+        _check(raw, row, record_type(), '', unknown)
+        assert unknown == {}
+    assert json.loads(typed[0][UNKNOWN_FIELDS_COLUMN])["patient.drug.0.newfield"] == "new"
+    assert conform_record(records[2])[UNKNOWN_FIELDS_COLUMN] is not None  # openfda identifiers
+
+
+def test_patient_age_in_years_is_derived_from_the_unit():
+    records = _records(300)
+    for row, raw in zip(records_to_batch(records).to_pylist(), records):
+        patient = raw["patient"]
+        years = row["patient"]["patientonsetage_years"]
+        if "patientonsetage" in patient:
+            expected = float(patient["patientonsetage"]) * AGE_UNIT_YEARS[patient["patientonsetageunit"]]
+            assert abs(years - expected) < 1e-9
+        else:
+            assert years is None
+
+
+def test_arrow_ndjson_reader_types_records_like_the_python_path(work_dir):
+    records = [remove_fields_from_dict(record, FIELDS_TO_REMOVE) for record in _records(600, seed=1)]
+    with open('shard.ndjson', 'w', encoding='utf-8') as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+    batches = list(convert_to_parquet.read_ndjson_batches('shard.ndjson', block_size=1 << 16))
+    assert len(batches) > 1
+    native = pa.Table.from_batches(batches, schema=DRUG_EVENT_SCHEMA)
+    assert native.equals(pa.Table.from_batches([records_to_batch(records)]))
+
+
+def test_values_that_fail_to_parse_keep_their_original_string(work_dir):
+    records = [remove_fields_from_dict(record, FIELDS_TO_REMOVE) for record in _records(3, seed=2)]
+    records[0]["receivedate"] = "2004-13-99"
+    records[0]["patient"]["patientweight"] = "heavy"
+    records[0]["patient"]["drug"].append(dict(records[0]["patient"]["drug"][0], drugstartdate="soon"))
+    records[1]["patient"]["reaction"][0]["reactionoutcome"] = "999"
+    records[2]["receivedate"] = "  "
+    last_drug = len(records[0]["patient"]["drug"]) - 1
+    expected = [
+        {"receivedate": "2004-13-99", "patient.patientweight": "heavy",
+         f"patient.drug.{last_drug}.drugstartdate": "soon"},
+        {"patient.reaction.0.reactionoutcome": "999"},
+        {},
+    ]
+    with open('shard.ndjson', 'w', encoding='utf-8') as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+    native = pa.Table.from_batches(list(convert_to_parquet.read_ndjson_batches('shard.ndjson')))
+
+    for rows in (records_to_batch(records).to_pylist(), native.to_pylist()):
+        for row, unknown in zip(rows, expected):
+            assert (json.loads(row[UNKNOWN_FIELDS_COLUMN]) if row[UNKNOWN_FIELDS_COLUMN] else {}) == unknown
+        assert rows[0]["receivedate"] is None and rows[0]["patient"]["patientweight"] is None
+        assert rows[0]["patient"]["drug"][last_drug]["drugstartdate"] is None
+        assert rows[1]["patient"]["reaction"][0]["reactionoutcome"] is None
@@ -0,0 +1,35 @@
+import json
+import functools
+import file_analysis
+import synthetic_data
+
+
+def test_shard_profiles_merge_in_any_order_and_cover_every_record(work_dir):
+    corpus = synthetic_data.generate_dataset('raw', shards=3, records_per_shard=60, corrupt=0, empty=0)
+    profiles = [file_analysis.profile_json_file(path) for path in corpus["files"]]
+    forward = functools.reduce(file_analysis.merge_profiles, profiles, file_analysis.empty_profile())
+    backward = functools.reduce(file_analysis.merge_profiles, reversed(profiles),
+                                file_analysis.empty_profile())
+    assert forward["files"] == 3 and forward["records"] == 180 and not forward["errors"]
+    # Path order differs with merge order, the statistics don't
+    assert json.dumps(forward, sort_keys=True) == json.dumps(backward, sort_keys=True)
+
+    # Every record and every drug in it is profiled, not just the first
+    records = []
+    for path in corpus["files"]:
+        with open(path, encoding='utf-8') as f:
+            records.extend(json.load(f)["results"])
+    drugs = forward["paths"]["results[].patient.drug[]"]
+    assert drugs["present"] == sum(len(record["patient"]["drug"]) for record in records)
+    assert forward["paths"]["results[]"]["present"] == 180
+    assert forward["paths"]["results"]["list_items"] == 180
+    assert forward["paths"]["results"]["files"] == 3
+
+    # Keys only some shards have are reported with the number of files holding them
+    missing = {"meta": {}, "results": [{"safetyreportid": "1", "patient": {"drug": []}}]}
+    with open('partial.json', 'w', encoding='utf-8') as f:
+        json.dump(missing, f)
+    report = file_analysis.summarize_profile(
+        file_analysis.merge_profiles(forward, file_analysis.profile_json_file('partial.json')), depth=2)
+    assert 'results.safetyreportid' in report["common_keys"]
+    assert report["partial_keys"]["results.receivedate"] == 3
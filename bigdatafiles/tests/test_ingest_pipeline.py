@@ -0,0 +1,67 @@
+import queue
+import threading
+import pytest
+import synthetic_data
+import ingest_pipeline
+
+
+def test_convert_stage_skips_unreadable_archive(work_dir):
+    corpus = synthetic_data.generate_dataset('Data', shards=2, records_per_shard=50, corrupt=0, empty=0, as_zip=True)
+    broken = 'Data/9-drug-event-0001-of-0001.json.zip'
+    with open(broken, 'wb') as f:
+        f.write(b'not a zip')
+    archives = queue.Queue()
+    for path in [broken] + corpus["files"] + [ingest_pipeline._DONE]:
+        archives.put(path)
+    stats = ingest_pipeline.StageStats()
+
+    ingest_pipeline._convert_stage(archives, 'Data', 'out', 1, stats)
+
+    assert stats.counts["convert_done"] == 2
+    assert stats.counts["convert_failed"] == 1
+    assert stats.counts["records"] == 100
+
+
+def test_download_stage_stops_when_converters_are_gone():
+    archives = queue.Queue(maxsize=1)
+    stop = threading.Event()
+    completed = [('link', f'archive-{i}.zip', 'shard', None) for i in range(3)]
+    downloader = threading.Thread(
+        target=ingest_pipeline._download_stage,
+        args=([], completed, archives, None, 1, ingest_pipeline.StageStats(), stop),
+    )
+    downloader.start()
+    stop.set()
+    downloader.join(timeout=10)
+    assert not downloader.is_alive()
+
+
+def test_failed_submit_frees_its_backlog_slot(work_dir, monkeypatch):
+    corpus = synthetic_data.generate_dataset('Data', shards=1, records_per_shard=10, corrupt=0, empty=0, as_zip=True)
+    semaphores, bounded_semaphore = [], threading.BoundedSemaphore
+
+    def semaphore(value):
+        semaphores.append(bounded_semaphore(value))
+        return semaphores[-1]
+
+    class FailingExecutor:
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def submit(self, *args, **kwargs):
+            raise RuntimeError("cannot start a worker")
+
+        def shutdown(self, wait=True):
+            pass
+
+    monkeypatch.setattr(ingest_pipeline.threading, 'BoundedSemaphore', semaphore)
+    monkeypatch.setattr(ingest_pipeline, 'ProcessPoolExecutor', FailingExecutor)
+    archives = queue.Queue()
+    for path in corpus["files"] + [ingest_pipeline._DONE]:
+        archives.put(path)
+
+    with pytest.raises(RuntimeError):
+        ingest_pipeline._convert_stage(archives, 'Data', 'out', 1, ingest_pipeline.StageStats())
+
+    slots = semaphores[0]
+    assert all(slots.acquire(blocking=False) for _ in range(1 + ingest_pipeline.MAX_CONVERT_BACKLOG))
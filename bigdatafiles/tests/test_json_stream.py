@@ -0,0 +1,47 @@
+import os
+import json
+import pytest
+import synthetic_data
+from json_stream import Quarantine, iter_records
+
+
+def _records(path, **kwargs):
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        return list(iter_records(f, **kwargs))
+
+
+@pytest.mark.parametrize('chunk_size', [64, 1024 * 1024])
+def test_truncated_shard_yields_every_record_before_the_cut(work_dir, chunk_size):
+    synthetic_data.generate_dataset('raw', shards=1, records_per_shard=200, corrupt=1, empty=0)
+    truncated = os.path.join('raw', '2-drug-event-0002-of-0002.json', 'drug-event-0002-of-0002.json')
+    # The corrupt shard is a 20-record shard with seed 1, cut at two thirds of its size
+    synthetic_data.write_shard('full.json', 20, 1)
+    full = _records('full.json')
+
+    with pytest.raises(ValueError):
+        _records(truncated, chunk_size=chunk_size)
+    quarantine = Quarantine(truncated, path='quarantine.jsonl')
+    salvaged = _records(truncated, chunk_size=chunk_size, on_error=quarantine)
+
+    assert 0 < len(salvaged) < len(full)
+    assert salvaged == full[:len(salvaged)]
+    assert quarantine.ranges == 1
+    with open('quarantine.jsonl', encoding='utf-8') as f:
+        entry = json.loads(f.readline())
+    assert entry["error"].startswith("Truncated")
+    assert entry["end"] == entry["start"] + quarantine.bytes
+
+
+def test_corrupt_record_is_skipped_and_reading_resumes(work_dir):
+    synthetic_data.write_shard('shard.json', 30, 0)
+    full = _records('shard.json')
+    text = open('shard.json', encoding='utf-8').read()
+    # Break the tenth record in the middle
+    start = text.index(json.dumps(full[9]['safetyreportid']))
+    with open('broken.json', 'w', encoding='utf-8') as f:
+        f.write(text[:start] + '#garbage#' + text[start + 1:])
+
+    quarantine = Quarantine('broken.json', path='quarantine.jsonl')
+    salvaged = _records('broken.json', chunk_size=128, on_error=quarantine)
+    assert salvaged == full[:9] + full[10:]
+    assert quarantine.ranges == 1
@@ -0,0 +1,46 @@
+import os
+import synthetic_data
+from manifest import Manifest
+from shard_sources import list_json_sources, split_zip_member
+
+
+def test_only_changed_or_unfinished_sources_are_pending(work_dir):
+    synthetic_data.generate_dataset('raw', shards=3, records_per_shard=20, corrupt=0, empty=0)
+    sources = list_json_sources('raw')
+    with Manifest() as manifest:
+        pending = manifest.pending_sources('convert', sources, 'raw', 2)
+        assert sorted(pending) == sources
+        assert [shard for shard, _ in pending.values()] == [
+            f"{i}-drug-event-000{i}-of-0003" for i in (1, 2, 3)]
+        manifest.record_results('convert', pending, {sources[0]: True, sources[1]: "Broken shard"})
+
+        assert sorted(manifest.pending_sources('convert', sources, 'raw', 2)) == sources[1:]
+        assert manifest.status()['convert']['failed_shards'] == ['2-drug-event-0002-of-0003']
+        # Another stage, or another output version of this one, starts from scratch
+        assert sorted(manifest.pending_sources('analyze', sources, 'raw')) == sources
+        assert sorted(manifest.pending_sources('convert', sources, 'raw', 3)) == sources
+
+        # A source rewritten since it succeeded is pending again
+        stat = os.stat(sources[0])
+        os.utime(sources[0], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        assert sorted(manifest.pending_sources('convert', sources, 'raw', 2)) == sources
+
+
+def test_zip_members_are_tracked_by_content(work_dir):
+    synthetic_data.generate_dataset('raw', shards=2, records_per_shard=20, corrupt=0, empty=0, as_zip=True)
+    sources = list_json_sources('raw')
+    assert len(sources) == 2
+    with Manifest() as manifest:
+        manifest.record_results('clean', manifest.pending_sources('clean', sources, 'raw'),
+                                {source: True for source in sources})
+        version = manifest.version()
+        # Touching an archive changes its mtime but not its members' size and CRC
+        archive, _ = split_zip_member(sources[0])
+        stat = os.stat(archive)
+        os.utime(archive, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        assert manifest.pending_sources('clean', sources, 'raw') == {}
+        assert manifest.version() == version
+
+    with Manifest() as manifest:
+        assert manifest.status()['clean']['done'] == 2
+        assert manifest.get_shard('1-drug-event-0001-of-0002')["shard"] == '1-drug-event-0001-of-0002'
@@ -0,0 +1,41 @@
+import os
+import pytest
+import metrics
+
+
+def test_track_records_successes_and_failures_per_run(work_dir, monkeypatch, capsys):
+    # start_run sets the run id in the environment; restored after the test
+    monkeypatch.delenv(metrics.RUN_ID_ENV, raising=False)
+    run_id = metrics.start_run('convert')
+    with metrics.track('convert', 'a.json', bytes_in=2048) as m:
+        m.records = 10
+        m.bytes_out = 1024
+    with pytest.raises(ValueError):
+        with metrics.track('convert', 'b.json', bytes_in=1024):
+            raise ValueError("truncated shard")
+    monkeypatch.setenv(metrics.RUN_ID_ENV, 'another-run')
+    with metrics.track('clean', 'c.json'):
+        pass
+
+    entries = metrics.load_metrics(run_id=run_id)
+    assert [(entry["file"], entry["records"], entry["error"]) for entry in entries] == [
+        ('a.json', 10, None), ('b.json', None, "truncated shard")]
+    assert all(entry["seconds"] >= 0 and entry["peak_rss_mb"] > 0 for entry in entries)
+    assert metrics.latest_run_id() == 'another-run'
+
+    summary = metrics.print_summary(run_id)
+    assert summary["stages"] == {"convert": {
+        "files": 2, "errors": 1, "seconds": pytest.approx(sum(entry["seconds"] for entry in entries)),
+        "records": 10, "bytes_in": 3072, "bytes_out": 1024,
+        "peak_rss_mb": max(entry["peak_rss_mb"] for entry in entries),
+    }}
+    output = capsys.readouterr().out
+    assert "failed: convert b.json: truncated shard" in output and "c.json" not in output
+
+
+@pytest.mark.parametrize("mode, suffix", [('cprofile', '.prof'), ('sample', '.folded')])
+def test_profile_hook_writes_one_profile_per_file(work_dir, monkeypatch, mode, suffix):
+    monkeypatch.setenv(metrics.PROFILE_ENV, mode)
+    with metrics.track('convert', os.path.join('raw', 'shard 1.json')):
+        sum(i * i for i in range(200000))
+    assert os.listdir(os.path.join(metrics.PROFILE_DIR, 'convert')) == [f"raw_shard_1.json{suffix}"]
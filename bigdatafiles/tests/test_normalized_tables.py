@@ -0,0 +1,47 @@
+import os
+import shutil
+import clean_to_parquet
+import compact_parquet
+import rollups
+import synthetic_data
+from normalized_tables import DRUGS, REPORTS, list_shard_files
+
+
+def _cube_counts(shard_files):
+    return {
+        shard: {cube: table.sort_by([(name, 'ascending') for name in table.column_names]).to_pylist()
+                for cube, table in rollups.compute_deltas(shard, files).items()}
+        for shard, files in shard_files.items()
+    }
+
+
+def test_shards_are_read_from_the_files_not_their_names(work_dir):
+    corpus = synthetic_data.generate_dataset('generated', shards=2, records_per_shard=120, corrupt=0, empty=0)
+    # Shard keys with underscores, which file names can't be split on
+    sources = []
+    for i, path in enumerate(corpus["files"]):
+        source = os.path.join('raw', f"drug_event_{i}.json", 'part_0001_of_0002.json')
+        os.makedirs(os.path.dirname(source))
+        shutil.copy(path, source)
+        sources.append(source)
+    for source in sources:
+        clean_to_parquet.clean_and_convert(source, input_dir='raw', output_dir='out', normalized_dir='norm')
+
+    shard_files = list_shard_files('norm')
+    assert sorted(shard_files) == ['drug_event_0', 'drug_event_1']
+    before = _cube_counts(shard_files)
+    assert before['drug_event_0'] != before['drug_event_1']
+
+    # A compacted file is listed under both shards and each reads only its own rows
+    compact_parquet.main(os.path.join('norm', REPORTS))
+    compact_parquet.main(os.path.join('norm', DRUGS))
+    shard_files = list_shard_files('norm')
+    shared = set(shard_files['drug_event_0'][REPORTS]) & set(shard_files['drug_event_1'][REPORTS])
+    assert shared and all(os.path.basename(path).startswith('compacted-') for path in shared)
+    assert _cube_counts(shard_files) == before
+
+    # Until the stale rows are dropped, compacted files holding an earlier conversion are left out
+    clean_to_parquet.clean_and_convert(sources[0], input_dir='raw', output_dir='out', normalized_dir='norm')
+    shard_files = list_shard_files('norm')
+    assert all('compacted-' not in path for path in shard_files['drug_event_0'][REPORTS])
+    assert _cube_counts(shard_files) == before
@@ -0,0 +1,144 @@
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+import parallel_downloader
+from parallel_downloader import ByteBudget, download_one
+
+PAYLOAD = os.urandom(200 * 1024)
+
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    /file serves PAYLOAD with Range support, /drop cuts the first response
+    off halfway, /norange ignores Range headers.
+    """
+    requests_seen = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        Handler.requests_seen.append((self.path, self.headers.get('Range')))
+        start = 0
+        byte_range = self.headers.get('Range')
+        if byte_range and self.path != '/norange':
+            start = int(byte_range.split('=')[1].split('-')[0])
+            if start >= len(PAYLOAD):
+                self.send_response(416)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+        else:
+            self.send_response(200)
+        body = PAYLOAD[start:]
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.path == '/drop' and sum(path == '/drop' for path, _ in Handler.requests_seen) == 1:
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            self.connection.close()
+            return
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(parallel_downloader, 'CHUNK_SIZE', 16 * 1024)
+    Handler.requests_seen = []
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_dropped_connection_resumes_with_range(server, work_dir):
+    result = download_one(f"{server}/drop", 'shard.zip', ByteBudget(10 ** 9), backoff=0)
+
+    assert result["status"] == "done"
+    with open('shard.zip', 'rb') as f:
+        assert f.read() == PAYLOAD
+    assert result["sha256"] == hashlib.sha256(PAYLOAD).hexdigest()
+    assert Handler.requests_seen[0] == ('/drop', None)
+    assert Handler.requests_seen[-1][1].startswith('bytes=') and Handler.requests_seen[-1][1] != 'bytes=0-'
+    assert not os.path.exists('shard.zip' + parallel_downloader.PART_SUFFIX)
+
+
+def test_server_ignoring_range_restarts_from_scratch(server, work_dir):
+    with open('shard.zip' + parallel_downloader.PART_SUFFIX, 'wb') as f:
+        f.write(b'stale partial content')
+
+    result = download_one(f"{server}/norange", 'shard.zip', ByteBudget(10 ** 9), backoff=0)
+
+    assert result["status"] == "done"
+    with open('shard.zip', 'rb') as f:
+        assert f.read() == PAYLOAD
+
+
+def test_complete_partial_file_is_accepted_on_416(server, work_dir):
+    with open('shard.zip' + parallel_downloader.PART_SUFFIX, 'wb') as f:
+        f.write(PAYLOAD)
+
+    result = download_one(f"{server}/file", 'shard.zip', ByteBudget(10 ** 9), backoff=0)
+
+    assert result["status"] == "done"
+    assert result["sha256"] == hashlib.sha256(PAYLOAD).hexdigest()
+
+
+def test_checksum_mismatch_discards_the_file(server, work_dir):
+    result = download_one(f"{server}/file", 'shard.zip', ByteBudget(10 ** 9), backoff=0, checksum='0' * 64)
+
+    assert result["status"] == "failed"
+    assert "SHA-256" in result["error"]
+    assert not os.path.exists('shard.zip')
+    assert not os.path.exists('shard.zip' + parallel_downloader.PART_SUFFIX)
+
+
+def test_missing_file_is_not_retried(server, work_dir, monkeypatch):
+    def not_found(self):
+        Handler.requests_seen.append((self.path, self.headers.get('Range')))
+        self.send_error(404)
+
+    monkeypatch.setattr(Handler, 'do_GET', not_found)
+
+    result = download_one(f"{server}/gone", 'shard.zip', ByteBudget(10 ** 9), max_attempts=3, backoff=0)
+
+    assert result["status"] == "failed"
+    assert Handler.requests_seen == [('/gone', None)]
+
+
+def test_budget_stops_concurrent_downloads(server, work_dir):
+    budget = ByteBudget(len(PAYLOAD) + len(PAYLOAD) // 2)
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        results = list(executor.map(
+            lambda i: download_one(f"{server}/file", f"shard-{i}.zip", budget, backoff=0), range(3)
+        ))
+
+    assert budget.used <= budget.max_bytes
+    assert budget.exhausted
+    statuses = sorted(result["status"] for result in results)
+    assert statuses.count("done") <= 1 and "budget" in statuses
+    for i, result in enumerate(results):
+        if result["status"] == "budget":
+            # The partial file is kept for a later resume
+            assert os.path.getsize(f"shard-{i}.zip" + parallel_downloader.PART_SUFFIX) == result["bytes"]
+
+
+def test_server_errors_are_retried_only_by_the_resuming_loop(server, work_dir, monkeypatch):
+    def unavailable(self):
+        Handler.requests_seen.append((self.path, self.headers.get('Range')))
+        self.send_error(503)
+
+    monkeypatch.setattr(Handler, 'do_GET', unavailable)
+    monkeypatch.setattr(parallel_downloader, '_thread_local', threading.local())
+
+    result = download_one(f"{server}/busy", 'shard.zip', ByteBudget(10 ** 9), max_attempts=3, backoff=0)
+
+    assert result["status"] == "failed"
+    assert Handler.requests_seen == [('/busy', None)] * 3
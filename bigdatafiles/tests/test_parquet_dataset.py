@@ -0,0 +1,76 @@
+import os
+import glob
+import random
+from datetime import date
+import pyarrow.parquet as pq
+import synthetic_data
+from drug_event_schema import DRUG_EVENT_SCHEMA, records_to_batch
+from parquet_dataset import PARTITION_KEY, SHARD_COLUMN, PartitionedDatasetWriter, file_shards
+
+SHARD = '1-drug-event-0001-of-0001'
+FILE_NAME = f'{SHARD}_drug-event-0001-of-0001.parquet'
+
+
+def _batches(start, count=300, batch_size=100, seed=0):
+    rng = random.Random(seed)
+    records = [synthetic_data.generate_record(rng, 10 ** 7 + i, start=start, days=120) for i in range(count)]
+    return [records_to_batch(records[i:i + batch_size]) for i in range(0, count, batch_size)]
+
+
+def _write(batches, row_group_size=64):
+    writer = PartitionedDatasetWriter('out', FILE_NAME, DRUG_EVENT_SCHEMA, SHARD, row_group_size=row_group_size)
+    for batch in batches:
+        writer.write_batch(batch)
+    return sorted(writer.close())
+
+
+def _contents():
+    """
+    Partition -> sorted report ids, over every file in the dataset.
+    """
+    contents = {}
+    for path in sorted(glob.glob(os.path.join('out', '*', '*'))):
+        ids = pq.read_table(path, columns=['safetyreportid']).column(0).to_pylist()
+        contents.setdefault(os.path.basename(os.path.dirname(path)), []).extend(ids)
+    return {partition: sorted(ids) for partition, ids in contents.items()}
+
+
+def test_rewriting_a_shard_is_idempotent(work_dir):
+    batches = _batches(date(2012, 1, 1))
+    paths = _write(batches)
+    first = _contents()
+    assert sum(len(ids) for ids in first.values()) == 300
+    assert all(os.path.basename(path) == FILE_NAME for path in paths)
+    for partition, ids in first.items():
+        month = partition.split('=', 1)[1]
+        dates = pq.read_table(os.path.join('out', partition, FILE_NAME), columns=['receivedate']).column(0)
+        assert {value.strftime('%Y-%m') for value in dates.to_pylist()} == {month}
+    # Every row and file names its shard
+    for path in paths:
+        assert set(pq.read_table(path, columns=[SHARD_COLUMN]).column(0).to_pylist()) == {SHARD}
+    assert len({file_shards(path)[SHARD] for path in paths}) == 1
+
+    # Row groups flushed at different points still give the same rows, and no temporary files remain
+    assert _write(batches, row_group_size=7) == paths
+    assert _contents() == first
+    assert all(name == FILE_NAME for partition in first for name in os.listdir(os.path.join('out', partition)))
+
+
+def test_rewrite_removes_copies_from_partitions_it_no_longer_touches(work_dir):
+    _write(_batches(date(2012, 1, 1)))
+    other = _write(_batches(date(2013, 6, 1)))
+
+    assert sorted(glob.glob(os.path.join('out', '*', FILE_NAME))) == other
+    assert all(partition.startswith(f"{PARTITION_KEY}=2013-") for partition in _contents())
+
+
+def test_abort_keeps_the_previous_output(work_dir):
+    _write(_batches(date(2012, 1, 1)))
+    before = _contents()
+    writer = PartitionedDatasetWriter('out', FILE_NAME, DRUG_EVENT_SCHEMA, SHARD, row_group_size=10)
+    for batch in _batches(date(2012, 1, 1), seed=1):
+        writer.write_batch(batch)
+    writer.abort()
+
+    assert _contents() == before
+    assert not glob.glob(os.path.join('out', '*', '.*'))
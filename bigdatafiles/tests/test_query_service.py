@@ -0,0 +1,76 @@
+import os
+import glob
+import shutil
+import pyarrow.parquet as pq
+import clean_to_parquet
+import dedupe
+import rollups
+import synthetic_data
+from query_service import QueryService
+
+
+def test_views_leave_out_the_versions_dedupe_dropped(work_dir):
+    corpus = synthetic_data.generate_dataset('raw', shards=2, records_per_shard=150, corrupt=0, empty=0)
+    # The first shard published again as a third shard: every report is now in two shards
+    copy = os.path.join('raw', '3-drug-event-0003-of-0003.json', 'drug-event-0003-of-0003.json')
+    os.makedirs(os.path.dirname(copy))
+    shutil.copy(corpus["files"][0], copy)
+    for path in corpus["files"] + [copy]:
+        clean_to_parquet.clean_and_convert(path, input_dir='raw', output_dir='out', normalized_dir='norm')
+
+    with QueryService('out', 'norm', manifest_path='ingest_manifest.sqlite', dedupe_dir='dedupe') as service:
+        assert service.query("SELECT count(*) AS n FROM reports")["n"][0] == 450
+        all_drugs = service.query("SELECT count(*) AS n FROM drugs")["n"][0]
+
+        summary = dedupe.main('norm', 'dedupe')
+        assert summary["duplicates_dropped"] == 150
+        rollups.main('norm', 'cubes', 'dedupe')
+        reports = service.query("SELECT count(*) AS n, count(DISTINCT safetyreportid) AS ids FROM reports")
+        assert reports["n"][0] == reports["ids"][0] == 300
+        assert reports["n"][0] == rollups.load_cube('reports', 'cubes').column(rollups.COUNT_COLUMN).to_numpy().sum()
+
+        drug_rows = service.query("SELECT count(*) AS n FROM drugs")["n"][0]
+        assert 0 < drug_rows < all_drugs
+        orphans = service.query("SELECT count(*) AS n FROM drugs ANTI JOIN reports USING (safetyreportid)")
+        assert orphans["n"][0] == 0
+        # Pruned queries apply the same lists
+        months = service.query("SELECT count(*) AS n FROM reactions", start_month='1900-01', end_month='2100-12')
+        assert months["n"][0] == service.query("SELECT count(*) AS n FROM reactions")["n"][0]
+
+
+def _converted(shards=2):
+    corpus = synthetic_data.generate_dataset('raw', shards=shards, records_per_shard=150, corrupt=0, empty=0)
+    for path in corpus["files"]:
+        clean_to_parquet.clean_and_convert(path, input_dir='raw', output_dir='out', normalized_dir='norm')
+    return corpus
+
+
+def test_files_rewritten_in_place_invalidate_the_cache(work_dir):
+    _converted()
+    with QueryService('out', 'norm', manifest_path='ingest_manifest.sqlite', dedupe_dir='dedupe') as service:
+        assert service.query("SELECT count(*) AS n FROM reports")["n"][0] == 300
+        version = service.refresh()
+        path = sorted(glob.glob(os.path.join('norm', 'reports', '*', '*.parquet')))[0]
+        partition = os.path.dirname(path)
+        partition_mtime = os.stat(partition).st_mtime_ns
+        table = pq.read_table(path)
+        # Rewritten in place, as compaction or dropping stale rows may do: the directory is unchanged
+        pq.write_table(table.slice(0, table.num_rows - 1), path)
+        assert os.stat(partition).st_mtime_ns == partition_mtime
+
+        assert service.refresh() != version
+        assert service.query("SELECT count(*) AS n FROM reports")["n"][0] == 299
+
+
+def test_countries_filter_drugs_and_reactions_through_their_reports(work_dir):
+    _converted()
+    with QueryService('out', 'norm', manifest_path='ingest_manifest.sqlite', dedupe_dir='dedupe') as service:
+        country = service.query("SELECT occurcountry FROM reports GROUP BY 1 ORDER BY count(*) DESC LIMIT 1")
+        country = country["occurcountry"][0]
+        for view in ('drugs', 'reactions'):
+            expected = service.query(f"SELECT count(*) AS n FROM {view} x SEMI JOIN "
+                                     f"(SELECT * FROM reports WHERE occurcountry = '{country}') r "
+                                     f"ON r.shard = x.shard AND r.safetyreportid = x.safetyreportid")["n"][0]
+            everything = service.query(f"SELECT count(*) AS n FROM {view}")["n"][0]
+            filtered = service.query(f"SELECT count(*) AS n FROM {view}", countries=[country])["n"][0]
+            assert 0 < filtered == expected < everything
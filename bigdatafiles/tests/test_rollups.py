@@ -0,0 +1,56 @@
+import os
+import json
+import shutil
+import clean_to_parquet
+import rollups
+import synthetic_data
+from normalized_tables import list_shard_files
+
+
+def test_cubes_match_a_full_recount_after_incremental_updates(work_dir, monkeypatch):
+    monkeypatch.setattr(rollups, 'MERGE_CHUNK', 1)
+    corpus = synthetic_data.generate_dataset('raw', shards=3, records_per_shard=150, corrupt=0, empty=0)
+    for path in corpus["files"][:2]:
+        clean_to_parquet.clean_and_convert(path, input_dir='raw', output_dir='out', normalized_dir='norm')
+    rollups.main('norm', 'cubes', 'dedupe')
+    clean_to_parquet.clean_and_convert(corpus["files"][2], input_dir='raw', output_dir='out', normalized_dir='norm')
+    rollups.main('norm', 'cubes', 'dedupe')
+
+    rollups.main('norm', 'fresh', 'dedupe')
+    for cube in rollups.CUBES:
+        keys = rollups.CUBES[cube]
+        incremental = rollups.load_cube(cube, 'cubes').sort_by([(key, 'ascending') for key in keys])
+        fresh = rollups.load_cube(cube, 'fresh').sort_by([(key, 'ascending') for key in keys])
+        assert incremental.equals(fresh)
+    assert rollups.load_cube('reports', 'cubes').column(rollups.COUNT_COLUMN).to_numpy().sum() == 450
+    # Only the deltas the cubes reference are kept
+    assert len(os.listdir(os.path.join('cubes', 'deltas', 'reports'))) == 3
+
+
+def test_rewritten_and_removed_shards_are_folded_out_of_the_cubes(work_dir):
+    corpus = synthetic_data.generate_dataset('raw', shards=2, records_per_shard=150, corrupt=0, empty=0)
+    for path in corpus["files"]:
+        clean_to_parquet.clean_and_convert(path, input_dir='raw', output_dir='out', normalized_dir='norm')
+    rollups.main('norm', 'cubes', 'dedupe')
+    first, second = sorted(list_shard_files('norm'))
+
+    # The first shard is republished with other records, the second withdrawn
+    other = synthetic_data.generate_dataset('other', shards=2, records_per_shard=90, corrupt=0, empty=0, seed=7)
+    shutil.copy(other["files"][0], corpus["files"][0])
+    clean_to_parquet.clean_and_convert(corpus["files"][0], input_dir='raw', output_dir='out', normalized_dir='norm')
+    for paths in list_shard_files('norm')[second].values():
+        for path in paths:
+            os.remove(path)
+    rollups.main('norm', 'cubes', 'dedupe')
+
+    rollups.main('norm', 'fresh', 'dedupe')
+    for cube, keys in rollups.CUBES.items():
+        incremental = rollups.load_cube(cube, 'cubes').sort_by([(key, 'ascending') for key in keys])
+        fresh = rollups.load_cube(cube, 'fresh').sort_by([(key, 'ascending') for key in keys])
+        assert incremental.equals(fresh)
+        assert json.loads(incremental.schema.metadata[rollups.APPLIED_KEY]) == \
+            json.loads(fresh.schema.metadata[rollups.APPLIED_KEY])
+    assert rollups.load_cube('reports', 'cubes').column(rollups.COUNT_COLUMN).to_numpy().sum() == 90
+    # The deltas of the old first shard and of the second are gone
+    deltas = os.listdir(os.path.join('cubes', 'deltas', 'reports'))
+    assert len(deltas) == 1 and deltas[0].startswith(f"{first}.")
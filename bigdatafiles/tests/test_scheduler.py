@@ -0,0 +1,94 @@
+import os
+import time
+import scheduler
+
+
+def crashing_stage(source):
+    if source == 'killed':
+        os._exit(1)  # Like a worker killed for memory
+    if source == 'raises':
+        raise ValueError("bad shard")
+    return f"Processed {source}"
+
+
+def make_tasks(sources):
+    return [{"source": source, "size": 1, "memory": 1, "huge": False, "kwargs": {}} for source in sources]
+
+
+def test_dead_worker_does_not_abort_the_run():
+    sources = ['a', 'killed', 'b', 'raises', 'c', 'd']
+
+    results = scheduler.run_tasks(crashing_stage, make_tasks(sources), memory_budget=10 ** 12, max_workers=3)
+
+    assert set(results) == set(sources)
+    for source in ('a', 'b', 'c', 'd'):
+        assert results[source] == f"Processed {source}"
+    assert results['raises'].startswith("Error processing raises: ValueError")
+    assert "died" in results['killed']
+
+
+def test_error_result_shapes_failures():
+    results = scheduler.run_tasks(crashing_stage, make_tasks(['raises']), 10 ** 12, 1,
+                                  error_result=lambda source, error: {"file": source, "error": error})
+    assert results == {'raises': {"file": 'raises', "error": "ValueError: bad shard"}}
+
+
+def timed_stage(source, log_dir):
+    start = time.time()
+    time.sleep(0.3)
+    with open(os.path.join(log_dir, source), 'w') as f:
+        f.write(f"{start} {time.time()}")
+    return f"Processed {source}"
+
+
+def _spans(tasks, log_dir):
+    spans = {}
+    for task in tasks:
+        with open(os.path.join(log_dir, task["source"])) as f:
+            spans[task["source"]] = [float(value) for value in f.read().split()]
+    return spans
+
+
+def _peak(tasks, spans, weight):
+    """
+    Largest total `weight` of the tasks running at the same time.
+    """
+    return max(sum(weight(other) for other in tasks
+                   if spans[other["source"]][0] <= spans[task["source"]][0] < spans[other["source"]][1])
+               for task in tasks)
+
+
+def test_running_tasks_stay_within_the_memory_budget(work_dir):
+    mb = 1024 ** 2
+    worker = scheduler.WORKER_MEMORY_MB * mb
+    tasks = [{"source": f"small-{i}", "size": 1, "memory": 100 * mb, "huge": False, "kwargs": {}} for i in range(6)]
+    tasks += [{"source": f"huge-{i}", "size": 2, "memory": 100 * mb, "huge": True, "kwargs": {}} for i in range(3)]
+    # Needs more than the whole budget, so it runs by itself
+    tasks.append({"source": 'giant', "size": 3, "memory": 1000 * mb, "huge": True, "kwargs": {}})
+    budget = 3 * (100 * mb + worker)
+
+    results = scheduler.run_tasks(timed_stage, tasks, budget, max_workers=6, max_huge=1, log_dir=str(work_dir))
+
+    assert results == {task["source"]: f"Processed {task['source']}" for task in tasks}
+    spans = _spans(tasks, work_dir)
+    regular = [task for task in tasks if task["source"] != 'giant']
+    assert _peak(regular, spans, lambda task: task["memory"] + worker) <= budget
+    assert _peak(regular, spans, lambda task: 1) == 3
+    assert _peak(tasks, spans, lambda task: task["huge"]) == 1
+    giant_start, giant_end = spans['giant']
+    assert all(end <= giant_start or start >= giant_end for source, (start, end) in spans.items() if source != 'giant')
+
+
+def test_plan_orders_largest_first_and_streams_what_does_not_fit(work_dir):
+    mb = 1024 ** 2
+    for name, size in (('small.json', 1), ('large.json', 30), ('medium.json', 8)):
+        with open(name, 'wb') as f:
+            f.write(b' ' * size * mb)
+
+    tasks = scheduler.plan_tasks(['small.json', 'large.json', 'medium.json'], memory_budget=200 * mb,
+                                 in_memory=True, in_memory_factor=10, streaming_memory_mb=50)
+
+    assert [task["source"] for task in tasks] == ['large.json', 'medium.json', 'small.json']
+    assert [task["kwargs"]["streaming"] for task in tasks] == [True, False, False]
+    assert [task["memory"] // mb for task in tasks] == [50, 80, 50]
+    assert not any(task["huge"] for task in tasks)
@@ -0,0 +1,49 @@
+import os
+import zipfile
+import pyarrow as pa
+import pyarrow.parquet as pq
+import clean_to_parquet
+import synthetic_data
+from manifest import shard_key
+from parquet_dataset import dataset_file_name
+from shard_sources import ZIP_MEMBER_SEPARATOR, list_json_sources, open_json_source, relative_source_path, source_size
+
+
+def _rows(dataset_dir):
+    paths = sorted(os.path.join(root, name) for root, _, names in os.walk(dataset_dir) for name in names)
+    return pa.concat_tables(pq.read_table(path) for path in paths).sort_by('safetyreportid')
+
+
+def test_zip_members_read_like_the_extracted_files(work_dir):
+    zipped = synthetic_data.generate_dataset('Data', shards=2, records_per_shard=80, corrupt=0, empty=0, as_zip=True)
+    extracted = synthetic_data.generate_dataset('DataUnzip', shards=2, records_per_shard=80, corrupt=0, empty=0)
+    archive = zipped["files"][0]
+    with zipfile.ZipFile(archive, 'a') as zip_ref:
+        zip_ref.writestr('__MACOSX/._drug-event-0001-of-0002.json', b'resource fork')
+        zip_ref.writestr('README.txt', b'not a shard')
+    with open(os.path.join('Data', 'broken.zip'), 'wb') as f:
+        f.write(b'not a zip')
+
+    sources = list_json_sources('Data')
+    assert sources == sorted(f"{path}{ZIP_MEMBER_SEPARATOR}{os.path.basename(plain)}"
+                             for path, plain in zip(zipped["files"], extracted["files"]))
+    # The downloaded archive and its members share one manifest shard
+    assert shard_key(archive, 'Data') == shard_key(sources[0], 'Data')
+    for source, plain in zip(sources, extracted["files"]):
+        assert relative_source_path(source, 'Data') == os.path.relpath(plain, 'DataUnzip')
+        assert shard_key(source, 'Data') == shard_key(plain, 'DataUnzip')
+        assert dataset_file_name(source, 'Data') == dataset_file_name(plain, 'DataUnzip')
+        assert source_size(source) == os.path.getsize(plain)
+        with open_json_source(source) as f, open(plain, encoding='utf-8') as g:
+            assert f.read() == g.read()
+
+    for source, plain in zip(sources, extracted["files"]):
+        zip_result = clean_to_parquet.clean_and_convert(source, input_dir='Data', output_dir='from_zip',
+                                                        normalized_dir=None)
+        plain_result = clean_to_parquet.clean_and_convert(plain, input_dir='DataUnzip', output_dir='from_files',
+                                                          normalized_dir=None)
+        assert zip_result["error"] is None and zip_result["records"] == plain_result["records"] == 80
+        assert [os.path.relpath(path, 'from_zip') for path in zip_result["outputs"]] == \
+            [os.path.relpath(path, 'from_files') for path in plain_result["outputs"]]
+    assert not os.path.exists(os.path.join('Data', '1-drug-event-0001-of-0002.json'))
+    assert _rows('from_zip').equals(_rows('from_files'))
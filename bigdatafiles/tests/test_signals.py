@@ -0,0 +1,90 @@
+import math
+import functools
+from datetime import date
+import numpy as np
+import pytest
+import clean_to_parquet
+import rollups
+import signals
+import synthetic_data
+from json_stream import iter_records
+
+
+def test_crude_statistics_match_a_hand_computed_table():
+    # 20 of the 100 reports with the drug have the reaction, 100 of the 1900 without it do
+    result = signals.disproportionality([20], [80], [100], [1800])
+    prr = (20 / 100) / (100 / 1900)
+    prr_se = math.sqrt(1 / 20 - 1 / 100 + 1 / 100 - 1 / 1900)
+    ror_se = math.sqrt(1 / 20 + 1 / 80 + 1 / 100 + 1 / 1800)
+    expected = {
+        'prr': 3.8,
+        'prr_lower': prr * math.exp(-signals.Z * prr_se),
+        'prr_upper': prr * math.exp(signals.Z * prr_se),
+        'ror': 4.5,
+        'ror_lower': 4.5 * math.exp(-signals.Z * ror_se),
+        'ror_upper': 4.5 * math.exp(signals.Z * ror_se),
+        # Yates-corrected: n (|ad - bc| - n/2)^2 / ((a+b)(c+d)(a+c)(b+d))
+        'chi2': 2000 * (20 * 1800 - 80 * 100 - 1000) ** 2 / (100 * 1900 * 120 * 1880),
+    }
+    for name, value in expected.items():
+        assert result[name][0] == pytest.approx(value), name
+
+
+def test_stratified_statistics_match_a_hand_computed_pair_of_tables():
+    # Two quarters: (a, b, c, d) = (4, 6, 10, 80) and (6, 14, 20, 160)
+    A = np.array([[4.0, 6.0]])
+    result = signals.mantel_haenszel(A, Nd=np.array([[10.0, 20.0]]), Nr=np.array([[14.0, 26.0]]),
+                                     N=np.array([100.0, 200.0]))
+    # ROR_MH = sum(ad/n) / sum(bc/n) = (3.2 + 4.8) / (0.6 + 1.4)
+    assert result['ror_mh'][0] == pytest.approx(4.0)
+    # PRR_MH = sum(a(c+d)/n) / sum(c(a+b)/n) = (3.6 + 5.4) / (1 + 2)
+    assert result['prr_mh'][0] == pytest.approx(3.0)
+    assert result['prr_mh_lower'][0] < 3.0 < result['prr_mh_upper'][0]
+    assert result['ror_mh_lower'][0] < 4.0 < result['ror_mh_upper'][0]
+
+    # A single stratum reduces to the crude statistics
+    single = signals.mantel_haenszel(np.array([[20.0]]), np.array([[100.0]]), np.array([[120.0]]), np.array([2000.0]))
+    crude = signals.disproportionality([20], [80], [100], [1800])
+    for name in ('prr', 'prr_lower', 'prr_upper', 'ror', 'ror_lower', 'ror_upper'):
+        assert single[f"{name.split('_')[0]}_mh{name[3:]}"][0] == pytest.approx(crude[name][0]), name
+
+
+def test_signal_table_matches_counts_taken_from_the_raw_reports(work_dir, monkeypatch):
+    monkeypatch.setattr(synthetic_data, 'generate_record',
+                        functools.partial(synthetic_data.generate_record, start=date(2010, 1, 1), days=365))
+    corpus = synthetic_data.generate_dataset('raw', shards=2, records_per_shard=300, corrupt=0, empty=0)
+    for path in corpus["files"]:
+        clean_to_parquet.clean_and_convert(path, input_dir='raw', output_dir='out', normalized_dir='norm')
+    rollups.main('norm', 'cubes', 'dedupe')
+    signals.main('cubes', 'signals')
+
+    # Per quarter: every report's drugs and reactions, upper-cased like the vocabularies compare them
+    reports = {}
+    for path in corpus["files"]:
+        with open(path, encoding='utf-8') as f:
+            for record in iter_records(f):
+                month = int(record["receivedate"][4:6])
+                reports[record["safetyreportid"]] = (
+                    (month - 1) // 3,
+                    {drug["medicinalproduct"].upper() for drug in record["patient"]["drug"]},
+                    {reaction["reactionmeddrapt"].upper() for reaction in record["patient"]["reaction"]},
+                )
+
+    table = signals.load_signals('signals').to_pandas()
+    assert (table['a'] + table['b'] + table['c'] + table['d'] == len(reports)).all()
+    for _, row in table.sort_values('a', ascending=False).head(5).iterrows():
+        drug, reaction = row['drug'].upper(), row['reaction'].upper()
+        cells = np.zeros((4, 4))  # quarter x (a, b, c, d)
+        for quarter, drugs, reactions in reports.values():
+            has_drug, has_reaction = drug in drugs, reaction in reactions
+            cell = 0 if has_drug and has_reaction else 1 if has_drug else 2 if has_reaction else 3
+            cells[quarter, cell] += 1
+        a, b, c, d = cells.sum(axis=0)
+        assert (row['a'], row['b'], row['c'], row['d']) == (a, b, c, d)
+        crude = signals.disproportionality([a], [b], [c], [d])
+        assert row['prr'] == pytest.approx(crude['prr'][0]) and row['ror'] == pytest.approx(crude['ror'][0])
+        # Mantel-Haenszel over the four quarters of 2010
+        qa, qb, qc, qd = cells.T
+        n = cells.sum(axis=1)
+        assert row['prr_mh'] == pytest.approx((qa * (qc + qd) / n).sum() / (qc * (qa + qb) / n).sum())
+        assert row['ror_mh'] == pytest.approx((qa * qd / n).sum() / (qb * qc / n).sum())
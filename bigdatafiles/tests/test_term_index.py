@@ -0,0 +1,105 @@
+import os
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import pytest
+import term_index
+from term_index import list_dataset_files, list_terms, lookup, matching_rows, read_matching, update_index
+
+
+@pytest.fixture
+def dataset(converted):
+    # Small row groups, so lookups have row groups to tell apart
+    for path in list_dataset_files(converted["out"]):
+        pq.write_table(pq.read_table(path), path, row_group_size=16)
+    return converted["out"]
+
+
+def _term_row_groups(dataset_dir, vocabulary, term):
+    """
+    Path -> row groups holding `term`, found by reading every row group.
+    """
+    found = {}
+    for path in list_dataset_files(dataset_dir):
+        parquet_file = pq.ParquetFile(path)
+        for row_group in range(parquet_file.num_row_groups):
+            terms, _ = list_terms(parquet_file.read_row_group(row_group), vocabulary)
+            if pc.any(pc.fill_null(pc.equal(terms, term), False)).as_py():
+                found.setdefault(path, []).append(row_group)
+    return found
+
+
+def _common_terms(dataset_dir):
+    """
+    A drug and a reaction term reported together, the drug a common one.
+    """
+    table = pq.read_table(list_dataset_files(dataset_dir)[0])
+    drugs, drug_rows = list_terms(table, 'drug')
+    counts = pc.value_counts(drugs.drop_null()).to_pylist()
+    drug = max(counts, key=lambda count: count['counts'])['values']
+    row = drug_rows.filter(pc.equal(drugs, drug))[0].as_py()
+    reactions, _ = list_terms(table.slice(row, 1), 'reaction')
+    return drug, reactions.drop_null()[0].as_py()
+
+
+def test_update_index_follows_new_rewritten_and_removed_files(dataset):
+    files = list_dataset_files(dataset)
+    assert update_index(dataset) == {"indexed": len(files), "removed": 0, "unchanged": 0}
+    assert update_index(dataset) == {"indexed": 0, "removed": 0, "unchanged": len(files)}
+
+    # Rewritten in place with other rows: its postings are replaced
+    drug, _ = _common_terms(dataset)
+    rewritten = next(path for path in files if path in _term_row_groups(dataset, 'drug', drug))
+    table = pq.read_table(rewritten)
+    terms, rows = list_terms(table, 'drug')
+    with_drug = rows.filter(pc.fill_null(pc.equal(terms, drug), False))
+    without = table.filter(pc.invert(pc.is_in(pa.array(range(table.num_rows), rows.type), value_set=with_drug)))
+    pq.write_table(without, rewritten, row_group_size=16)
+    assert update_index(dataset) == {"indexed": 1, "removed": 0, "unchanged": len(files) - 1}
+    assert rewritten not in lookup(drug)
+    assert lookup(drug) == _term_row_groups(dataset, 'drug', drug)
+
+    removed = files[-1]
+    os.remove(removed)
+    assert update_index(dataset) == {"indexed": 0, "removed": 1, "unchanged": len(files) - 1}
+    with term_index.TermIndex() as index:
+        assert removed not in index.indexed_files()
+
+
+def test_lookup_intersects_drug_and_reaction_row_groups(dataset):
+    update_index(dataset)
+    drug, reaction = _common_terms(dataset)
+    drugs = _term_row_groups(dataset, 'drug', drug)
+    reactions = _term_row_groups(dataset, 'reaction', reaction)
+
+    assert lookup(drug) == drugs
+    assert lookup(reaction=reaction) == reactions
+    both = {path: sorted(set(groups) & set(reactions[path])) for path, groups in drugs.items() if path in reactions}
+    assert lookup(drug, reaction) == {path: groups for path, groups in both.items() if groups}
+    assert sum(len(groups) for groups in lookup(drug, reaction).values()) < sum(len(groups) for groups in drugs.values())
+    assert lookup('no such drug') == {}
+
+
+def test_read_matching_returns_only_the_matching_rows(dataset, monkeypatch):
+    update_index(dataset)
+    drug, reaction = _common_terms(dataset)
+    expected = []
+    for path in list_dataset_files(dataset):
+        table = pq.read_table(path)
+        expected.extend(table.filter(matching_rows(table, drug, reaction)).column('safetyreportid').to_pylist())
+
+    read = []
+    read_row_groups = pq.ParquetFile.read_row_groups
+    monkeypatch.setattr(pq.ParquetFile, 'read_row_groups', lambda self, row_groups, columns=None, **kwargs: (
+        read.append(columns) or read_row_groups(self, row_groups, columns=columns, **kwargs)))
+    table = read_matching(lookup(drug, reaction), drug, reaction, columns=['safetyreportid', 'receivedate'])
+
+    # Only the requested columns and the term columns are read
+    assert read and all(columns == ['safetyreportid', 'receivedate', term_index.column_path('drug'),
+                                    term_index.column_path('reaction')] for columns in read)
+
+    assert table.column_names == ['safetyreportid', 'receivedate', term_index.PARTITION_KEY]
+    assert sorted(table.column('safetyreportid').to_pylist()) == sorted(expected)
+    assert len(expected) > 0
+    full = read_matching(lookup(drug, reaction), drug, reaction)
+    assert 'patient' in full.column_names and full.num_rows == table.num_rows
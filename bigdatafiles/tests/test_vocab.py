@@ -0,0 +1,31 @@
+from concurrent.futures import ThreadPoolExecutor
+import pyarrow as pa
+from vocab import Vocabulary
+
+
+def test_ids_are_stable_and_new_terms_are_appended(work_dir):
+    with Vocabulary() as vocabulary:
+        ids = vocabulary.encode('drug', pa.array([' aspirin', 'IBUPROFEN', None, '', 'Aspirin ']))
+        assert ids.to_pylist() == [1, 2, None, None, 1]
+
+    # A later run, with its own connection and cache, keeps the ids it finds
+    with Vocabulary() as vocabulary:
+        ids = vocabulary.encode('drug', pa.array(['metformin', 'aspirin', 'ibuprofen']))
+        assert ids.to_pylist() == [3, 1, 2]
+        # Vocabularies are numbered separately and keep the case of case-sensitive terms
+        assert vocabulary.encode('reaction', pa.array(['Nausea', 'nausea'])).to_pylist() == [1, 2]
+        assert vocabulary.ids('drug', ['WARFARIN'], assign=False) == {}
+        assert vocabulary.decode('drug', [3, 1, 99]).to_pylist() == ['METFORMIN', 'ASPIRIN', None]
+
+
+def test_concurrent_writers_agree_on_ids(work_dir):
+    terms = [f"DRUG {i}" for i in range(200)]
+
+    def assign(offset):
+        with Vocabulary() as vocabulary:
+            return vocabulary.ids('drug', terms[offset:] + terms[:offset])
+
+    with ThreadPoolExecutor(4) as pool:
+        mappings = list(pool.map(assign, [0, 50, 100, 150]))
+    assert all(mapping == mappings[0] for mapping in mappings)
+    assert sorted(mappings[0].values()) == list(range(1, 201))
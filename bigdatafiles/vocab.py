@@ -0,0 +1,176 @@
+import sqlite3
+import threading
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# Global dictionaries shared by every conversion run and worker
+VOCABULARY_PATH = 'vocabulary.sqlite'
+
+# Vocabulary name -> whether its terms are upper-cased. Terms are always
+# trimmed, and empty strings count as missing.
+VOCABULARIES = {
+    'drug': True,       # patient.drug.medicinalproduct
+    'reaction': False,  # patient.reaction.reactionmeddrapt (MedDRA preferred terms)
+    'country': True,    # occurcountry, primarysourcecountry, primarysource.reportercountry
+}
+
+# Most SQLite builds allow 999 parameters per statement
+_LOOKUP_CHUNK = 500
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS terms (
+    vocabulary TEXT NOT NULL,
+    term TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    PRIMARY KEY (vocabulary, term),
+    UNIQUE (vocabulary, id)
+);
+"""
+
+
+def normalize_terms(array, vocabulary):
+    """
+    Canonical form of the terms of `vocabulary`: trimmed, upper-cased where
+    the vocabulary is case-insensitive, with empty strings turned into nulls.
+    """
+    terms = pc.utf8_trim_whitespace(array)
+    if VOCABULARIES[vocabulary]:
+        terms = pc.utf8_upper(terms)
+    return pc.if_else(pc.equal(terms, ''), pa.scalar(None, pa.string()), terms)
+
+
+class Vocabulary:
+    """
+    SQLite-backed dictionaries mapping every term of a vocabulary to a compact
+    integer id. Ids start at 1, are never reused or renumbered, and are
+    assigned under a write lock, so concurrent converters and later
+    incremental runs all agree on them.
+    """
+
+    def __init__(self, path=VOCABULARY_PATH):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(_SCHEMA)
+        self.cache = {name: {} for name in VOCABULARIES}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def _select(self, vocabulary, terms):
+        found = {}
+        for i in range(0, len(terms), _LOOKUP_CHUNK):
+            chunk = terms[i:i + _LOOKUP_CHUNK]
+            placeholders = ",".join("?" * len(chunk))
+            found.update(self.conn.execute(
+                f"SELECT term, id FROM terms WHERE vocabulary = ? AND term IN ({placeholders})",
+                [vocabulary] + chunk,
+            ))
+        return found
+
+    def ids(self, vocabulary, terms, assign=True):
+        """
+        Ids of `terms`, assigning new ids to unseen terms when `assign` is set.
+
+        Returns:
+            dict: Term -> id (unknown terms are missing when not assigning).
+        """
+        cache = self.cache[vocabulary]
+        missing = [term for term in set(terms) if term not in cache]
+        if missing:
+            found = self._select(vocabulary, missing)
+            new_terms = [term for term in missing if term not in found]
+            if new_terms and assign:
+                self.conn.execute("BEGIN IMMEDIATE")
+                try:
+                    self.conn.executemany(
+                        """
+                        INSERT OR IGNORE INTO terms (vocabulary, term, id)
+                        SELECT ?1, ?2, COALESCE(MAX(id), 0) + 1 FROM terms WHERE vocabulary = ?1
+                        """,
+                        [(vocabulary, term) for term in sorted(new_terms)],
+                    )
+                    self.conn.execute("COMMIT")
+                except Exception:
+                    self.conn.execute("ROLLBACK")
+                    raise
+                found.update(self._select(vocabulary, new_terms))
+            cache.update(found)
+        return {term: cache[term] for term in terms if term in cache}
+
+    def encode(self, vocabulary, array):
+        """
+        Replace the terms of a string array by their int32 ids, assigning ids
+        to unseen terms. The array is normalized first (see normalize_terms);
+        nulls stay null.
+        """
+        terms = normalize_terms(array, vocabulary)
+        unique = pc.unique(terms).drop_null()
+        if len(unique) == 0:
+            return pa.nulls(len(terms), pa.int32())
+        mapping = self.ids(vocabulary, unique.to_pylist())
+        unique_ids = pa.array([mapping[term] for term in unique.to_pylist()], pa.int32())
+        return pc.take(unique_ids, pc.index_in(terms, value_set=unique))
+
+    def table(self, vocabulary):
+        """
+        The whole vocabulary as a table of (id, term), ordered by id.
+        """
+        rows = self.conn.execute(
+            "SELECT id, term FROM terms WHERE vocabulary = ? ORDER BY id", (vocabulary,)
+        ).fetchall()
+        return pa.table({
+            'id': pa.array([row[0] for row in rows], pa.int32()),
+            'term': pa.array([row[1] for row in rows], pa.string()),
+        })
+
+    def decode(self, vocabulary, ids):
+        """
+        Turn an array of ids back into terms, as a dictionary array (which
+        pandas loads as a Categorical). Unknown ids become null.
+        """
+        table = self.table(vocabulary)
+        if not isinstance(ids, (pa.Array, pa.ChunkedArray)):
+            ids = pa.array(ids, pa.int32())
+        if isinstance(ids, pa.ChunkedArray):
+            ids = ids.combine_chunks()
+        indices = pc.index_in(ids, value_set=table.column('id').combine_chunks()).cast(pa.int32())
+        return pa.DictionaryArray.from_arrays(indices, table.column('term').combine_chunks())
+
+
+_thread_local = threading.local()
+
+
+def get_vocabulary(path=VOCABULARY_PATH):
+    """
+    One Vocabulary connection per worker thread, with its id cache kept for
+    the life of the worker.
+    """
+    vocabularies = getattr(_thread_local, 'vocabularies', None)
+    if vocabularies is None:
+        vocabularies = _thread_local.vocabularies = {}
+    if path not in vocabularies:
+        vocabularies[path] = Vocabulary(path)
+    return vocabularies[path]
+
+
+def main(path=VOCABULARY_PATH):
+    """
+    Print the size of every vocabulary and its first few terms.
+    """
+    with Vocabulary(path) as vocabulary:
+        for name in VOCABULARIES:
+            table = vocabulary.table(name)
+            sample = ", ".join(f"{i}={t}" for i, t in zip(table.column('id').to_pylist()[:5],
+                                                         table.column('term').to_pylist()[:5]))
+            print(f"{name}: {table.num_rows} terms ({sample})")
+
+
+if __name__ == "__main__":
+    main()